@@ -0,0 +1,341 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from io import BytesIO
+import argparse
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import main
+import resume_img
+from mock_sentinel import synthetic_bands
+
+# Micro-benchmark dei percorsi numerici e di storage: tempo, throughput e
+# picco di memoria per funzione e dimensione dei dati, salvati in JSON e
+# confrontati con una baseline.
+#
+#   python ./bench.py -output bench.json
+#   python ./bench.py -baseline bench_baseline.json        (exit 1 se regressioni)
+#   python ./bench.py -baseline bench_baseline.json -save-baseline
+
+PRESETS = {
+    "quick":   {"raster": (64, 256),             "rows": (1_000, 10_000)},
+    "default": {"raster": (64, 256, 1024, 2500), "rows": (1_000, 10_000, 100_000, 1_000_000)},
+    "full":    {"raster": (64, 256, 1024, 2500), "rows": (1_000, 10_000, 100_000, 1_000_000,
+                                                          10_000_000)},
+}
+
+BENCH_DEFAULTS = {
+    "min_time":       0.5,   # secondi minimi di misura per caso
+    "max_repeats":    20,
+    "time_threshold": 0.20,  # regressione se il tempo minimo cresce oltre il 20%
+    "mem_threshold":  0.30,  # regressione se il picco di memoria cresce oltre il 30%
+}
+
+BENCH_GEOMETRY = {"type": "Polygon",
+                  "coordinates": [[[16.0, 40.0], [16.01, 40.0], [16.01, 40.01],
+                                   [16.0, 40.01], [16.0, 40.0]]]}
+BENCH_FIELDS  = 20
+BENCH_INDICES = ["ndvi", "ndre", "gndvi", "gci", "savi", "ndmi"]
+
+# ================= DATI SINTETICI =================
+
+def synthetic_raster(size):
+    """Bande B03, B04, B08 e NDVI (4 x size x size, float32) di un campo a chiome."""
+    _, b03, b04, b08 = synthetic_bands(BENCH_GEOMETRY, "2024-06-01T00:00:00Z",
+                                       "2024-06-11T00:00:00Z", size, size, empty_ratio=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ndvi = (b08 - b04) / (b08 + b04)
+    return np.stack([b03, b04, b08, ndvi]).astype(np.float32)
+
+
+def geotiff_bytes(data):
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_bounds
+
+    _, height, width = data.shape
+    with MemoryFile() as mem:
+        with mem.open(driver="GTiff", width=width, height=height, count=data.shape[0],
+                      dtype=data.dtype, crs="EPSG:4326",
+                      transform=from_bounds(16.0, 40.0, 16.01, 40.01, width, height)) as dst:
+            dst.write(data)
+        return mem.read()
+
+
+def _field_key(i):
+    return {"field": f"{i:016x}", "size": "512x512", "step_days": "10"}
+
+
+def datapoints_file(workdir, rows):
+    """
+    CSV delle rilevazioni con rows righe: BENCH_FIELDS campi, finestre di 10
+    giorni, indici a rotazione e un 10% di rilevazioni ripetute (più recenti).
+    Generato una volta e riusato tra le esecuzioni.
+    """
+    path = os.path.join(workdir, f"datapoints_{rows}.csv")
+    if os.path.exists(path):
+        return path
+
+    rng    = np.random.default_rng(rows)
+    i      = np.arange(rows)
+    unique = max(1, int(rows * 0.9))
+    k      = np.where(i < unique, i, rng.integers(0, unique, rows))
+    field  = k % BENCH_FIELDS
+    index  = (k // BENCH_FIELDS) % len(BENCH_INDICES)
+    window = k // (BENCH_FIELDS * len(BENCH_INDICES))
+    day0   = np.datetime64("2018-01-01")
+    start  = day0 + (window * 10).astype("timedelta64[D]")
+    stamp  = np.datetime64("2024-01-01T00:00:00") + i.astype("timedelta64[s]")
+
+    df = pd.DataFrame({
+        "timestamp":    np.datetime_as_string(stamp, unit="s"),
+        "field":        np.char.mod("%016x", field),
+        "size":         "512x512",
+        "step_days":    10,
+        "start":        np.datetime_as_string(start, unit="D"),
+        "end":          np.datetime_as_string(start + np.timedelta64(10, "D"), unit="D"),
+        "tree_focused": np.where(field % 2 == 0, "False", "True"),
+        "index":        np.array(BENCH_INDICES)[index],
+        "value":        np.round(rng.uniform(-0.2, 0.9, rows), 6),
+    }, columns=main.CSV_FIELDNAMES)
+    df.to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def pixels_file(workdir, rows):
+    """*_pixels.csv di un giorno con rows pixel e la sua versione binaria .npy."""
+    path = os.path.join(workdir, f"bench_{rows}_pixels.csv")
+    if os.path.exists(path) and resume_img.load_manifest(path) is not None:
+        return path
+
+    rng = np.random.default_rng(rows)
+    df  = pd.DataFrame({c: rng.normal(0.4, 0.15, rows).astype(np.float32)
+                        for c in resume_img.INDEX_COLUMNS})
+    df.iloc[::50, 0] = np.nan
+    df.iloc[::70, 1] = 0
+    df.to_csv(path, index=False)
+    resume_img.convert_pixels_csv(path)
+    return path
+
+# ================= CASI =================
+
+def raster_cases(sizes):
+    """(nome, dimensione, elementi, unità, funzione) per i percorsi sui raster."""
+    tree_params = dict(main.TREE_MASK_DEFAULTS)
+    for size in sizes:
+        data = synthetic_raster(size)
+        tiff_tree  = geotiff_bytes(data)
+        tiff_index = geotiff_bytes(data[3:])
+        pixels = size * size
+
+        yield ("compute_tree_mask", f"{size}x{size}", pixels, "px",
+               lambda data=data: main.compute_tree_mask(data[0], data[1], data[2]))
+        yield ("extract_array_and_mean[tree]", f"{size}x{size}", pixels, "px",
+               lambda b=tiff_tree: main.extract_array_and_mean(BytesIO(b), "ndvi", True,
+                                                               tree_params))
+        yield ("extract_array_and_mean[campo]", f"{size}x{size}", pixels, "px",
+               lambda b=tiff_index: main.extract_array_and_mean(BytesIO(b), "ndvi", False,
+                                                                tree_params))
+
+
+def row_cases(sizes, workdir):
+    """(nome, dimensione, elementi, unità, funzione) per CSV, score e aggregazione."""
+    field_key = _field_key(3)
+    for rows in sizes:
+        dp = datapoints_file(workdir, rows)
+        # finestra presente per il campo 3 anche nel file più piccolo
+        start = "2018-01-01"
+        end   = "2018-01-11"
+        values = np.random.default_rng(rows).uniform(-0.3, 1.1, rows).tolist()
+        px = pixels_file(workdir, rows)
+        label = f"{rows} righe"
+
+        yield ("load_datapoints", label, rows, "righe",
+               lambda dp=dp: main.load_datapoints(dp, field_key=field_key))
+        yield ("load_period_means", label, rows, "righe",
+               lambda dp=dp: main.load_period_means(dp, start, end, True, field_key))
+        yield ("normalize_to_score", label, rows, "valori",
+               lambda values=values: [main.normalize_to_score("ndvi", v) for v in values])
+        yield ("resume_img.daily_stats[csv]", label, rows, "righe",
+               lambda px=px: resume_img.daily_stats(_csv_only(px)))
+        yield ("resume_img.daily_stats[npy]", label, rows, "righe",
+               lambda px=px: resume_img.daily_stats(px))
+        yield ("resume_img.daily_stats[npy, blocchi]", label, rows, "righe",
+               lambda px=px: resume_img.daily_stats(px, chunksize=max(1, rows // 10)))
+
+
+def _csv_only(path):
+    """Stesso CSV senza versione binaria accanto: forza la lettura con pandas."""
+    alias = path.replace("_pixels.csv", "_csvonly_pixels.csv")
+    if not os.path.exists(alias):
+        os.link(path, alias)
+    return alias
+
+# ================= MISURA =================
+
+def measure(fn, min_time=BENCH_DEFAULTS["min_time"], max_repeats=BENCH_DEFAULTS["max_repeats"]):
+    """
+    Esegue fn finché non accumula min_time secondi (almeno una volta, al
+    più max_repeats) e poi una volta sotto tracemalloc per il picco di memoria.
+    Ritorna (tempi in secondi, picco in byte).
+    """
+    times = []
+    while not times or (sum(times) < min_time and len(times) < max_repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def run_bench(preset="default", only=None, workdir=None, min_time=BENCH_DEFAULTS["min_time"],
+              max_repeats=BENCH_DEFAULTS["max_repeats"]):
+    """Esegue i casi del preset (filtrati per sottostringa del nome) e ritorna i risultati."""
+    if workdir is None:
+        workdir = os.path.join(tempfile.gettempdir(), "agro_sentinel_bench")
+    os.makedirs(workdir, exist_ok=True)
+    sizes = PRESETS[preset]
+
+    results = []
+    for cases in (raster_cases(sizes["raster"]), row_cases(sizes["rows"], workdir)):
+        for name, size, items, unit, fn in cases:
+            if only and not any(o in name for o in only):
+                continue
+            times, peak = measure(fn, min_time, max_repeats)
+            median = statistics.median(times)
+            results.append({
+                "case":       name,
+                "size":       size,
+                "items":      items,
+                "unit":       unit,
+                "repeats":    len(times),
+                "median_s":   median,
+                "min_s":      min(times),
+                "throughput": items / median if median > 0 else None,
+                "peak_mb":    peak / 2**20,
+            })
+            print(f"  {name:<36} {size:>14}  {_fmt_time(median):>9}  "
+                  f"{_fmt_rate(results[-1]['throughput'], unit):>16}  {peak / 2**20:8.1f} MB")
+
+    return {
+        "meta": {
+            "date":     datetime.now().isoformat(timespec="seconds"),
+            "preset":   preset,
+            "python":   platform.python_version(),
+            "numpy":    np.__version__,
+            "platform": platform.platform(),
+            "cpus":     os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def _fmt_time(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.0f} µs"
+    if seconds < 1:
+        return f"{seconds * 1e3:.1f} ms"
+    return f"{seconds:.2f} s"
+
+
+def _fmt_rate(rate, unit):
+    if rate is None:
+        return "-"
+    for scale, prefix in ((1e9, "G"), (1e6, "M"), (1e3, "k")):
+        if rate >= scale:
+            return f"{rate / scale:.1f} {prefix}{unit}/s"
+    return f"{rate:.0f} {unit}/s"
+
+# ================= CONFRONTO CON LA BASELINE =================
+
+def compare_results(current, baseline, time_threshold=BENCH_DEFAULTS["time_threshold"],
+                    mem_threshold=BENCH_DEFAULTS["mem_threshold"]):
+    """
+    Confronta i casi presenti in entrambi i risultati (stesso nome e dimensione).
+    Per il tempo usa il minimo delle ripetizioni, meno sensibile al carico
+    della macchina della mediana.
+    Ritorna [(caso, dimensione, delta tempo, delta memoria, regressione), ...]
+    con i delta come frazione della baseline.
+    """
+    base = {(r["case"], r["size"]): r for r in baseline["results"]}
+    rows = []
+    for r in current["results"]:
+        b = base.get((r["case"], r["size"]))
+        if b is None:
+            continue
+        dt = r["min_s"] / b["min_s"] - 1 if b["min_s"] > 0 else 0.0
+        dm = r["peak_mb"] / b["peak_mb"] - 1 if b["peak_mb"] > 0 else 0.0
+        rows.append((r["case"], r["size"], dt, dm, dt > time_threshold or dm > mem_threshold))
+    return rows
+
+
+def print_comparison(rows, baseline_meta):
+    print(f"\n→ Confronto con la baseline del {baseline_meta.get('date', '?')} "
+          f"(preset {baseline_meta.get('preset', '?')})")
+    for case, size, dt, dm, regression in rows:
+        flag = "  REGRESSIONE" if regression else ""
+        print(f"  {case:<36} {size:>14}  tempo {dt:+7.1%}  memoria {dm:+7.1%}{flag}")
+    n = sum(1 for r in rows if r[4])
+    print(f"  {n} regressioni su {len(rows)} casi confrontati")
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark di maschera chiome, decodifica, CSV, score e aggregazione."
+    )
+    parser.add_argument("-preset", choices=sorted(PRESETS), default="default",
+                        help="Dimensioni: quick (fino a 256² e 10k righe), default (2500² e 1M), "
+                             "full (fino a 10M righe)")
+    parser.add_argument("-only", nargs="+", default=None, metavar="CASO",
+                        help="Solo i casi il cui nome contiene una di queste stringhe")
+    parser.add_argument("-output", default="bench_results.json",
+                        help="File JSON dei risultati")
+    parser.add_argument("-baseline", default=None, metavar="FILE",
+                        help="Confronta con una baseline ed esce con codice 1 se ci sono regressioni")
+    parser.add_argument("-save-baseline", action="store_true",
+                        help="Con -baseline: salva questi risultati come nuova baseline")
+    parser.add_argument("-time-threshold", type=float, default=BENCH_DEFAULTS["time_threshold"],
+                        help="Aumento relativo del tempo minimo considerato regressione")
+    parser.add_argument("-mem-threshold", type=float, default=BENCH_DEFAULTS["mem_threshold"],
+                        help="Aumento relativo del picco di memoria considerato regressione")
+    parser.add_argument("-min-time", type=float, default=BENCH_DEFAULTS["min_time"],
+                        help="Secondi minimi di misura per caso")
+    parser.add_argument("-workdir", default=None,
+                        help="Cartella dei file sintetici (riusati tra le esecuzioni)")
+    args = parser.parse_args()
+
+    print(f"→ Benchmark preset {args.preset}")
+    results = run_bench(args.preset, args.only, args.workdir, args.min_time)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"→ Risultati salvati in: {args.output}")
+
+    regressions = 0
+    if args.baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            rows = compare_results(results, baseline, args.time_threshold, args.mem_threshold)
+            regressions = print_comparison(rows, baseline["meta"])
+        else:
+            print(f"→ Baseline {args.baseline} assente")
+        if args.save_baseline:
+            with open(args.baseline, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"→ Baseline aggiornata: {args.baseline}")
+            regressions = 0
+
+    raise SystemExit(1 if regressions else 0)
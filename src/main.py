@@ -1,16 +1,6 @@
-import geopandas as gpd
-from oauthlib.oauth2 import BackendApplicationClient
-from requests_oauthlib import OAuth2Session
-import requests
-import rasterio
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-from matplotlib.colors import LinearSegmentedColormap
-from matplotlib.patches import Patch
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from pyproj import Transformer
 from io import BytesIO
 import time
 import argparse
@@ -18,33 +8,375 @@ import configparser
 import csv
 import os
 import json
+import hashlib
+import re
+import heapq
+from bisect import bisect_left
+import threading
+import functools
+import weakref
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+# geopandas, rasterio, matplotlib, requests e oauthlib sono importati
+# nelle funzioni che li usano: le esecuzioni servite dal CSV o --chart-only
+# non pagano il loro tempo di import.
+
+# ================= PROFILAZIONE =================
+
+# Span temporali delle fasi di un'esecuzione (--profile). Ogni processo,
+# compresi i worker degli indici e del rendering, scrive i propri span in un
+# file JSONL; a fine esecuzione vengono uniti in una traccia Chrome
+# (chrome://tracing, Perfetto). Con la profilazione spenta span() ritorna
+# un context manager vuoto già pronto.
+_profile = {"dir": None, "path": None, "t0": 0.0, "file": None, "pid": None}
+_NO_SPAN = nullcontext()
+
+
+def enable_profile(path):
+    """Attiva la profilazione: la traccia verrà scritta in path (write_profile)."""
+    spans_dir = path + ".spans"
+    os.makedirs(spans_dir, exist_ok=True)
+    for name in os.listdir(spans_dir):
+        os.remove(os.path.join(spans_dir, name))
+    _profile.update(dir=spans_dir, path=path, t0=time.perf_counter(), file=None, pid=None)
+
+
+def span(name, **args):
+    """Misura il blocco with come fase name (argomenti opzionali nella traccia)."""
+    if _profile["dir"] is None:
+        return _NO_SPAN
+    return _span(name, args)
+
+
+@contextmanager
+def _span(name, args):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_span(name, t0, time.perf_counter() - t0, args)
+
+
+def traced(name):
+    """Decoratore: l'intera funzione come fase name."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            if _profile["dir"] is None:
+                return fn(*a, **kw)
+            with _span(name, {}):
+                return fn(*a, **kw)
+        return wrapper
+    return decorate
+
+
+def _record_span(name, t0, duration, args):
+    # un file per processo, a righe: i worker terminano senza svuotare i buffer
+    if _profile["pid"] != os.getpid():
+        _profile["file"] = open(os.path.join(_profile["dir"], f"{os.getpid()}.jsonl"),
+                                "a", buffering=1, encoding="utf-8")
+        _profile["pid"] = os.getpid()
+    _profile["file"].write(json.dumps({
+        "name": name, "ts": (t0 - _profile["t0"]) * 1e6, "dur": duration * 1e6,
+        "tid": threading.get_ident(), "args": args,
+    }, default=str) + "\n")
+
+
+def write_profile():
+    """
+    Unisce gli span di tutti i processi nella traccia Chrome, stampa il
+    riepilogo per fase (totale, p50, p95) e disattiva la profilazione.
+    """
+    if _profile["dir"] is None:
+        return
+    if _profile["file"] is not None:
+        _profile["file"].close()
+    main_pid = os.getpid()
+    events   = []
+    for name in sorted(os.listdir(_profile["dir"])):
+        pid = int(name.split(".")[0])
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                       "args": {"name": "main" if pid == main_pid else f"worker {pid}"}})
+        with open(os.path.join(_profile["dir"], name), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    ev = json.loads(line)
+                except json.JSONDecodeError:
+                    continue   # riga troncata da un worker interrotto
+                events.append(dict(ev, ph="X", pid=pid, cat=ev["name"].split(".")[0]))
+        os.remove(os.path.join(_profile["dir"], name))
+    os.rmdir(_profile["dir"])
+
+    with open(_profile["path"], "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    print(f"\n→ Traccia salvata in: {_profile['path']} (chrome://tracing o ui.perfetto.dev)")
+    print_profile_summary([ev for ev in events if ev["ph"] == "X"])
+    _profile.update(dir=None, path=None, file=None, pid=None)
+
+
+def print_profile_summary(events):
+    """Tabella per fase: chiamate, tempo totale, p50 e p95 (tempi inclusivi delle sottofasi)."""
+    durations = {}
+    for ev in events:
+        durations.setdefault(ev["name"], []).append(ev["dur"] / 1e6)
+    if not durations:
+        return
+    print(f"  {'fase':<22} {'chiamate':>8} {'totale':>10} {'p50':>10} {'p95':>10}")
+    for name, ds in sorted(durations.items(), key=lambda kv: -sum(kv[1])):
+        p50, p95 = np.percentile(ds, [50, 95])
+        print(f"  {name:<22} {len(ds):>8} {sum(ds):>9.3f}s {p50:>9.3f}s {p95:>9.3f}s")
 
 # ================= AUTH =================
 
-def authenticate(client_id, client_secret):
+SH_ENDPOINTS = {
+    "token":   "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token",
+    "process": "https://sh.dataspace.copernicus.eu/api/v1/process",
+    "catalog": "https://sh.dataspace.copernicus.eu/api/v1/catalog/1.0.0/search",
+}
+
+
+def set_base_url(base_url):
+    """
+    Indirizza token, Process e catalogo verso un altro server con gli stessi
+    percorsi (es. mock_sentinel.py). Per un server http:// oauthlib va
+    autorizzato esplicitamente al trasporto non cifrato.
+    """
+    from urllib.parse import urlsplit
+
+    base = base_url.rstrip("/")
+    for name, url in SH_ENDPOINTS.items():
+        SH_ENDPOINTS[name] = base + urlsplit(url).path
+    if base.startswith("http://"):
+        os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+
+
+@traced("auth")
+def fetch_token(client_id, client_secret):
+    """Token OAuth completo (access_token, expires_in, ...)."""
+    from oauthlib.oauth2 import BackendApplicationClient
+    from requests_oauthlib import OAuth2Session
+
     client = BackendApplicationClient(client_id=client_id)
     oauth = OAuth2Session(client=client)
-    token = oauth.fetch_token(
-        token_url='https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token',
+    return oauth.fetch_token(
+        token_url=SH_ENDPOINTS["token"],
         client_secret=client_secret,
-        include_client_id=True
+        include_client_id=True,
+        timeout=HTTP_TIMEOUT,
     )
-    return token["access_token"]
+
+
+def authenticate(client_id, client_secret):
+    return fetch_token(client_id, client_secret)["access_token"]
+
+
+TOKEN_MARGIN = 60   # secondi di anticipo sul rinnovo del token
+
+
+def token_provider(client_id, client_secret):
+    """
+    Funzione che ritorna un token valido, rinnovato prima della scadenza:
+    un backfill di più anni o il daemon durano più della sua validità.
+    """
+    auth = {"token": None, "expires": 0.0}
+
+    def get_token():
+        if auth["token"] is None or time.time() >= auth["expires"] - TOKEN_MARGIN:
+            print("→ Autenticazione Copernicus...")
+            tok = fetch_token(client_id, client_secret)
+            auth["token"]   = tok["access_token"]
+            auth["expires"] = time.time() + float(tok.get("expires_in", 600))
+        return auth["token"]
+
+    return get_token
+
 
 # ================= AREA =================
 
+def _local_tag(elem):
+    return elem.tag.rsplit("}", 1)[-1]
+
+
+def _parse_kml_coordinates(text):
+    coords = []
+    for tup in (text or "").split():
+        parts = tup.split(",")
+        coords.append((float(parts[0]), float(parts[1])))
+    return coords
+
+
+def read_kml_placemarks(path):
+    """
+    Legge i poligoni di un file KML o KMZ con parsing XML in streaming,
+    senza geopandas. Supporta Polygon con anelli interni e MultiGeometry.
+    Ritorna lista di (nome, [poligono, ...]) per ogni Placemark con almeno un
+    poligono, dove poligono = [anello esterno, anelli interni...].
+    """
+    import zipfile
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            names = [n for n in zf.namelist() if n.lower().endswith(".kml")]
+            if not names:
+                raise ValueError(f"{path}: l'archivio KMZ non contiene alcun file .kml")
+            names.sort(key=lambda n: (n.lower() != "doc.kml", n))
+            with zf.open(names[0]) as source:
+                return _parse_kml_stream(source)
+
+    with open(path, "rb") as source:
+        return _parse_kml_stream(source)
+
+
+def _parse_kml_stream(source):
+    import xml.etree.ElementTree as ET
+
+    placemarks = []
+    name, polygons, rings, ring_kind = None, [], [], None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        tag = _local_tag(elem)
+        if event == "start":
+            if tag == "Placemark":
+                name, polygons = None, []
+            elif tag == "Polygon":
+                rings = []
+            elif tag in ("outerBoundaryIs", "innerBoundaryIs"):
+                ring_kind = tag
+            continue
+
+        if tag == "name" and name is None:
+            name = (elem.text or "").strip()
+        elif tag == "coordinates" and ring_kind is not None:
+            ring = _parse_kml_coordinates(elem.text)
+            if ring_kind == "outerBoundaryIs":
+                rings.insert(0, ring)
+            else:
+                rings.append(ring)
+        elif tag in ("outerBoundaryIs", "innerBoundaryIs"):
+            ring_kind = None
+        elif tag == "Polygon":
+            if rings:
+                polygons.append(rings)
+        elif tag == "Placemark":
+            if polygons:
+                placemarks.append((name, polygons))
+            elem.clear()  # memoria costante anche con molti Placemark
+
+    return placemarks
+
+
+def _read_polygons_geopandas(path):
+    """Fallback per formati diversi da KML/KMZ (shapefile, GeoPackage, GeoJSON...)."""
+    import geopandas as gpd
+
+    gdf = gpd.read_file(path)
+    geom = gdf.geometry[0]
+    parts = list(geom.geoms) if geom.geom_type == "MultiPolygon" else [geom]
+    return [
+        [[tuple(c[:2]) for c in p.exterior.coords]]
+        + [[tuple(c[:2]) for c in r.coords] for r in p.interiors]
+        for p in parts
+    ]
+
+
+def read_area_polygons(path, placemark=0):
+    """Poligoni (con anelli interni) del Placemark indicato dell'area di interesse."""
+    if os.path.splitext(path)[1].lower() in (".kml", ".kmz"):
+        placemarks = read_kml_placemarks(path)
+        if placemarks:
+            return placemarks[placemark][1]
+    return _read_polygons_geopandas(path)
+
+
+@traced("area.kml")
+def get_geometry(path, placemark=0):
+    """Geometria GeoJSON (Polygon o MultiPolygon) dell'area di interesse."""
+    polygons = read_area_polygons(path, placemark)
+    if len(polygons) == 1:
+        return {"type": "Polygon", "coordinates": polygons[0]}
+    return {"type": "MultiPolygon", "coordinates": polygons}
+
+
 def get_polygon(path):
-    gdf = gpd.read_file(path, driver="KML")
-    return list(gdf.geometry[0].exterior.coords)
+    """Anello esterno del primo poligono dell'area di interesse."""
+    return read_area_polygons(path)[0][0]
+
+
+def _as_geometry(polygon):
+    """Accetta un anello di coordinate o una geometria GeoJSON."""
+    if isinstance(polygon, dict):
+        return polygon
+    return {"type": "Polygon", "coordinates": [polygon]}
+
+
+def _exterior_coords(polygon):
+    geom = _as_geometry(polygon)
+    polys = [geom["coordinates"]] if geom["type"] == "Polygon" else geom["coordinates"]
+    return [c for p in polys for c in p[0]]
 
 # ================= SIZE =================
 
-def get_bbox_size(coords):
-    lon = [c[0] for c in coords]
-    lat = [c[1] for c in coords]
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
-    xs, ys = transformer.transform(lon, lat)
-    return max(xs) - min(xs), max(ys) - min(ys)
+WEB_MERCATOR_RADIUS = 6378137.0
+
+def get_bbox_size(polygon):
+    # EPSG:4326 → EPSG:3857 (Web Mercator sferico) in forma chiusa,
+    # identica a pyproj ma senza caricare PROJ all'avvio
+    coords = _exterior_coords(polygon)
+    lon = np.radians([c[0] for c in coords])
+    lat = np.radians([c[1] for c in coords])
+    xs = WEB_MERCATOR_RADIUS * lon
+    ys = WEB_MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + lat / 2))
+    return float(xs.max() - xs.min()), float(ys.max() - ys.min())
+
+
+def output_size(width, height, resolution=10):
+    """Dimensione in pixel del raster richiesto (10 m/pixel, limiti 64-2500)."""
+    width_px  = max(64, min(2500, int(width  / resolution)))
+    height_px = max(64, min(2500, int(height / resolution)))
+    return width_px, height_px
+
+# ================= CHIAVE CAMPO =================
+
+def _normalized_ring(coords):
+    ring = [(round(float(c[0]), 7), round(float(c[1]), 7)) for c in coords]
+    if len(ring) > 1 and ring[0] == ring[-1]:
+        ring = ring[:-1]
+
+    area2 = sum(x0 * y1 - x1 * y0
+                for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]))
+    if area2 < 0:
+        ring = ring[::-1]
+
+    i0   = ring.index(min(ring))
+    ring = ring[i0:] + ring[:i0]
+    return ";".join(f"{x:.7f},{y:.7f}" for x, y in ring)
+
+
+def geometry_fingerprint(polygon):
+    """
+    Impronta stabile di un poligono: coordinate arrotondate a 1e-7 gradi,
+    senza vertice di chiusura, orientate in senso antiorario e ruotate in
+    modo da partire dal vertice minimo. Lo stesso campo dà sempre la stessa
+    impronta indipendentemente dal punto di partenza e dal verso del KML.
+    Accetta un anello oppure una geometria GeoJSON Polygon/MultiPolygon.
+    """
+    geom  = _as_geometry(polygon)
+    polys = [geom["coordinates"]] if geom["type"] == "Polygon" else geom["coordinates"]
+    text  = "||".join(
+        "|".join([_normalized_ring(p[0])] + sorted(_normalized_ring(r) for r in p[1:]))
+        for p in polys
+    )
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def make_field_key(polygon, width, height, step_days):
+    """Chiave con cui le rilevazioni di un campo vengono salvate e cercate nel CSV."""
+    width_px, height_px = output_size(width, height)
+    return {
+        "field":     geometry_fingerprint(polygon),
+        "size":      f"{width_px}x{height_px}",
+        "step_days": str(step_days),
+    }
 
 # ================= TREE MASK (DOI: 10.1016/j.compag.2020.105500) =================
 
@@ -90,54 +422,186 @@ def compute_tree_mask(b03, b04, b08,
 
 # ================= CSV: SINGOLE RILEVAZIONI =================
 
-CSV_FIELDNAMES = ["timestamp", "start", "end", "tree_focused", "index", "value"]
+CSV_FIELDNAMES = ["timestamp", "field", "size", "step_days",
+                  "start", "end", "tree_focused", "index", "value"]
+
+FIELD_KEY_COLUMNS = ("field", "size", "step_days")
+
+
+def _datapoint_key(row):
+    return (tuple(row.get(k) or "" for k in FIELD_KEY_COLUMNS)
+            + (row["start"], row["end"], str(row["tree_focused"]).lower(), row["index"]))
+
+
+def _matches_key(row, field_key):
+    """Vero se la riga appartiene al campo field_key (None = qualsiasi campo)."""
+    if field_key is None:
+        return True
+    return all((row.get(k) or "") == field_key[k] for k in FIELD_KEY_COLUMNS)
+
+
+def _latest_rows(rows):
+    """
+    Tiene solo la rilevazione più recente per chiave (_datapoint_key): campo,
+    dimensione e passo (field, size, step_days), poi start, end, tree_focused
+    e index. La stessa finestra salvata con due passi resta su due righe.
+    """
+    latest = {}
+    for row in rows:
+        key  = _datapoint_key(row)
+        prev = latest.get(key)
+        if prev is None or row["timestamp"] >= prev["timestamp"]:
+            latest[key] = row
+    return list(latest.values())
+
+
+def _read_rows(filepath):
+    with open(filepath, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def _rewrite_datapoints(filepath, rows):
+    """Riscrive il CSV in modo atomico: file temporaneo + os.replace."""
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+
 
-def save_datapoint(filepath, start, end, tree_focused, index_name, value):
-    """Salva una singola rilevazione (un indice, una finestra temporale) nel CSV."""
+def _migrate_header(filepath):
+    """
+    Porta un CSV con intestazione di una versione precedente al formato
+    corrente. Le righe senza chiave campo restano con field/size/step_days
+    vuoti e non vengono restituite alle ricerche per campo.
+    """
+    with open(filepath, newline="") as f:
+        header = next(csv.reader(f), None)
+    if header is not None and header != CSV_FIELDNAMES:
+        _rewrite_datapoints(filepath, _read_rows(filepath))
+
+
+@traced("csv.scrittura")
+def compact_datapoints(filepath):
+    """
+    Rimuove le rilevazioni duplicate mantenendo la più recente per chiave.
+    Ritorna (righe rimosse, byte recuperati).
+    """
+    if not os.path.exists(filepath):
+        return 0, 0
+    _migrate_header(filepath)
+
+    size_before = os.path.getsize(filepath)
+    rows = _read_rows(filepath)
+    kept = _latest_rows(rows)
+    if len(kept) == len(rows):
+        return 0, 0
+
+    _rewrite_datapoints(filepath, kept)
+    return len(rows) - len(kept), size_before - os.path.getsize(filepath)
+
+
+@traced("csv.scrittura")
+def save_datapoint(filepath, start, end, tree_focused, index_name, value, field_key=None):
+    """
+    Accoda una singola rilevazione (un indice, una finestra temporale) al CSV.
+    field_key (da make_field_key) identifica campo, dimensione e passo. Le
+    rilevazioni precedenti con la stessa chiave vengono rimosse da
+    compact_datapoints.
+    """
     file_exists = os.path.exists(filepath)
+    if file_exists:
+        _migrate_header(filepath)
+
+    row = {
+        "timestamp":    datetime.now().isoformat(timespec="seconds"),
+        "field":        field_key["field"] if field_key else "",
+        "size":         field_key["size"] if field_key else "",
+        "step_days":    field_key["step_days"] if field_key else "",
+        "start":        start,
+        "end":          end,
+        "tree_focused": tree_focused,
+        "index":        index_name,
+        "value":        value,
+    }
+
     with open(filepath, "a", newline="") as f:
         writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES)
         if not file_exists:
             writer.writeheader()
-        writer.writerow({
-            "timestamp":    datetime.now().isoformat(timespec="seconds"),
-            "start":        start,
-            "end":          end,
-            "tree_focused": tree_focused,
-            "index":        index_name,
-            "value":        value,
-        })
+        writer.writerow(row)
+
+
+# Lock condiviso tra processi per le scritture su CSV e journal, impostato
+# nei worker degli indici (start_index_workers)
+_shared = {"write_lock": None}
+
+
+def _write_guard():
+    lock = _shared["write_lock"]
+    return lock if lock is not None else nullcontext()
+
+
+def _save_and_count(dedup_stats, filepath, start, end, tree_focused, index_name, value,
+                    field_key=None):
+    """
+    Accoda la rilevazione al CSV. Con la deduplica attiva (dedup_stats non
+    None) il file viene annotato e le righe sostituite vengono rimosse una
+    sola volta da finish_dedup: riscriverlo a ogni riga costerebbe O(N²).
+    """
+    with _write_guard():
+        save_datapoint(filepath, start, end, tree_focused, index_name, value,
+                       field_key=field_key)
+    if dedup_stats is not None:
+        dedup_stats.setdefault("files", set()).add(filepath)
+
+
+def finish_dedup(dedup_stats):
+    """Compatta i CSV annotati da _save_and_count e accumula righe e byte recuperati."""
+    if dedup_stats is None:
+        return
+    for filepath in sorted(dedup_stats.pop("files", ())):
+        with _write_guard():
+            removed, reclaimed = compact_datapoints(filepath)
+        dedup_stats["rows"]  += removed
+        dedup_stats["bytes"] += reclaimed
 
 
-def load_datapoints(filepath, tree_focused=None):
+@traced("csv.lettura")
+def load_datapoints(filepath, tree_focused=None, field_key=None):
     """
-    Carica tutte le rilevazioni dal CSV.
+    Carica tutte le rilevazioni dal CSV, una sola (la più recente) per chiave.
     Ritorna dict: { index_name: [ {"start": ..., "end": ..., "value": float}, ... ] }
-    Se tree_focused non è None filtra per quel valore.
+    Se tree_focused non è None filtra per quel valore, se field_key non è
+    None solo le rilevazioni di quel campo.
     """
     if not os.path.exists(filepath):
         return {}
 
     result = {}
-    with open(filepath, newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if tree_focused is not None:
-                if str(row["tree_focused"]).lower() != str(tree_focused).lower():
-                    continue
-            idx = row["index"]
-            val = row["value"]
-            if val == "" or val is None:
+    for row in _latest_rows(_read_rows(filepath)):
+        if not _matches_key(row, field_key):
+            continue
+        if tree_focused is not None:
+            if str(row["tree_focused"]).lower() != str(tree_focused).lower():
                 continue
-            result.setdefault(idx, []).append({
-                "start": row["start"],
-                "end":   row["end"],
-                "value": float(val),
-            })
+        idx = row["index"]
+        val = row["value"]
+        if val == "" or val is None:
+            continue
+        result.setdefault(idx, []).append({
+            "start": row["start"],
+            "end":   row["end"],
+            "value": float(val),
+        })
     return result
 
 
-def load_period_means(filepath, start, end, tree_focused):
+@traced("csv.lettura")
+def load_period_means(filepath, start, end, tree_focused, field_key=None):
     """
     Carica le medie per un periodo specifico (start/end esatti).
     Usato per evitare di riscaricaire dati già presenti.
@@ -152,6 +616,7 @@ def load_period_means(filepath, start, end, tree_focused):
         for row in reader:
             if (row["start"] == start and
                     row["end"] == end and
+                    _matches_key(row, field_key) and
                     str(row["tree_focused"]).lower() == str(tree_focused).lower()):
                 val = row["value"]
                 if val != "":
@@ -160,15 +625,432 @@ def load_period_means(filepath, start, end, tree_focused):
     return found if found else None
 
 
+# ================= JOURNAL DEI BACKFILL =================
+
+# Stati conclusivi di un task: non viene più richiesto alla ripresa.
+# "planned" e "failed" restano da eseguire.
+JOURNAL_DONE = ("done", "empty")
+
+
+def journal_path(data_file):
+    return data_file + ".journal.jsonl"
+
+
+def trend_windows(start, end, step_days):
+    """Finestre (inizio, fine) del trend: una ogni step_days giorni."""
+    start_dt = datetime.fromisoformat(start)
+    end_dt   = datetime.fromisoformat(end)
+    windows  = []
+    current  = start_dt
+    while current <= end_dt:
+        windows.append((current, min(current + relativedelta(days=step_days), end_dt)))
+        current += relativedelta(days=step_days)
+    return windows
+
+
+def backfill_job_id(field_key, start, end, step_days, tree_focused):
+    """Identificativo del backfill: stesso campo e stessi parametri → stesso job."""
+    raw = json.dumps([field_key, start, end, int(step_days), bool(tree_focused)],
+                     sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()[:12]
+
+
+def _task_id(index, kind, start, end):
+    return f"{index}/{kind}/{start}/{end}"
+
+
+def load_journal(path, job):
+    """
+    Ultimo stato di ogni task del job. Il journal è un file JSON-lines in sola
+    aggiunta: una riga troncata da un'interruzione durante la scrittura viene
+    ignorata.
+    """
+    tasks = {}
+    if not os.path.exists(path):
+        return tasks
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if rec.get("job") == job:
+                tasks[rec["task"]] = rec
+    return tasks
+
+
+def _journal_append(journal, records):
+    with _write_guard(), open(journal["path"], "a", encoding="utf-8") as fh:
+        for rec in records:
+            fh.write(json.dumps(rec) + "\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+    for rec in records:
+        journal["tasks"][rec["task"]] = rec
+
+
+def open_backfill(path, job, plan):
+    """
+    Apre o riprende un job. plan è la lista ordinata dei task come tuple
+    (index, kind, start, end), con kind "window" (una finestra del trend) o
+    "map" (mappa del periodo intero); quelli non ancora nel journal vengono
+    registrati come "planned".
+    """
+    journal = {"path": path, "job": job, "tasks": load_journal(path, job),
+               "order": [], "t0": time.time(), "done_run": 0}
+    now = datetime.now().isoformat(timespec="seconds")
+    new = []
+    for index, kind, start, end in plan:
+        tid = _task_id(index, kind, start, end)
+        journal["order"].append(tid)
+        if tid not in journal["tasks"]:
+            new.append({"job": job, "task": tid, "index": index, "kind": kind,
+                        "start": start, "end": end, "state": "planned",
+                        "value": None, "t": now})
+    if new:
+        _journal_append(journal, new)
+    journal["done_start"] = len(journal["order"]) - len(journal_pending(journal))
+    return journal
+
+
+def journal_get(journal, index, kind, start, end):
+    """Record del task se già concluso, altrimenti None (anche senza journal)."""
+    if journal is None:
+        return None
+    rec = journal["tasks"].get(_task_id(index, kind, start, end))
+    return rec if rec is not None and rec["state"] in JOURNAL_DONE else None
+
+
+def journal_set(journal, index, kind, start, end, state, value=None):
+    if journal is None:
+        return
+    _journal_append(journal, [{
+        "job": journal["job"], "task": _task_id(index, kind, start, end),
+        "index": index, "kind": kind, "start": start, "end": end,
+        "state": state, "value": value,
+        "t": datetime.now().isoformat(timespec="seconds"),
+    }])
+    if state in JOURNAL_DONE:
+        journal["done_run"] += 1
+
+
+def journal_pending(journal, index=None):
+    """Task non conclusi, nell'ordine del piano (di un solo indice se index non è None)."""
+    pending = []
+    for tid in journal["order"]:
+        rec = journal["tasks"][tid]
+        if rec["state"] not in JOURNAL_DONE and (index is None or rec["index"] == index):
+            pending.append(rec)
+    return pending
+
+
+def journal_map_path(journal, index):
+    return f"{journal['path']}.{journal['job']}.{index}.npz"
+
+
+def save_journal_map(journal, index, map_array, mask_array, georef):
+    """
+    Salva accanto al journal il raster della mappa del periodo: una ripresa
+    che salta la richiesta ridisegna comunque la figura con la mappa.
+    """
+    if journal is None or map_array is None:
+        return
+    arrays = {"map": map_array}
+    if mask_array is not None:
+        arrays["mask"] = mask_array
+    if georef is not None:
+        arrays["transform"] = np.array(georef[0], dtype=np.float64)
+        arrays["crs"]       = np.array(georef[1])
+    path = journal_map_path(journal, index)
+    tmp  = path[:-len(".npz")] + ".tmp.npz"
+    np.savez_compressed(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def load_journal_map(journal, index):
+    """(map_array, mask_array, georef) salvati da save_journal_map, oppure None."""
+    if journal is None or not os.path.exists(journal_map_path(journal, index)):
+        return None
+    with np.load(journal_map_path(journal, index)) as z:
+        georef = ((tuple(z["transform"].tolist()), str(z["crs"]))
+                  if "transform" in z.files else None)
+        return z["map"], (z["mask"] if "mask" in z.files else None), georef
+
+
+def close_backfill(journal):
+    """
+    Chiude un job concluso (nessun task del piano da eseguire) dopo il
+    rendering delle figure: elimina i raster delle mappe salvati accanto al
+    journal e ne compatta le righe all'ultimo stato dei task senza dati e
+    delle mappe, gli unici che una nuova esecuzione non deve ripetere (le
+    finestre scaricate sono nel CSV). Ritorna True se il job era concluso.
+    """
+    path, job = journal["path"], journal["job"]
+    tasks = load_journal(path, job)
+    if any(tid not in tasks or tasks[tid]["state"] not in JOURNAL_DONE
+           for tid in journal["order"]):
+        return False
+    for index in {rec["index"] for rec in tasks.values()}:
+        if os.path.exists(journal_map_path(journal, index)):
+            os.remove(journal_map_path(journal, index))
+
+    keep = [rec for rec in tasks.values() if rec["state"] == "empty" or rec["kind"] == "map"]
+    with _write_guard():
+        with open(path, encoding="utf-8") as fh:
+            others = []
+            for line in fh:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec.get("job") != job:
+                    others.append(line)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            fh.writelines(others)
+            for rec in keep:
+                fh.write(json.dumps(rec) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+    return True
+
+
+def journal_subset(journal, index):
+    """Journal limitato ai task di un indice: avanzamento ed ETA di un worker."""
+    sub = dict(journal, tasks=dict(journal["tasks"]), t0=time.time(), done_run=0,
+               order=[t for t in journal["order"] if journal["tasks"][t]["index"] == index])
+    sub["done_start"] = len(sub["order"]) - len(journal_pending(sub))
+    return sub
+
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def journal_progress(journal):
+    """Avanzamento del job con throughput ed ETA della sessione corrente."""
+    if journal is None:
+        return ""
+    total = len(journal["order"])
+    done  = journal["done_start"] + journal["done_run"]
+    elapsed = time.time() - journal["t0"]
+    if journal["done_run"] == 0 or elapsed <= 0:
+        return f"[{done}/{total}]"
+    rate = journal["done_run"] / elapsed
+    return (f"[{done}/{total} · {rate * 60:.1f} task/min · "
+            f"ETA {_format_duration((total - done) / rate)}]")
+
+
+# ================= PIANIFICAZIONE DEL BACKFILL =================
+
+S2_REVISIT_DAYS = 5   # Sentinel-2A + 2B: un'acquisizione ogni 5 giorni
+
+
+def _script_bands(script):
+    """(bande di input escluso dataMask, sampleType dell'output) di un evalscript."""
+    inputs = re.search(r"input:\s*\[([^\]]*)\]", script).group(1)
+    bands  = [b for b in re.findall(r'"(\w+)"', inputs) if b != "dataMask"]
+    sample = re.search(r'sampleType:\s*"(\w+)"', script)
+    return len(bands), sample.group(1) if sample else "AUTO"
+
+
+def processing_units(width_px, height_px, n_bands, sample_type, days):
+    """
+    Processing unit stimate per una richiesta: area rispetto a 512×512 px
+    (minimo 0.01), bande di input / 3, ×2 per output FLOAT32, × acquisizioni
+    nel periodo (mosaicking ORBIT); minimo 0.005 per richiesta.
+    """
+    area    = max(0.01, width_px * height_px / (512 * 512))
+    samples = max(1, -(-max(days, 1) // S2_REVISIT_DAYS))
+    return max(0.005, area * n_bands / 3 * (2 if sample_type == "FLOAT32" else 1) * samples)
+
+
+def estimate_pu(mode, width_px, height_px, days, tree_focused=False):
+    if tree_focused and mode in EVALSCRIPTS_TREE:
+        script = EVALSCRIPTS_TREE[mode]
+    else:
+        script = EVALSCRIPTS[mode]
+    n_bands, sample_type = _script_bands(script)
+    return processing_units(width_px, height_px, n_bands, sample_type, days)
+
+
+def plan_backfill(modes, start, end, step_days, size_px, tree_focused=False,
+                  stored=None, journal_tasks=None, report_only=False, usable=None):
+    """
+    Richieste davvero necessarie per un'esecuzione. Per ogni indice: le
+    finestre del trend senza rilevazione nel CSV (stored, da load_datapoints)
+    né concluse nel journal (journal_tasks, da load_journal), e la mappa del
+    periodo, richiesta solo se l'indice ha lacune o un job interrotto da
+    riprendere. Con report_only basta la media del periodo, se manca sia
+    quella sia il trend completo. usable (da windows_with_scenes), se non
+    None, esclude le finestre senza acquisizioni utili nel catalogo.
+    """
+    stored        = stored or {}
+    journal_tasks = journal_tasks or {}
+    width_px, height_px = size_px
+    windows = [(s.strftime("%Y-%m-%d"), e.strftime("%Y-%m-%d"))
+               for s, e in trend_windows(start, end, step_days)]
+    period_days = (datetime.fromisoformat(end[:10]) - datetime.fromisoformat(start[:10])).days
+
+    def concluded(index, kind, s, e):
+        rec = journal_tasks.get(_task_id(index, kind, s, e))
+        return rec is not None and rec["state"] in JOURNAL_DONE
+
+    plan = {"indices": {}, "windows": len(windows), "report_only": report_only,
+            "requests": 0, "pixels": 0, "pu": 0.0}
+    for m in modes:
+        if m == "rgb":
+            entry = {"windows": [], "cached": 0, "resumed": 0, "no_scenes": 0,
+                     "touched": False, "map": True}
+        else:
+            have    = {(p["start"], p["end"]) for p in stored.get(m, [])}
+            done    = [w for w in windows if concluded(m, "window", *w)]
+            cached  = sum(1 for w in windows if w in have)
+            missing = [w for w in windows if w not in have and w not in done]
+            resumed = len(windows) - cached - len(missing)
+            touched = bool(done)   # job già avviato su questo indice
+            no_scenes = 0
+            if usable is not None:
+                no_scenes = sum(1 for w in missing if w not in usable)
+                missing   = [w for w in missing if w in usable]
+            if report_only:
+                need_map = bool(missing) and (start, end) not in have
+                missing  = []
+            else:
+                need_map = not concluded(m, "map", start, end) and (bool(missing) or touched)
+            if usable is not None and not usable:
+                need_map = False   # nessuna acquisizione utile nell'intero periodo
+            entry = {"windows": missing, "cached": cached, "resumed": resumed,
+                     "no_scenes": no_scenes, "touched": touched, "map": need_map}
+        plan["indices"][m] = entry
+
+        days = [(datetime.fromisoformat(e) - datetime.fromisoformat(s)).days
+                for s, e in entry["windows"]]
+        if entry["map"]:
+            days.append(period_days)
+        plan["requests"] += len(days)
+        plan["pixels"]   += len(days) * width_px * height_px
+        plan["pu"]       += sum(estimate_pu(m, width_px, height_px, d, tree_focused and m != "rgb")
+                                for d in days)
+    return plan
+
+
+def print_backfill_plan(plan, minute_rate, used=None, monthly_pu=0):
+    """
+    Riepilogo del piano: lacune per indice, richieste, pixel, PU e durata
+    stimata. used (da ledger_totals) aggiunge il consumo già registrato e,
+    con monthly_pu, il confronto con la quota mensile.
+    """
+    print(f"\n→ Piano: {plan['windows']} finestre per indice")
+    for m, entry in plan["indices"].items():
+        if m == "rgb":
+            print("  RGB: 1 immagine del periodo")
+            continue
+        if plan["report_only"]:
+            print(f"  {m.upper()}: " + ("media del periodo da scaricare" if entry["map"]
+                                        else "media disponibile nel CSV"))
+            continue
+        parts = [f"{len(entry['windows'])} finestre da scaricare",
+                 f"{entry['cached']} nel CSV"]
+        if entry["resumed"]:
+            parts.append(f"{entry['resumed']} senza dati nel journal")
+        if entry["no_scenes"]:
+            parts.append(f"{entry['no_scenes']} senza acquisizioni utili")
+        parts.append("mappa del periodo" if entry["map"] else "nessuna mappa")
+        print(f"  {m.upper()}: " + ", ".join(parts))
+    duration = plan["requests"] * 60.0 / minute_rate if minute_rate else 0.0
+    print(f"  Totale: {plan['requests']} richieste, {plan['pixels'] / 1e6:.1f} Mpx, "
+          f"~{plan['pu']:.1f} PU, durata stimata {_format_duration(duration)} "
+          f"a {minute_rate} richieste/min")
+    if used is not None:
+        print(f"  Già registrate: oggi {used['day']['requests']} richieste (~{used['day']['pu']:.1f} PU), "
+              f"mese {used['month']['requests']} richieste (~{used['month']['pu']:.1f} PU)")
+        if monthly_pu and used["month"]["pu"] + plan["pu"] > monthly_pu:
+            print(f"  ⚠ Con questo piano il mese arriva a ~{used['month']['pu'] + plan['pu']:.0f} PU "
+                  f"su una quota di {monthly_pu:.0f}")
+
+
 # ================= HTML CHART =================
 
-def generate_html_chart(filepath, data_file, tree_focused, output_html="chart.html"):
+CHART_MAX_POINTS = 400   # punti per indice inclusi nell'HTML, oltre si ricampiona
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: indici dei threshold punti che meglio
+    conservano la forma della serie (x crescente, y senza NaN). Primo e ultimo punto
+    sono sempre inclusi; sotto soglia ritorna tutti gli indici.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # threshold-2 bucket tra il secondo e il penultimo punto
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    keep  = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # vertice opposto: media del bucket successivo (ultimo punto alla fine)
+        if i + 2 < len(edges):
+            nlo, nhi = edges[i + 1], edges[i + 2]
+            cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+        ax_, ay = x[a], y[a]
+        area = np.abs((ax_ - cx) * (y[lo:hi] - ay) - (ax_ - x[lo:hi]) * (cy - ay))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def _chart_point(start, end, value):
+    day = int(np.datetime64(start[:10], "D").astype(np.int64))
+    return {"x": day, "y": round(value, 5), "start": start, "end": end}
+
+
+def _write_full_series(path, label, series, days):
+    """
+    Sidecar JS con la serie completa in forma colonnare:
+    chartFullData(label, {x: [...], y: [...], start: [...], end: [...]}).
+    """
+    cols = {
+        "x":     days.tolist(),
+        "y":     [round(v, 5) for _, _, v in series],
+        "start": [st for st, _, _ in series],
+        "end":   [en for _, en, _ in series],
+    }
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(f"chartFullData({json.dumps(label)}, ")
+        json.dump(cols, f, ensure_ascii=False, separators=(",", ":"))
+        f.write(");\n")
+    os.replace(tmp, path)
+
+
+@traced("grafico.html")
+def generate_html_chart(filepath, data_file, tree_focused, output_html="chart.html",
+                        field_key=None, max_points=CHART_MAX_POINTS):
     """
     Genera un file HTML con grafici a linee interattivi e scorrevoli per tutti
     gli indici presenti nel CSV. Il grafico mostra un tooltip con la data al
     passaggio del mouse.
+    Le serie più lunghe di max_points vengono ricampionate con LTTB; quella
+    completa viene salvata in <output>_data/<indice>.js e caricata dalla
+    pagina solo su richiesta. L'HTML è scritto in streaming, un dataset
+    alla volta.
     """
-    datapoints = load_datapoints(data_file, tree_focused=tree_focused)
+    datapoints = load_datapoints(data_file, tree_focused=tree_focused, field_key=field_key)
     if not datapoints:
         print("⚠ Nessun dato nel CSV per generare il grafico HTML.")
         return
@@ -178,31 +1060,50 @@ def generate_html_chart(filepath, data_file, tree_focused, output_html="chart.ht
         "#5588ff", "#ff7055", "#55ddaa", "#ffcc44",
         "#cc88ff", "#44ddff", "#ff99cc", "#88ff66",
     ]
+    sidecar_dir = os.path.splitext(output_html)[0] + "_data"
 
-    datasets = []
-    for i, (idx_name, points) in enumerate(sorted(datapoints.items())):
+    def build_dataset(i, idx_name, points):
         # Ordina per data di inizio
-        points_sorted = sorted(points, key=lambda p: p["start"])
-        color = palette[i % len(palette)]
-        datasets.append({
-            "label": idx_name.upper(),
-            "data": [
-                {"x": p["start"], "y": round(p["value"], 5), "end": p["end"]}
-                for p in points_sorted
-            ],
+        series = sorted((p["start"], p["end"], p["value"]) for p in points)
+        values = np.array([v for _, _, v in series], dtype=np.float64)
+        valid  = values[~np.isnan(values)]
+        color  = palette[i % len(palette)]
+        label  = idx_name.upper()
+
+        dataset = {
+            "label": label,
             "borderColor": color,
             "backgroundColor": color + "22",
             "pointBackgroundColor": color,
-            "pointRadius": 5,
+            "pointRadius": 5 if len(series) <= 120 else 2,
             "pointHoverRadius": 8,
             "tension": 0.35,
             "fill": False,
-        })
+            # statistiche sulla serie completa, anche se è ricampionata
+            "stats": {
+                "n":    len(series),
+                "last": float(valid[-1]) if len(valid) else None,
+                "prev": float(valid[-2]) if len(valid) > 1 else None,
+                "avg":  float(valid.mean()) if len(valid) else None,
+            },
+        }
+        if len(series) > max_points:
+            days = np.array([st[:10] for st, _, _ in series],
+                            dtype="datetime64[D]").astype(np.int64)
+            # i valori mancanti non devono pesare sulla scelta dei punti
+            filled = np.where(np.isnan(values), dataset["stats"]["avg"] or 0.0, values)
+            keep = lttb_indices(days, filled, max_points)
+            os.makedirs(sidecar_dir, exist_ok=True)
+            fname = "".join(c for c in idx_name.lower() if c.isalnum()) + ".js"
+            _write_full_series(os.path.join(sidecar_dir, fname), label, series, days)
+            dataset["full"] = os.path.basename(sidecar_dir) + "/" + fname
+            series = [series[k] for k in keep]
+        dataset["data"] = [_chart_point(*p) for p in series]
+        return dataset
 
-    datasets_json = json.dumps(datasets, ensure_ascii=False)
     tree_label = "chiome arboree" if str(tree_focused).lower() == "true" else "campo intero"
 
-    html = f"""<!DOCTYPE html>
+    html_head = f"""<!DOCTYPE html>
 <html lang="it">
 <head>
 <meta charset="UTF-8">
@@ -383,6 +1284,7 @@ def generate_html_chart(filepath, data_file, tree_focused, output_html="chart.ht
 
 <div class="controls" id="controls">
   <button class="btn-all" onclick="toggleAll()">Tutti / Nessuno</button>
+  <button class="btn-all" id="btnFull" style="margin-left: 0" onclick="loadFull()">Risoluzione completa</button>
 </div>
 
 <div class="chart-wrap">
@@ -396,139 +1298,169 @@ def generate_html_chart(filepath, data_file, tree_focused, output_html="chart.ht
 <footer>generato il {datetime.now().strftime("%d/%m/%Y %H:%M")} &nbsp;·&nbsp; Sentinel-2 L2A</footer>
 
 <script>
-const RAW_DATASETS = {datasets_json};
+const RAW_DATASETS = ["""
+
+    html_tail = """];
 
-// Calcola statistiche per le card
-function buildStats(datasets) {{
+// Calcola statistiche per le card (precalcolate sulla serie completa)
+function buildStats(datasets) {
   const grid = document.getElementById('statsGrid');
   grid.innerHTML = '';
-  datasets.forEach(ds => {{
-    const vals = ds.data.map(p => p.y).filter(v => v !== null && !isNaN(v));
-    if (!vals.length) return;
-    const last  = vals[vals.length - 1];
-    const avg   = vals.reduce((a,b) => a+b, 0) / vals.length;
-    const trend = vals.length > 1 ? last - vals[vals.length - 2] : 0;
+  datasets.forEach(ds => {
+    const st = ds.stats;
+    if (st.last === null) return;
+    const last  = st.last;
+    const avg   = st.avg;
+    const trend = st.prev !== null ? last - st.prev : 0;
     const arrow = trend > 0 ? '▲' : trend < 0 ? '▼' : '—';
     const tcolor = trend > 0 ? '#55dd88' : trend < 0 ? '#ff6655' : '#888';
 
     const card = document.createElement('div');
     card.className = 'stat-card';
     card.innerHTML = `
-      <div class="idx-name">${{ds.label}}</div>
-      <div class="idx-val">${{last.toFixed(4)}}</div>
-      <div class="idx-label" style="color:${{tcolor}}">${{arrow}} ${{Math.abs(trend).toFixed(4)}} &nbsp;·&nbsp; media ${{avg.toFixed(4)}}</div>
+      <div class="idx-name">${ds.label}</div>
+      <div class="idx-val">${last.toFixed(4)}</div>
+      <div class="idx-label" style="color:${tcolor}">${arrow} ${Math.abs(trend).toFixed(4)} &nbsp;·&nbsp; media ${avg.toFixed(4)}</div>
     `;
     grid.appendChild(card);
-  }});
-}}
+  });
+}
 
 // Pulsanti filtro
 const activeSet = new Set(RAW_DATASETS.map(d => d.label));
 
-function renderButtons() {{
+function renderButtons() {
   const ctrl = document.getElementById('controls');
   // rimuovi vecchi btn
   ctrl.querySelectorAll('.btn-idx').forEach(b => b.remove());
   const all = ctrl.querySelector('.btn-all');
-  RAW_DATASETS.forEach(ds => {{
+  RAW_DATASETS.forEach(ds => {
     const btn = document.createElement('button');
     btn.className = 'btn-idx' + (activeSet.has(ds.label) ? ' active' : '');
     btn.textContent = ds.label;
     btn.style.setProperty('--c', ds.borderColor);
-    btn.addEventListener('click', () => {{
+    btn.addEventListener('click', () => {
       if (activeSet.has(ds.label)) activeSet.delete(ds.label);
       else activeSet.add(ds.label);
       updateChart();
       renderButtons();
-    }});
+    });
     ctrl.insertBefore(btn, all);
-  }});
-}}
+  });
+}
 
-function toggleAll() {{
+function toggleAll() {
   if (activeSet.size === RAW_DATASETS.length) activeSet.clear();
   else RAW_DATASETS.forEach(d => activeSet.add(d.label));
   updateChart();
   renderButtons();
-}}
+}
 
-function updateChart() {{
+function updateChart() {
   const visible = RAW_DATASETS.filter(d => activeSet.has(d.label));
   chart.data.datasets = visible;
   chart.update('active');
   buildStats(visible);
-}}
+}
+
+// Serie complete caricate su richiesta tramite <script> (funziona anche
+// aprendo la pagina da file://, dove fetch non è consentito)
+function chartFullData(label, cols) {
+  const ds = RAW_DATASETS.find(d => d.label === label);
+  if (!ds) return;
+  ds.data = cols.x.map((x, i) => ({ x: x, y: cols.y[i], start: cols.start[i], end: cols.end[i] }));
+  ds.loaded = true;
+  updateChart();
+}
+
+function loadFull() {
+  RAW_DATASETS.forEach(ds => {
+    if (!ds.full || ds.loaded || ds.loading || !activeSet.has(ds.label)) return;
+    ds.loading = true;
+    const s = document.createElement('script');
+    s.src = ds.full;
+    document.body.appendChild(s);
+  });
+}
+
+function dayLabel(day) {
+  return new Date(day * 86400000).toISOString().slice(0, 10);
+}
 
 // Chart.js
 const ctx = document.getElementById('mainChart').getContext('2d');
-const chart = new Chart(ctx, {{
+const chart = new Chart(ctx, {
   type: 'line',
-  data: {{ datasets: RAW_DATASETS }},
-  options: {{
+  data: { datasets: RAW_DATASETS },
+  options: {
     responsive: true,
     maintainAspectRatio: false,
-    interaction: {{
-      mode: 'index',
+    interaction: {
+      mode: 'nearest',
+      axis: 'x',
       intersect: false,
-    }},
-    plugins: {{
-      legend: {{ display: false }},
-      tooltip: {{
+    },
+    plugins: {
+      legend: { display: false },
+      tooltip: {
         backgroundColor: '#0d1020ee',
         borderColor: '#1e2240',
         borderWidth: 1,
-        titleFont: {{ family: 'Space Mono', size: 11 }},
-        bodyFont: {{ family: 'DM Sans', size: 12 }},
+        titleFont: { family: 'Space Mono', size: 11 },
+        bodyFont: { family: 'DM Sans', size: 12 },
         titleColor: '#c8d0f0',
         bodyColor: '#8899cc',
         padding: 12,
-        callbacks: {{
-          title: function(items) {{
+        callbacks: {
+          title: function(items) {
             if (!items.length) return '';
             const pt = items[0].raw;
             return pt.end
-              ? `${{pt.x}}  →  ${{pt.end}}`
-              : pt.x;
-          }},
-          label: function(item) {{
-            return `  ${{item.dataset.label}}: ${{item.parsed.y.toFixed(5)}}`;
-          }}
-        }}
-      }}
-    }},
-    scales: {{
-      x: {{
-        type: 'category',
-        ticks: {{
+              ? `${pt.start}  →  ${pt.end}`
+              : pt.start;
+          },
+          label: function(item) {
+            return `  ${item.dataset.label}: ${item.parsed.y.toFixed(5)}`;
+          }
+        }
+      }
+    },
+    scales: {
+      x: {
+        type: 'linear',
+        ticks: {
+          callback: v => dayLabel(v),
           color: '#5a6080',
-          font: {{ family: 'Space Mono', size: 10 }},
+          font: { family: 'Space Mono', size: 10 },
           maxRotation: 45,
-        }},
-        grid: {{ color: '#1e224044' }},
-        title: {{
+        },
+        grid: { color: '#1e224044' },
+        title: {
           display: true,
           text: 'Inizio finestra',
           color: '#5a6080',
-          font: {{ family: 'DM Sans', size: 11 }},
-        }}
-      }},
-      y: {{
-        ticks: {{
+          font: { family: 'DM Sans', size: 11 },
+        }
+      },
+      y: {
+        ticks: {
           color: '#5a6080',
-          font: {{ family: 'Space Mono', size: 10 }},
-        }},
-        grid: {{ color: '#1e224088' }},
-        title: {{
+          font: { family: 'Space Mono', size: 10 },
+        },
+        grid: { color: '#1e224088' },
+        title: {
           display: true,
           text: 'Valore indice',
           color: '#5a6080',
-          font: {{ family: 'DM Sans', size: 11 }},
-        }}
-      }}
-    }}
-  }}
-}});
+          font: { family: 'DM Sans', size: 11 },
+        }
+      }
+    }
+  }
+});
 
+if (!RAW_DATASETS.some(d => d.full))
+  document.getElementById('btnFull').style.display = 'none';
 renderButtons();
 buildStats(RAW_DATASETS);
 </script>
@@ -536,7 +1468,12 @@ buildStats(RAW_DATASETS);
 </html>"""
 
     with open(output_html, "w", encoding="utf-8") as f:
-        f.write(html)
+        f.write(html_head)
+        for i, (idx_name, points) in enumerate(sorted(datapoints.items())):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(build_dataset(i, idx_name, points), ensure_ascii=False))
+        f.write(html_tail)
     print(f"  → Grafico HTML salvato in: {output_html}")
 
 
@@ -676,20 +1613,23 @@ INDEX_WEIGHTS = {
 
 # ================= NORMALIZZAZIONE A SCORE 0-100 =================
 
+SCORE_RANGES = {
+    "ndvi":  (-0.2, 1.0),
+    "ndre":  (0.0,  0.6),
+    "gndvi": (0.0,  0.8),
+    "gci":   (0.0,  10.0),
+    "savi":  (0.0,  0.8),
+    "pri":   (-0.1, 0.1),
+    "mcari": (0.0,  1.0),
+    "tcari": (0.0,  1.5),
+}
+DEFAULT_SCORE_RANGE = (0, 1)
+
+
 def normalize_to_score(name, value):
     if value is None or np.isnan(value):
         return None
-    ranges = {
-        "ndvi":  (-0.2, 1.0),
-        "ndre":  (0.0,  0.6),
-        "gndvi": (0.0,  0.8),
-        "gci":   (0.0,  10.0),
-        "savi":  (0.0,  0.8),
-        "pri":   (-0.1, 0.1),
-        "mcari": (0.0,  1.0),
-        "tcari": (0.0,  1.5),
-    }
-    lo, hi = ranges.get(name, (0, 1))
+    lo, hi = SCORE_RANGES.get(name, DEFAULT_SCORE_RANGE)
     score = (value - lo) / (hi - lo) * 100
     return float(np.clip(score, 0, 100))
 
@@ -1003,66 +1943,175 @@ EVALSCRIPTS_TREE = {
 
 # ================= VALUTAZIONE TESTUALE =================
 
+# Per ogni indice: soglie crescenti e giudizi; il giudizio i vale per
+# soglie[i-1] <= valore < soglie[i] (l'ultimo oltre l'ultima soglia)
+EVALUATION_CLASSES = {
+    "ndvi": ([0, 0.2, 0.4, 0.6, 0.8], [
+        "Acqua o superfici artificiali",
+        "Suolo nudo o vegetazione molto scarsa",
+        "Vegetazione rada o stress elevato",
+        "Vegetazione moderata",
+        "Vegetazione sana e densa",
+        "Vegetazione molto densa e vigorosa",
+    ]),
+    "ndre": ([0, 0.2, 0.35, 0.5], [
+        "Suolo nudo o stress severo",
+        "Stress elevato, clorofilla molto bassa",
+        "Stress moderato",
+        "Vegetazione discreta",
+        "Vegetazione sana, buona clorofilla",
+    ]),
+    "gndvi": ([0.1, 0.3, 0.5], [
+        "Suolo nudo",
+        "Vegetazione scarsa",
+        "Vegetazione moderata",
+        "Vegetazione densa e sana",
+    ]),
+    "gci": ([1, 3, 5, 8], [
+        "Clorofilla molto bassa, stress severo",
+        "Clorofilla bassa",
+        "Clorofilla nella norma",
+        "Clorofilla elevata, buona salute",
+        "Clorofilla molto elevata",
+    ]),
+    "savi": ([0, 0.2, 0.4, 0.6], [
+        "Suolo nudo o acqua",
+        "Vegetazione molto scarsa",
+        "Vegetazione rada",
+        "Vegetazione moderata",
+        "Vegetazione densa",
+    ]),
+    "pri": ([-0.05, 0, 0.05], [
+        "Efficienza fotosintetica bassa, stress",
+        "Efficienza fotosintetica nella norma",
+        "Buona efficienza fotosintetica",
+        "Efficienza fotosintetica molto alta",
+    ]),
+    "mcari": ([0.1, 0.5], [
+        "Clorofilla molto bassa",
+        "Clorofilla moderata",
+        "Clorofilla elevata",
+    ]),
+    "tcari": ([0.1, 0.5], [
+        "Clorofilla molto bassa",
+        "Clorofilla moderata",
+        "Clorofilla elevata",
+    ]),
+}
+
+
 def evaluate_index(name, value):
     if value is None or np.isnan(value):
         return "Nessun dato"
+    if name not in EVALUATION_CLASSES:
+        return "N/D"
+    edges, labels = EVALUATION_CLASSES[name]
+    return labels[int(np.searchsorted(edges, value, side="right"))]
+
+
+# ================= MOTORE DI SCORING =================
+
+def normalize_scores(names, values):
+    """Versione vettoriale di normalize_to_score: NaN dove il valore manca."""
+    uniq, inv = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+    bounds = np.array([SCORE_RANGES.get(n, DEFAULT_SCORE_RANGE) for n in uniq],
+                      dtype=np.float64).reshape(-1, 2)
+    lo, hi = bounds[inv, 0], bounds[inv, 1]
+    values = np.asarray(values, dtype=np.float64)
+    return np.clip((values - lo) / (hi - lo) * 100, 0, 100)
+
+
+def evaluate_indices(names, values):
+    """Versione vettoriale di evaluate_index: una searchsorted per indice."""
+    uniq, inv = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+    values = np.asarray(values, dtype=np.float64)
+    out = np.full(len(values), "N/D", dtype=object)
+    for i, name in enumerate(uniq):
+        sel = inv == i
+        if name in EVALUATION_CLASSES:
+            edges, labels = EVALUATION_CLASSES[name]
+            pos = np.searchsorted(edges, values[sel], side="right")
+            out[sel] = np.asarray(labels, dtype=object)[pos]
+    out[np.isnan(values)] = "Nessun dato"
+    return out
+
+
+def score_values(table):
+    """
+    Tabella lunga (una riga per rilevazione, colonne "index" e "value" più
+    le chiavi di campo/periodo) con score 0-100, peso INDEX_WEIGHTS e
+    valutazione testuale. Le righe senza valore vengono scartate.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(table)
+    df = df[pd.to_numeric(df["value"], errors="coerce").notna()].copy()
+    df["value"]      = df["value"].astype(np.float64)
+    df["score"]      = normalize_scores(df["index"].to_numpy(), df["value"].to_numpy())
+    df["weight"]     = df["index"].map(INDEX_WEIGHTS).fillna(0.0)
+    df["evaluation"] = evaluate_indices(df["index"].to_numpy(), df["value"].to_numpy())
+    return df
+
+
+def rank_scores(scored, keys):
+    """
+    Una riga per combinazione di keys (es. campo e periodo) con lo score
+    di ogni indice (score_<indice>), lo score globale pesato e la posizione
+    in classifica (1 = migliore).
+    """
+    keys = list(keys)
+    # una sola riga per indice: la stessa finestra salvata con due passi
+    # (step_days) conterebbe due volte nella media pesata
+    df = (scored.drop_duplicates(keys + ["index"], keep="last")
+                .assign(weighted=lambda d: d["score"] * d["weight"]))
+    sums = df.groupby(keys, sort=False, dropna=False)[["weighted", "weight"]].sum()
+    global_score = (sums["weighted"] / sums["weight"]).where(sums["weight"] > 0, 0.0)
+
+    wide = (df.groupby(keys + ["index"], sort=False, dropna=False)["score"]
+              .last().unstack("index"))
+    wide.columns = [f"score_{c}" for c in wide.columns]
+    ranked = wide.join(global_score.rename("global_score")).reset_index()
+    ranked = ranked.sort_values("global_score", ascending=False, kind="stable")
+    ranked["rank"] = np.arange(1, len(ranked) + 1)
+    return ranked.reset_index(drop=True)
+
+
+def score_table(table, keys=("field", "start", "end", "tree_focused")):
+    """
+    Score e classifica di un'intera tabella di rilevazioni. Le chiavi
+    assenti (CSV con l'intestazione precedente, senza field/size/step_days)
+    valgono "" come nelle ricerche per campo.
+    """
+    scored = score_values(table)
+    for k in keys:
+        scored[k] = scored[k].fillna("") if k in scored.columns else ""
+    return rank_scores(scored, keys)
 
-    if name == "ndvi":
-        if value < 0:    return "Acqua o superfici artificiali"
-        if value < 0.2:  return "Suolo nudo o vegetazione molto scarsa"
-        if value < 0.4:  return "Vegetazione rada o stress elevato"
-        if value < 0.6:  return "Vegetazione moderata"
-        if value < 0.8:  return "Vegetazione sana e densa"
-        return                  "Vegetazione molto densa e vigorosa"
-
-    if name == "ndre":
-        if value < 0:    return "Suolo nudo o stress severo"
-        if value < 0.2:  return "Stress elevato, clorofilla molto bassa"
-        if value < 0.35: return "Stress moderato"
-        if value < 0.5:  return "Vegetazione discreta"
-        return                  "Vegetazione sana, buona clorofilla"
-
-    if name == "gndvi":
-        if value < 0.1:  return "Suolo nudo"
-        if value < 0.3:  return "Vegetazione scarsa"
-        if value < 0.5:  return "Vegetazione moderata"
-        return                  "Vegetazione densa e sana"
-
-    if name == "gci":
-        if value < 1:    return "Clorofilla molto bassa, stress severo"
-        if value < 3:    return "Clorofilla bassa"
-        if value < 5:    return "Clorofilla nella norma"
-        if value < 8:    return "Clorofilla elevata, buona salute"
-        return                  "Clorofilla molto elevata"
-
-    if name == "savi":
-        if value < 0:    return "Suolo nudo o acqua"
-        if value < 0.2:  return "Vegetazione molto scarsa"
-        if value < 0.4:  return "Vegetazione rada"
-        if value < 0.6:  return "Vegetazione moderata"
-        return                  "Vegetazione densa"
-
-    if name == "pri":
-        if value < -0.05: return "Efficienza fotosintetica bassa, stress"
-        if value < 0:     return "Efficienza fotosintetica nella norma"
-        if value < 0.05:  return "Buona efficienza fotosintetica"
-        return                   "Efficienza fotosintetica molto alta"
-
-    if name == "mcari":
-        if value < 0.1:  return "Clorofilla molto bassa"
-        if value < 0.5:  return "Clorofilla moderata"
-        return                  "Clorofilla elevata"
-
-    if name == "tcari":
-        if value < 0.1:  return "Clorofilla molto bassa"
-        if value < 0.5:  return "Clorofilla moderata"
-        return                  "Clorofilla elevata"
-
-    return "N/D"
 
 # ================= COLORMAP PER INDICE =================
 
+VALUE_RANGES = {
+    "ndvi":  (-0.2, 1.0),
+    "ndre":  (-0.2, 1.0),
+    "gndvi": (-0.2, 1.0),
+    "savi":  (-0.2, 1.0),
+    "gci":   (0, 10),
+    "pri":   (-0.1, 0.1),
+    "mcari": (0, 1),
+    "tcari": (0, 1),
+}
+DEFAULT_VALUE_RANGE = (-1, 1)
+
+
+def get_value_range(name):
+    """Range teorico dell'indice, lo stesso usato da get_colormap_and_range."""
+    return VALUE_RANGES.get(name, DEFAULT_VALUE_RANGE)
+
+
 def get_colormap_and_range(name):
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LinearSegmentedColormap
+
     if name in ("ndvi", "ndre", "gndvi", "savi"):
         cmap = LinearSegmentedColormap.from_list("veg", [
             (0.0,  (0.55, 0.0,  0.0)),
@@ -1071,9 +2120,7 @@ def get_colormap_and_range(name):
             (0.75, (0.56, 0.93, 0.56)),
             (1.0,  (0.0,  0.39, 0.0)),
         ])
-        return cmap, -0.2, 1.0
-
-    if name == "gci":
+    elif name == "gci":
         cmap = LinearSegmentedColormap.from_list("gci", [
             (0.0,  (0.55, 0.0,  0.0)),
             (0.3,  (0.82, 0.41, 0.12)),
@@ -1081,33 +2128,28 @@ def get_colormap_and_range(name):
             (0.8,  (0.56, 0.93, 0.56)),
             (1.0,  (0.0,  0.39, 0.0)),
         ])
-        return cmap, 0, 10
-
-    if name == "pri":
+    elif name == "pri":
         cmap = LinearSegmentedColormap.from_list("pri", [
             (0.0,  (0.8, 0.2, 0.0)),
             (0.5,  (1.0, 1.0, 0.0)),
             (1.0,  (0.0, 0.6, 0.0)),
         ])
-        return cmap, -0.1, 0.1
-
-    if name in ("mcari", "tcari"):
+    elif name in ("mcari", "tcari"):
         cmap = LinearSegmentedColormap.from_list("chloro", [
             (0.0,  (0.55, 0.0,  0.0)),
             (0.5,  (1.0,  1.0,  0.0)),
             (1.0,  (0.0,  0.39, 0.0)),
         ])
-        return cmap, 0, 1
+    else:
+        cmap = plt.cm.RdYlGn
 
-    return plt.cm.RdYlGn, -1, 1
+    return (cmap, *get_value_range(name))
 
 # ================= REQUEST =================
 
 def make_request(token, polygon, width, height, start, end, mode, tree_focused=False):
-    url = "https://sh.dataspace.copernicus.eu/api/v1/process"
-    resolution = 10
-    width_px  = max(64, min(2500, int(width  / resolution)))
-    height_px = max(64, min(2500, int(height / resolution)))
+    url = SH_ENDPOINTS["process"]
+    width_px, height_px = output_size(width, height)
 
     if tree_focused and mode in EVALSCRIPTS_TREE:
         evalscript = EVALSCRIPTS_TREE[mode]
@@ -1118,7 +2160,7 @@ def make_request(token, polygon, width, height, start, end, mode, tree_focused=F
 
     payload = {
         "input": {
-            "bounds": {"geometry": {"type": "Polygon", "coordinates": [polygon]}},
+            "bounds": {"geometry": _as_geometry(polygon)},
             "data": [{
                 "type": "sentinel-2-l2a",
                 "dataFilter": {
@@ -1142,31 +2184,208 @@ def make_request(token, polygon, width, height, start, end, mode, tree_focused=F
 
 # ================= DOWNLOAD =================
 
-def download_image(url, headers, payload):
-    r = requests.post(url, headers=headers, json=payload)
+# (connessione, lettura) in secondi: una connessione bloccata non deve
+# fermare un backfill o il daemon
+HTTP_TIMEOUT = (10, 300)
+
+_http = {"session": None}
+
+
+def http_session():
+    """Sessione HTTP condivisa: connessioni keep-alive riusate tra le richieste."""
+    if _http["session"] is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=8))
+        _http["session"] = session
+    return _http["session"]
+
+
+def download_image(url, headers, payload, session=None):
+    import requests
+
+    post = session.post if session is not None else requests.post
+    t0 = time.perf_counter()
+    try:
+        with span("rete"):
+            r = post(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
+    except Exception:
+        ledger_record(payload, 0, time.perf_counter() - t0)
+        raise
+    ledger_record(payload, r.status_code, time.perf_counter() - t0)
     if r.status_code != 200:
         print(f"Errore API: {r.status_code} - {r.text}")
         return None
     return BytesIO(r.content)
 
-# ================= ESTRAI ARRAY, MASCHERA E MEDIA =================
+# ================= LEDGER DELLE RICHIESTE =================
+
+LEDGER_FILE = "ledger.sqlite"
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    ts          REAL NOT NULL,
+    field       TEXT,
+    idx         TEXT,
+    width       INTEGER,
+    height      INTEGER,
+    bands       INTEGER,
+    sample_type TEXT,
+    pu          REAL,
+    latency     REAL,
+    status      INTEGER
+);
+CREATE INDEX IF NOT EXISTS requests_ts ON requests (ts);
+"""
 
-def extract_array_and_mean(img_bytes, mode, tree_focused, tree_params):
-    if img_bytes is None:
+# Una connessione per processo: i worker degli indici aprono la propria
+_ledger = {"path": None, "conn": None, "pid": None, "scripts": None}
+
+
+def open_ledger(path=LEDGER_FILE):
+    """Attiva il ledger SQLite delle richieste Process (None lo disattiva)."""
+    _ledger.update(path=path, conn=None, pid=None)
+
+
+def _ledger_conn():
+    if _ledger["path"] is None:
+        return None
+    if _ledger["conn"] is None or _ledger["pid"] != os.getpid():
+        import sqlite3
+
+        try:
+            conn = sqlite3.connect(_ledger["path"], timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(LEDGER_SCHEMA)
+        except sqlite3.Error as e:
+            # ledger non apribile (cartella in sola lettura, file corrotto): disattivato
+            print(f"⚠ Ledger {_ledger['path']} non disponibile ({e}): disattivato")
+            _ledger.update(path=None, conn=None, pid=None)
+            return None
+        _ledger.update(conn=conn, pid=os.getpid())
+    return _ledger["conn"]
+
+
+def _payload_info(payload):
+    """Campo, indice, dimensioni, bande, sampleType e PU stimate di una richiesta Process."""
+    if _ledger["scripts"] is None:
+        names = {script: name for name, script in EVALSCRIPTS.items()}
+        names.update({script: name for name, script in EVALSCRIPTS_TREE.items()})
+        _ledger["scripts"] = names
+    script     = payload["evalscript"]
+    out        = payload["output"]
+    time_range = payload["input"]["data"][0]["dataFilter"]["timeRange"]
+    days = (datetime.fromisoformat(time_range["to"][:10])
+            - datetime.fromisoformat(time_range["from"][:10])).days
+    n_bands, sample_type = _script_bands(script)
+    return (geometry_fingerprint(payload["input"]["bounds"]["geometry"]),
+            _ledger["scripts"].get(script, "?"),
+            out["width"], out["height"], n_bands, sample_type,
+            processing_units(out["width"], out["height"], n_bands, sample_type, days))
+
+
+def ledger_record(payload, status, latency):
+    """
+    Registra una richiesta Process (status 0: nessuna risposta). Un errore
+    del ledger (database bloccato, cartella in sola lettura, payload non
+    riconosciuto) viene solo segnalato: non cambia l'esito della richiesta.
+    """
+    import sqlite3
+
+    try:
+        conn = _ledger_conn()
+        if conn is None:
+            return
+        conn.execute("INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (time.time(),) + _payload_info(payload) + (latency, status))
+        conn.commit()
+    except (sqlite3.Error, KeyError, IndexError, TypeError, ValueError) as e:
+        print(f"⚠ Ledger: richiesta non registrata ({type(e).__name__}: {e})")
+
+
+def ledger_recent(seconds=60):
+    """Istanti (time.time()) delle richieste degli ultimi secondi, di qualsiasi esecuzione."""
+    conn = _ledger_conn()
+    if conn is None:
+        return []
+    rows = conn.execute("SELECT ts FROM requests WHERE ts >= ? ORDER BY ts",
+                        (time.time() - seconds,))
+    return [ts for (ts,) in rows]
+
+
+def ledger_totals():
+    """Richieste e PU registrate oggi e nel mese corrente, su tutti i campi."""
+    conn = _ledger_conn()
+    if conn is None:
+        return None
+    now    = datetime.now()
+    day0   = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    totals = {}
+    for name, since in (("day", day0), ("month", day0.replace(day=1))):
+        n, pu = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(CASE WHEN status = 200 THEN pu END), 0) "
+            "FROM requests WHERE ts >= ?", (since.timestamp(),)).fetchone()
+        totals[name] = {"requests": n, "pu": pu}
+    return totals
+
+
+def ledger_usage(group="day", since=None):
+    """
+    Consumo per periodo (giorno o mese) e campo; le PU contano solo le
+    richieste riuscite. Ritorna righe (periodo, campo, richieste, PU,
+    errori, latenza media).
+    """
+    conn = _ledger_conn()
+    if conn is None:
+        return []
+    fmt = "%Y-%m-%d" if group == "day" else "%Y-%m"
+    return conn.execute(
+        "SELECT strftime(?, ts, 'unixepoch', 'localtime') AS period, field, COUNT(*), "
+        "COALESCE(SUM(CASE WHEN status = 200 THEN pu END), 0), SUM(status != 200), AVG(latency) "
+        "FROM requests WHERE ts >= ? "
+        "GROUP BY period, field ORDER BY period, field",
+        (fmt, since.timestamp() if since else 0.0),
+    ).fetchall()
+
+
+def print_usage(days=30):
+    """Consumo giornaliero (ultimi days giorni) e mensile per campo."""
+    since = datetime.now() - relativedelta(days=days)
+    for title, rows in ((f"Consumo giornaliero (ultimi {days} giorni)", ledger_usage("day", since)),
+                        ("Consumo mensile", ledger_usage("month"))):
+        print(f"\n{title}")
+        if not rows:
+            print("  nessuna richiesta registrata")
+            continue
+        print(f"  {'periodo':<10}  {'campo':<16}  {'richieste':>9}  {'PU':>10}  "
+              f"{'errori':>6}  {'latenza':>8}")
+        for period, field, n, pu, errors, latency in rows:
+            print(f"  {period:<10}  {field:<16}  {n:>9}  {pu:>10.1f}  {errors:>6}  "
+                  f"{latency:>7.2f}s")
+
+# ================= ESTRAI ARRAY, MASCHERA E MEDIA =================
+
+def extract_array_and_mean(img_bytes, mode, tree_focused, tree_params):
+    if img_bytes is None:
         return None, None, None, "campo intero"
 
-    with rasterio.open(img_bytes) as src:
+    import rasterio
+
+    with span("tiff.decodifica"), rasterio.open(img_bytes) as src:
         data = src.read().astype(np.float32)
 
     if tree_focused and data.shape[0] >= 4:
         b03, b04, b08 = data[0], data[1], data[2]
         index_arr = data[3]
-        tree_mask, _, _ = compute_tree_mask(
-            b03, b04, b08,
-            cvi_threshold    = tree_params["cvi_threshold"],
-            ndvi_threshold   = tree_params["ndvi_threshold"],
-            shadow_threshold = tree_params["shadow_threshold"],
-        )
+        with span("maschera"):
+            tree_mask, _, _ = compute_tree_mask(
+                b03, b04, b08,
+                cvi_threshold    = tree_params["cvi_threshold"],
+                ndvi_threshold   = tree_params["ndvi_threshold"],
+                shadow_threshold = tree_params["shadow_threshold"],
+            )
         map_array  = np.where(tree_mask, index_arr, np.nan)
         mask_array = tree_mask
         mean_label = "chiome arboree"
@@ -1181,8 +2400,232 @@ def extract_array_and_mean(img_bytes, mode, tree_focused, tree_params):
     return map_array, mask_array, mean_val, mean_label
 
 
+def fetch_window_mean(token, polygon, width, height, mode, win_start, win_end,
+                      tree_focused=False, tree_params=None, session=None):
+    """
+    Media dell'indice su una finestra temporale: NaN se la finestra non ha
+    dati validi, None se la richiesta è fallita (da ripetere).
+    """
+    if tree_params is None:
+        tree_params = dict(TREE_MASK_DEFAULTS)
+    url, headers, payload = make_request(
+        token, polygon, width, height,
+        win_start.isoformat() + "Z", win_end.isoformat() + "Z", mode,
+        tree_focused=tree_focused,
+    )
+    img = download_image(url, headers, payload, session=session)
+    if img is None:
+        return None
+    _, _, mean, _ = extract_array_and_mean(img, mode, tree_focused, tree_params)
+    return mean if mean is not None else np.nan
+
+# ================= CATALOGO STAC =================
+
+CATALOG_MAX_CLOUD   = 50   # come maxCloudCoverage delle richieste Process
+CATALOG_SETTLE_DAYS = 3    # acquisizioni recenti pubblicate in ritardo: non cacheate
+
+
+def catalog_cache_path(data_file):
+    return data_file + ".catalog.json"
+
+
+def search_catalog(token, polygon, start, end, url=None, session=None):
+    """
+    Acquisizioni Sentinel-2 L2A sull'area nel periodo (date YYYY-MM-DD
+    incluse) con una ricerca STAC paginata.
+    Ritorna [(datetime ISO, copertura nuvolosa %), ...].
+    """
+    if session is None:
+        session = http_session()
+    if url is None:
+        url = SH_ENDPOINTS["catalog"]
+    body = {
+        "collections": ["sentinel-2-l2a"],
+        "datetime":    f"{start}T00:00:00Z/{end}T23:59:59Z",
+        "intersects":  _as_geometry(polygon),
+        "limit":       100,
+        "fields":      {"include": ["properties.datetime", "properties.eo:cloud_cover"],
+                        "exclude": ["assets", "links"]},
+    }
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    scenes = []
+    while True:
+        r = session.post(url, headers=headers, json=body, timeout=HTTP_TIMEOUT)
+        if r.status_code != 200:
+            raise RuntimeError(f"catalogo {r.status_code} - {r.text[:200]}")
+        data = r.json()
+        for feature in data.get("features", []):
+            props = feature.get("properties", {})
+            scenes.append((props["datetime"], float(props.get("eo:cloud_cover", 0.0))))
+        next_page = data.get("context", {}).get("next")
+        if next_page is None:
+            return scenes
+        body["next"] = next_page
+
+
+@traced("catalogo")
+def load_scenes(get_token, polygon, aoi, start, end, cache_file=None, url=None):
+    """
+    Acquisizioni del periodo per l'area aoi (impronta del campo). La cache
+    tiene per ogni area l'intervallo già cercato: vengono interrogate solo
+    le parti del periodo fuori da quell'intervallo, e gli ultimi
+    CATALOG_SETTLE_DAYS giorni restano sempre da cercare.
+    """
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, encoding="utf-8") as fh:
+                cache = json.load(fh)
+        except ValueError:
+            cache = {}
+
+    s, e  = start[:10], end[:10]
+    entry = cache.get(aoi)
+    if entry is None:
+        queries = [(s, e)]
+    else:
+        queries = []
+        if s < entry["from"]:
+            day_before = datetime.fromisoformat(entry["from"]) - relativedelta(days=1)
+            queries.append((s, day_before.strftime("%Y-%m-%d")))
+        if e > entry["to"]:
+            day_after = datetime.fromisoformat(entry["to"]) + relativedelta(days=1)
+            queries.append((day_after.strftime("%Y-%m-%d"), e))
+
+    if queries:
+        scenes = dict(entry["scenes"]) if entry else {}
+        token  = get_token()
+        for q_start, q_end in queries:
+            print(f"→ Catalogo: acquisizioni {q_start} → {q_end} ...")
+            scenes.update(search_catalog(token, polygon, q_start, q_end, url=url))
+        settled = (datetime.now() - relativedelta(days=CATALOG_SETTLE_DAYS)).strftime("%Y-%m-%d")
+        entry = {
+            "from":   min(s, entry["from"]) if entry else s,
+            "to":     min(max(e, entry["to"]) if entry else e, settled),
+            "scenes": sorted(scenes.items()),
+        }
+        if cache_file and entry["from"] <= entry["to"]:
+            cache[aoi] = entry
+            tmp = cache_file + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(cache, fh)
+            os.replace(tmp, cache_file)
+
+    return [(dt, cloud) for dt, cloud in entry["scenes"] if s <= dt[:10] <= e]
+
+
+def windows_with_scenes(windows, scenes, max_cloud=CATALOG_MAX_CLOUD):
+    """Finestre (start, end) del trend con almeno un'acquisizione entro max_cloud."""
+    times = sorted(datetime.fromisoformat(dt.replace("Z", "+00:00")).replace(tzinfo=None)
+                   for dt, cloud in scenes if cloud <= max_cloud)
+    usable = set()
+    for s, e in windows:
+        # stessa finestra della richiesta Process: da s a e, alle 00:00
+        i = bisect_left(times, datetime.fromisoformat(s))
+        if i < len(times) and times[i] <= datetime.fromisoformat(e):
+            usable.add((s, e))
+    return usable
+
 # ================= HOVER INTERATTIVO =================
 
+HOVER_MIN_INTERVAL = 1 / 30   # secondi minimi tra due ridisegni dei tooltip
+
+# Stato per figura: sfondo in cache e tooltip da ridisegnare col blitting
+_hover_overlays = weakref.WeakKeyDictionary()
+
+
+def _overlay_state(fig):
+    state = _hover_overlays.get(fig)
+    if state is not None:
+        return state
+
+    canvas = fig.canvas
+    state  = {"background": None, "annots": [], "last": 0.0, "timer": None}
+
+    def on_draw(event):
+        # dopo ogni ridisegno completo (zoom, pan, resize) aggiorna lo sfondo
+        if getattr(canvas, "supports_blit", False):
+            state["background"] = canvas.copy_from_bbox(fig.bbox)
+        for annot in state["annots"]:
+            if annot.get_visible():
+                fig.draw_artist(annot)
+
+    canvas.mpl_connect("draw_event", on_draw)
+    _hover_overlays[fig] = state
+    return state
+
+
+def _blit_overlays(fig, state):
+    state["last"] = time.monotonic()
+    canvas = fig.canvas
+    if state["background"] is None:
+        canvas.draw_idle()
+        return
+    canvas.restore_region(state["background"])
+    for annot in state["annots"]:
+        if annot.get_visible():
+            fig.draw_artist(annot)
+    canvas.blit(fig.bbox)
+
+
+def _attach_overlay(fig, ax, annot, lookup, min_interval=HOVER_MIN_INTERVAL):
+    """
+    Collega un tooltip al movimento del mouse su ax.
+    lookup(event) ritorna (chiave, xy, testo) oppure None se non c'è nulla da
+    mostrare. Il tooltip viene aggiornato solo quando cambia la chiave (nuovo
+    pixel o nuovo punto), ridisegnando col blitting sopra lo sfondo in cache
+    e al più una volta ogni min_interval secondi; l'ultimo stato viene
+    comunque mostrato allo scadere dell'intervallo.
+    """
+    state = _overlay_state(fig)
+    annot.set_animated(True)
+    annot.set_visible(False)
+    state["annots"].append(annot)
+    current = {"key": None}
+
+    def flush():
+        state["timer"] = None
+        _blit_overlays(fig, state)
+
+    def on_move(event):
+        hit = lookup(event) if event.inaxes == ax else None
+        key = hit[0] if hit is not None else None
+        if key == current["key"]:
+            return
+        current["key"] = key
+
+        if hit is None:
+            annot.set_visible(False)
+        else:
+            annot.xy = hit[1]
+            annot.set_text(hit[2])
+            annot.set_visible(True)
+
+        wait = min_interval - (time.monotonic() - state["last"])
+        if wait <= 0:
+            _blit_overlays(fig, state)
+        elif state["timer"] is None:
+            timer = fig.canvas.new_timer(interval=int(wait * 1000) + 1)
+            timer.single_shot = True
+            timer.add_callback(flush)
+            state["timer"] = timer
+            timer.start()
+
+    fig.canvas.mpl_connect("motion_notify_event", on_move)
+
+
+def _pixel_at(event, shape):
+    """(riga, colonna) del pixel sotto il mouse oppure None se fuori raster."""
+    if event.xdata is None or event.ydata is None:
+        return None
+    col = int(round(event.xdata))
+    row = int(round(event.ydata))
+    h, w = shape[:2]
+    if 0 <= row < h and 0 <= col < w:
+        return row, col
+    return None
+
+
 def _attach_hover(fig, ax, array_2d, label_prefix="val"):
     annot = ax.annotate(
         "", xy=(0, 0),
@@ -1191,30 +2634,20 @@ def _attach_hover(fig, ax, array_2d, label_prefix="val"):
         fontsize=7.5, color="#e0e8ff",
         arrowprops=dict(arrowstyle="->", color="#4488ff", lw=0.7),
     )
-    annot.set_visible(False)
 
-    def on_move(event):
-        if event.inaxes != ax:
-            annot.set_visible(False)
-            fig.canvas.draw_idle()
-            return
-        col = int(round(event.xdata)) if event.xdata is not None else -1
-        row = int(round(event.ydata)) if event.ydata is not None else -1
-        h, w = array_2d.shape
-        if 0 <= row < h and 0 <= col < w:
-            val = array_2d[row, col]
-            if np.isnan(val):
-                txt = f"({col}, {row})\n— fuori maschera —"
-            else:
-                txt = f"({col}, {row})\n{label_prefix}: {val:.4f}"
-            annot.set_text(txt)
-            annot.xy = (event.xdata, event.ydata)
-            annot.set_visible(True)
+    def lookup(event):
+        px = _pixel_at(event, array_2d.shape)
+        if px is None:
+            return None
+        row, col = px
+        val = array_2d[row, col]
+        if np.isnan(val):
+            txt = f"({col}, {row})\n— fuori maschera —"
         else:
-            annot.set_visible(False)
-        fig.canvas.draw_idle()
+            txt = f"({col}, {row})\n{label_prefix}: {val:.4f}"
+        return px, (col, row), txt
 
-    fig.canvas.mpl_connect("motion_notify_event", on_move)
+    _attach_overlay(fig, ax, annot, lookup)
 
 
 def _attach_hover_mask(fig, ax, mask_2d):
@@ -1225,118 +2658,381 @@ def _attach_hover_mask(fig, ax, mask_2d):
         fontsize=7.5, color="#ccffcc",
         arrowprops=dict(arrowstyle="->", color="#44bb44", lw=0.7),
     )
-    annot.set_visible(False)
 
-    def on_move(event):
-        if event.inaxes != ax:
-            annot.set_visible(False)
-            fig.canvas.draw_idle()
-            return
-        col = int(round(event.xdata)) if event.xdata is not None else -1
-        row = int(round(event.ydata)) if event.ydata is not None else -1
-        h, w = mask_2d.shape
-        if 0 <= row < h and 0 <= col < w:
-            is_tree = bool(mask_2d[row, col])
-            lbl = "Chioma arborea" if is_tree else "Non chioma"
-            annot.set_text(f"({col}, {row})\n{lbl}")
-            annot.xy = (event.xdata, event.ydata)
-            annot.set_visible(True)
-        else:
-            annot.set_visible(False)
-        fig.canvas.draw_idle()
+    def lookup(event):
+        px = _pixel_at(event, mask_2d.shape)
+        if px is None:
+            return None
+        row, col = px
+        lbl = "Chioma arborea" if bool(mask_2d[row, col]) else "Non chioma"
+        return px, (col, row), f"({col}, {row})\n{lbl}"
 
-    fig.canvas.mpl_connect("motion_notify_event", on_move)
+    _attach_overlay(fig, ax, annot, lookup)
 
 
-# ================= FIGURA UNIFICATA: MAPPA + COPERTURA + TREND =================
+# ================= PIRAMIDE DI VISUALIZZAZIONE =================
 
-def show_index_unified(token, polygon, width, height,
-                       mode, start, end,
-                       step_days=10,
-                       tree_focused=False,
-                       tree_params=None,
-                       data_file=None):
-    if tree_params is None:
-        tree_params = dict(TREE_MASK_DEFAULTS)
+DISPLAY_DPI    = 150       # dpi dei PNG salvati, usati per dimensionare i livelli
+DISPLAY_SAMPLE = 200_000   # pixel campionati per stimare i percentili del colormap
 
-    info = INDEX_DESCRIPTIONS.get(mode, {})
-    cmap, vmin, vmax = get_colormap_and_range(mode)
+# Livelli già calcolati per raster (chiave id dell'array, rimossa quando
+# l'array viene liberato)
+_display_pyramids = {}
 
-    # ------------------------------------------------------------------ #
-    # 1. Mappa media sull'intero periodo
-    # ------------------------------------------------------------------ #
-    s_full = f"{start}T00:00:00Z" if "T" not in start else start
-    e_full = f"{end}T23:59:59Z"   if "T" not in end   else end
 
-    print(f"\n[{mode.upper()}] Scarico mappa periodo intero {start} → {end} ...")
-    url, headers, payload = make_request(
-        token, polygon, width, height,
-        s_full, e_full, mode,
-        tree_focused=tree_focused,
-    )
-    img_full = download_image(url, headers, payload)
-    map_array, mask_array, mean_full, mean_label = extract_array_and_mean(
-        img_full, mode, tree_focused, tree_params
-    )
+def _reduce_half(arr):
+    """
+    Dimezza il raster aggregando blocchi 2x2: media dei pixel validi per i
+    float (NaN se il blocco è tutto NaN), "almeno uno" per le maschere,
+    media arrotondata per gli interi (RGB). Le righe/colonne dispari vengono
+    completate per non perdere il bordo.
+    """
+    if arr.dtype != bool and not np.issubdtype(arr.dtype, np.floating):
+        return np.round(_reduce_half(arr.astype(np.float32))).astype(arr.dtype)
+
+    h, w = arr.shape[:2]
+    ph, pw = h % 2, w % 2
+    fill = False if arr.dtype == bool else np.nan
+    if ph or pw:
+        pad = [(0, ph), (0, pw)] + [(0, 0)] * (arr.ndim - 2)
+        arr = np.pad(arr, pad, constant_values=fill)
+    blocks = arr.reshape((arr.shape[0] // 2, 2, arr.shape[1] // 2, 2) + arr.shape[2:])
+
+    if arr.dtype == bool:
+        return blocks.any(axis=(1, 3))
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (total / count).astype(arr.dtype)
+
+
+def display_level(arr, target_h, target_w):
+    """
+    Livello della piramide da mostrare in un'area di target_h x target_w pixel:
+    il più piccolo che non scende sotto la risoluzione dell'area. I livelli
+    sono calcolati una sola volta per raster e riusati.
+    """
+    key = id(arr)
+    levels = _display_pyramids.get(key)
+    if levels is None:
+        levels = [arr]
+        _display_pyramids[key] = levels
+        weakref.finalize(arr, _display_pyramids.pop, key, None)
+
+    i = 0
+    while True:
+        h, w = levels[i].shape[:2]
+        if (h + 1) // 2 < target_h or (w + 1) // 2 < target_w or min(h, w) < 2:
+            return levels[i]
+        if i + 1 == len(levels):
+            levels.append(_reduce_half(levels[i]))
+        i += 1
+
+
+def _axes_pixels(fig, ax, dpi=DISPLAY_DPI):
+    """(altezza, larghezza) in pixel dell'area di ax nel PNG salvato."""
+    pos = ax.get_position()
+    fw, fh = fig.get_size_inches()
+    dpi = max(dpi, fig.dpi)
+    return max(1, int(pos.height * fh * dpi)), max(1, int(pos.width * fw * dpi))
+
+
+def _raster_extent(arr):
+    """Extent che mantiene le coordinate in pixel del raster a piena risoluzione."""
+    h, w = arr.shape[:2]
+    return (-0.5, w - 0.5, h - 0.5, -0.5)
+
+
+def robust_range(arr, lo=2, hi=98, sample=DISPLAY_SAMPLE):
+    """
+    Percentili lo/hi dei pixel validi stimati su un campione deterministico
+    di al più sample pixel (seed fisso: stessa mappa, stessi colori).
+    Ritorna None se non ci sono pixel validi.
+    """
+    flat = arr.ravel()
+    if flat.size > sample:
+        idx = np.random.default_rng(0).integers(0, flat.size, sample)
+        picked = flat[idx]
+        picked = picked[~np.isnan(picked)]
+        if len(picked) == 0:
+            # raster quasi tutto fuori maschera: il campione non basta
+            picked = flat[~np.isnan(flat)]
+    else:
+        picked = flat[~np.isnan(flat)]
+    if len(picked) == 0:
+        return None
+    p_lo, p_hi = np.percentile(picked, [lo, hi])
+    return float(p_lo), float(p_hi)
+
+
+# ================= FIGURA UNIFICATA: MAPPA + COPERTURA + TREND =================
+
+@traced("indice.download")
+def fetch_index_data(token, polygon, width, height,
+                     mode, start, end,
+                     step_days=10,
+                     tree_focused=False,
+                     tree_params=None,
+                     data_file=None,
+                     dedup_stats=None,
+                     field_key=None,
+                     journal=None,
+                     acquire=None,
+                     skip=None):
+    """
+    Scarica trend e mappa del periodo di un indice.
+    Ritorna la specifica della figura per render_index_figure.
+    token può essere una funzione che ritorna un token valido, così un
+    backfill lungo lo rinnova alla scadenza. Con journal (open_backfill) i
+    task già conclusi vengono saltati: si riparte dalla prima finestra
+    incompleta e la mappa del periodo, scaricata per ultima, non viene
+    richiesta di nuovo se già registrata. acquire, se presente, viene
+    chiamata prima di ogni richiesta (limitatore condiviso); senza, pausa
+    fissa dopo ogni finestra. Le finestre in skip (senza acquisizioni utili
+    nel catalogo) valgono NaN senza richieste.
+    """
+    if tree_params is None:
+        tree_params = dict(TREE_MASK_DEFAULTS)
+    get_token = token if callable(token) else (lambda: token)
 
     # ------------------------------------------------------------------ #
-    # 2. Dati temporali: un punto ogni step_days giorni
+    # 1. Dati temporali: un punto ogni step_days giorni
     # ------------------------------------------------------------------ #
-    start_dt = datetime.fromisoformat(start)
-    end_dt   = datetime.fromisoformat(end)
+    stored = {}
+    if data_file and os.path.exists(data_file):
+        points = load_datapoints(data_file, tree_focused=tree_focused, field_key=field_key)
+        stored = {(p["start"], p["end"]): p["value"] for p in points.get(mode, [])}
 
+    print(f"\n[{mode.upper()}] Trend {start} → {end} ogni {step_days} giorni ...")
     dates_pts  = []
     values_pts = []
-    current    = start_dt
+    resumed    = 0
 
-    while current <= end_dt:
-        win_end = min(current + relativedelta(days=step_days), end_dt)
-        s_w = current.isoformat() + "Z"
-        e_w = win_end.isoformat() + "Z"
+    for current, win_end in trend_windows(start, end, step_days):
         s_w_date = current.strftime("%Y-%m-%d")
         e_w_date = win_end.strftime("%Y-%m-%d")
 
-        # Controlla se già salvato nel CSV
-        cached = None
-        if data_file:
-            cached_dict = load_period_means(data_file, s_w_date, e_w_date, tree_focused)
-            if cached_dict and mode in cached_dict:
-                cached = cached_dict[mode]
-                print(f"  trend {s_w_date} → {e_w_date} ... {cached:.4f}  [da CSV]")
-
-        if cached is None:
-            print(f"  trend {s_w_date} → {e_w_date} ...", end=" ", flush=True)
-            url_w, hdr_w, pay_w = make_request(
-                token, polygon, width, height,
-                s_w, e_w, mode,
+        done = journal_get(journal, mode, "window", s_w_date, e_w_date)
+        if done is not None:
+            value    = done["value"] if done["value"] is not None else np.nan
+            resumed += 1
+        elif (s_w_date, e_w_date) in stored:
+            value = stored[(s_w_date, e_w_date)]
+            print(f"  {mode.upper()} trend {s_w_date} → {e_w_date} ... {value:.4f}  [da CSV]")
+        elif skip and (s_w_date, e_w_date) in skip:
+            value = np.nan
+            print(f"  {mode.upper()} trend {s_w_date} → {e_w_date} ... nessuna acquisizione  "
+                  "[catalogo]")
+        else:
+            if resumed:
+                print(f"  {mode.upper()}: {resumed} finestre già concluse nel journal")
+                resumed = 0
+            if acquire is not None:
+                with span("attesa"):
+                    acquire()
+            with span("finestra", index=mode, start=s_w_date):
+                value = fetch_window_mean(get_token(), polygon, width, height, mode,
+                                          current, win_end, tree_focused, tree_params)
+            if value is None:
+                journal_set(journal, mode, "window", s_w_date, e_w_date, "failed")
+                value = np.nan
+                outcome = "richiesta fallita"
+            elif np.isnan(value):
+                journal_set(journal, mode, "window", s_w_date, e_w_date, "empty")
+                outcome = "no data"
+            else:
+                # prima il CSV, poi il journal: un task "done" ha sempre il suo dato
+                if data_file:
+                    _save_and_count(dedup_stats, data_file, s_w_date, e_w_date,
+                                    tree_focused, mode, value, field_key=field_key)
+                journal_set(journal, mode, "window", s_w_date, e_w_date, "done", value)
+                outcome = f"{value:.4f}"
+            # riga unica: con i worker degli indici l'output è interlacciato
+            print(f"  {mode.upper()} trend {s_w_date} → {e_w_date} ... {outcome}  "
+                  f"{journal_progress(journal)}".rstrip(), flush=True)
+            if acquire is None:
+                with span("attesa"):
+                    time.sleep(0.4)
+
+        dates_pts.append(current)
+        values_pts.append(value)
+
+    if resumed:
+        print(f"  {mode.upper()}: {resumed} finestre già concluse nel journal")
+
+    # ------------------------------------------------------------------ #
+    # 2. Mappa media sull'intero periodo
+    # ------------------------------------------------------------------ #
+    done  = journal_get(journal, mode, "map", start, end)
+    saved = load_journal_map(journal, mode) if done is not None else None
+    if saved is not None:
+        print("  mappa periodo intero già registrata nel journal: richiesta saltata")
+        map_array, mask_array, georef = saved
+        mean_full  = done["value"]
+        mean_label = "chiome arboree" if tree_focused else "campo intero"
+    else:
+        s_full = f"{start}T00:00:00Z" if "T" not in start else start
+        e_full = f"{end}T23:59:59Z"   if "T" not in end   else end
+
+        if acquire is not None:
+            with span("attesa"):
+                acquire()
+        with span("mappa", index=mode):
+            url, headers, payload = make_request(
+                get_token(), polygon, width, height,
+                s_full, e_full, mode,
                 tree_focused=tree_focused,
             )
-            img_w = download_image(url_w, hdr_w, pay_w)
-            _, _, mean_w, _ = extract_array_and_mean(img_w, mode, tree_focused, tree_params)
-            mean_w_val = mean_w if mean_w is not None else np.nan
-            print(f"{mean_w_val:.4f}" if not np.isnan(mean_w_val) else "no data")
+            img_full = download_image(url, headers, payload)
+            map_array, mask_array, mean_full, mean_label = extract_array_and_mean(
+                img_full, mode, tree_focused, tree_params
+            )
+        georef = (raster_georef(img_full, polygon, map_array.shape)
+                  if map_array is not None else None)
+        # prima il raster, poi il journal: una mappa "done" ha sempre la sua figura
+        save_journal_map(journal, mode, map_array, mask_array, georef)
+        journal_set(journal, mode, "map", start, end,
+                    "failed" if img_full is None else "done", mean_full)
+        if img_full is None:
+            outcome = "richiesta fallita"
+        else:
+            outcome = f"{mean_full:.4f}" if mean_full is not None else "no data"
+        print(f"  {mode.upper()} mappa periodo intero {start} → {end} ... {outcome}  "
+              f"{journal_progress(journal)}".rstrip(), flush=True)
 
-            # Salva nel CSV
-            if data_file and not np.isnan(mean_w_val):
-                save_datapoint(data_file, s_w_date, e_w_date, tree_focused, mode, mean_w_val)
+    return {
+        "mode":         mode,
+        "start":        start,
+        "end":          end,
+        "step_days":    step_days,
+        "tree_focused": tree_focused,
+        "map_array":    map_array,
+        "mask_array":   mask_array,
+        "georef":       georef,
+        "mean_full":    mean_full,
+        "mean_label":   mean_label,
+        "dates_pts":    dates_pts,
+        "values_pts":   values_pts,
+    }
 
-            cached = mean_w_val
 
-        dates_pts.append(current)
-        values_pts.append(cached)
-        current += relativedelta(days=step_days)
-        time.sleep(0.4)
+# ================= TEMPLATE FIGURE =================
 
-    # ------------------------------------------------------------------ #
-    # 3. Costruzione figura matplotlib
-    # ------------------------------------------------------------------ #
-    period_label = f"{start} → {end}"
-    tree_tag     = "  [chiome arboree]" if tree_focused else ""
+# Figure già impaginate riusate dai render senza finestra (una per layout e
+# per processo): per ogni indice si aggiornano solo dati, limiti e testi
+_figure_templates = {}
+
+# zlib 1 invece del 6 di Pillow: a 150 dpi la codifica PNG costava quanto il
+# disegno della figura, per file al più ~25% più grandi
+PNG_COMPRESS_LEVEL = 1
 
-    fig = plt.figure(figsize=(16, 10) if tree_focused else (14, 10))
+
+def _score_color(score):
+    return ("#66dd66" if (score or 0) >= 70
+            else "#eecc44" if (score or 0) >= 45
+            else "#ee4444")
+
+
+def _new_figure(figsize, reuse):
+    """Figura pyplot per la visualizzazione, Figure isolata se va riusata."""
+    if reuse:
+        from matplotlib.figure import Figure
+
+        return Figure(figsize=figsize)
+    import matplotlib.pyplot as plt
+
+    return plt.figure(figsize=figsize)
+
+
+def _build_trend_panel(ax):
+    """Assi del trend con stile, linea, media e testo "nessun dato"."""
+    ax.set_facecolor("#0d0d20")
+    ax.tick_params(colors="#888899", labelsize=8)
+    ax.set_xlabel("Data", color="#888899", fontsize=8)
+    for spine in ax.spines.values():
+        spine.set_edgecolor("#2a2a4a")
+    ax.grid(True, color="#1e1e3a", linewidth=0.6)
+    ax.xaxis_date()
+
+    line, = ax.plot([], [], color="#5588ff", lw=2, marker="o", ms=6,
+                    zorder=3, picker=5)
+    mean_line = ax.axhline(0, color="#eecc44", lw=1.2, linestyle="--", alpha=0.75)
+    nodata = ax.text(
+        0.5, 0.5, "Nessun dato temporale disponibile",
+        transform=ax.transAxes, ha="center", va="center",
+        fontsize=9, color="#888899",
+    )
+    return {"ax": ax, "line": line, "mean": mean_line, "nodata": nodata,
+            "fill": None, "labels": []}
+
+
+def _fill_trend_panel(panel, dates_ok, vals_ok, mean_val, line_label, vmin, vmax):
+    """Aggiorna linea, area, media, etichette dei punti, limiti e legenda."""
+    import matplotlib.dates as mdates
+
+    ax  = panel["ax"]
+    has = len(vals_ok) > 0
+    x   = mdates.date2num(dates_ok) if has else np.array([])
+
+    panel["line"].set_data(x, vals_ok)
+    panel["line"].set_label(line_label)
+    panel["line"].set_visible(has)
+
+    if panel["fill"] is not None:
+        panel["fill"].remove()
+        panel["fill"] = None
+    if has:
+        panel["fill"] = ax.fill_between(x, vals_ok, alpha=0.10, color="#5588ff")
+
+    show_mean = has and mean_val is not None
+    panel["mean"].set_visible(show_mean)
+    if show_mean:
+        panel["mean"].set_ydata([mean_val, mean_val])
+        panel["mean"].set_label(f"Media periodo ({mean_val:.4f})")
+
+    # Etichette statiche sui punti: riusa quelle già create, nasconde le altre
+    labels = panel["labels"]
+    while len(labels) < len(vals_ok):
+        labels.append(ax.annotate(
+            "", xy=(0, 0), xytext=(0, 9), textcoords="offset points",
+            ha="center", fontsize=6.5, color="#ccccee",
+        ))
+    for i, annot in enumerate(labels):
+        if i < len(vals_ok):
+            annot.xy = (x[i], vals_ok[i])
+            annot.set_text(f"{vals_ok[i]:.3f}")
+            annot.set_visible(True)
+        else:
+            annot.set_visible(False)
+
+    panel["nodata"].set_visible(not has)
+    legend = ax.get_legend()
+    if legend is not None:
+        legend.remove()
+    if has:
+        ax.relim(visible_only=True)
+        ax.autoscale_view(scaley=False)
+        ax.set_ylim(
+            min(vals_ok) - abs(vmax - vmin) * 0.15,
+            max(vals_ok) + abs(vmax - vmin) * 0.22,
+        )
+        handles = [panel["line"]] + ([panel["mean"]] if show_mean else [])
+        ax.legend(handles=handles,
+                  facecolor="#1a1a3a", edgecolor="#3355aa",
+                  labelcolor="#d0d0f0", fontsize=8)
+
+
+def _build_index_template(with_mask, reuse):
+    """Impaginazione mappa (+ copertura chiome) + trend, senza dati."""
+    import matplotlib.gridspec as gridspec
+    from matplotlib.colors import LinearSegmentedColormap
+    from matplotlib.patches import Patch
+
+    fig = _new_figure((16, 10) if with_mask else (14, 10), reuse)
     fig.patch.set_facecolor("#0a0a14")
 
-    if tree_focused and mask_array is not None:
+    if with_mask:
         gs = gridspec.GridSpec(
             2, 2,
             height_ratios=[1.6, 1],
@@ -1359,28 +3055,155 @@ def show_index_unified(token, polygon, width, height,
         ax_mask = None
         ax_line = fig.add_subplot(gs[1])
 
-    fig.suptitle(
-        f"{info.get('title', mode.upper())}   —   {period_label}{tree_tag}",
-        fontsize=11, color="#ffffff", y=0.97,
-    )
+    tpl = {"fig": fig, "ax_map": ax_map, "ax_mask": ax_mask}
+    tpl["suptitle"] = fig.suptitle("", fontsize=11, color="#ffffff", y=0.97)
 
     # Pannello A: mappa indice
     ax_map.set_facecolor("#0a0a14")
     ax_map.axis("off")
-    map_title = (
+    tpl["map_title"] = ax_map.set_title("", fontsize=9, color="#a8d8ff", pad=5)
+    tpl["im"] = ax_map.imshow(np.zeros((1, 1)), aspect="auto")
+    cbar = fig.colorbar(tpl["im"], ax=ax_map, fraction=0.025, pad=0.01)
+    cbar.ax.tick_params(color="#aaa", labelcolor="#ccc", labelsize=7)
+    tpl["cbar"] = cbar
+    # label range reale sotto la colorbar
+    tpl["cbar_range"] = cbar.ax.text(
+        0.5, -0.02, "",
+        transform=cbar.ax.transAxes, ha="center", va="top",
+        fontsize=6, color="#888899",
+    )
+    tpl["map_mean"] = ax_map.text(
+        0.5, -0.025, "",
+        transform=ax_map.transAxes, ha="center", va="top",
+        fontsize=8.5, color="#1a1a1a",
+        bbox=dict(boxstyle="round,pad=0.3",
+                  facecolor="#66dd66", alpha=0.88, edgecolor="none"),
+    )
+    tpl["formula"] = ax_map.text(
+        0.01, 0.98, "",
+        transform=ax_map.transAxes, ha="left", va="top",
+        fontsize=7, color="#ffe08a", fontfamily="monospace",
+        bbox=dict(boxstyle="round,pad=0.25", facecolor="#1a1a3a",
+                  edgecolor="#4455aa", lw=0.8, alpha=0.85),
+    )
+    tpl["map_nodata"] = ax_map.text(
+        0.5, 0.5, "Nessuna immagine disponibile",
+        transform=ax_map.transAxes, ha="center", va="center",
+        fontsize=10, color="#888899",
+    )
+
+    # Pannello B: mappa copertura chiome
+    if ax_mask is not None:
+        ax_mask.set_facecolor("#0a0a14")
+        ax_mask.axis("off")
+        tpl["mask_title"] = ax_mask.set_title("", fontsize=9, color="#88ffaa", pad=5)
+        # sfondo uniforme (grigio scuro al 25% sul fondo della figura)
+        tpl["mask_bg"] = ax_mask.imshow([[0.0]], cmap="gray", vmin=0, vmax=1,
+                                        aspect="auto", alpha=0.25)
+        cmap_tree = LinearSegmentedColormap.from_list(
+            "tree_cover", [(0.0, (0.1, 0.45, 0.1)), (1.0, (0.35, 0.95, 0.35))]
+        )
+        tpl["mask_im"] = ax_mask.imshow(np.full((1, 1), np.nan), cmap=cmap_tree,
+                                        vmin=0, vmax=1, aspect="auto", alpha=0.9)
+        legend_elements = [
+            Patch(facecolor="#44bb44", edgecolor="none", label="Chioma arborea"),
+            Patch(facecolor="#333344", edgecolor="none", label="Non chioma"),
+        ]
+        ax_mask.legend(
+            handles=legend_elements, loc="lower right",
+            facecolor="#1a1a3a", edgecolor="#3355aa",
+            labelcolor="#d0d0f0", fontsize=7,
+        )
+        tpl["mask_text"] = ax_mask.text(
+            0.5, -0.025, "",
+            transform=ax_mask.transAxes, ha="center", va="top",
+            fontsize=8, color="#bbffbb",
+            bbox=dict(boxstyle="round,pad=0.3",
+                      facecolor="#0d2a0d", alpha=0.88, edgecolor="none"),
+        )
+
+    # Pannello C: grafico trend
+    tpl["trend"] = _build_trend_panel(ax_line)
+    tpl["line_title"] = ax_line.set_title("", fontsize=9, color="#a8d8ff", pad=4)
+    return tpl
+
+
+def _index_template(with_mask, reuse):
+    key = ("index", with_mask)
+    if reuse and key in _figure_templates:
+        return _figure_templates[key]
+    tpl = _build_index_template(with_mask, reuse)
+    if reuse:
+        _figure_templates[key] = tpl
+    return tpl
+
+
+def _show_raster(ax, im, level, full):
+    """Mostra level nelle coordinate in pixel di full e adatta i limiti."""
+    extent = _raster_extent(full)
+    im.set_data(level)
+    im.set_extent(extent)
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+
+
+@traced("matplotlib")
+def render_index_figure(spec, show=True):
+    """
+    Costruisce la figura mappa + copertura + trend e la salva in PNG.
+    Con show=False non apre finestre e non collega gli handler interattivi:
+    la figura impaginata viene riusata per gli indici successivi
+    aggiornandone solo dati e testi.
+    Ritorna il nome del file salvato.
+    """
+    mode         = spec["mode"]
+    start, end   = spec["start"], spec["end"]
+    step_days    = spec["step_days"]
+    tree_focused = spec["tree_focused"]
+    map_array    = spec["map_array"]
+    mask_array   = spec["mask_array"]
+    mean_full    = spec["mean_full"]
+    mean_label   = spec["mean_label"]
+    dates_pts    = spec["dates_pts"]
+    values_pts   = spec["values_pts"]
+    end_dt       = datetime.fromisoformat(end)
+
+    info = INDEX_DESCRIPTIONS.get(mode, {})
+    cmap, vmin, vmax = get_colormap_and_range(mode)
+
+    # ------------------------------------------------------------------ #
+    # 3. Figura matplotlib (template) e aggiornamento dei contenuti
+    # ------------------------------------------------------------------ #
+    period_label = f"{start} → {end}"
+    tree_tag     = "  [chiome arboree]" if tree_focused else ""
+
+    tpl = _index_template(bool(tree_focused and mask_array is not None), reuse=not show)
+    fig, ax_map, ax_mask = tpl["fig"], tpl["ax_map"], tpl["ax_mask"]
+
+    tpl["suptitle"].set_text(
+        f"{info.get('title', mode.upper())}   —   {period_label}{tree_tag}"
+    )
+
+    # Pannello A: mappa indice
+    tpl["map_title"].set_text(
         f"Mappa {mode.upper()} — solo chiome arboree"
         if tree_focused else
         f"Mappa {mode.upper()} — periodo completo"
     )
-    ax_map.set_title(map_title, fontsize=9, color="#a8d8ff", pad=5)
+    has_map = map_array is not None
+    for artist in (tpl["im"], tpl["cbar"].ax, tpl["formula"]):
+        artist.set_visible(has_map)
+    tpl["map_nodata"].set_visible(not has_map)
+    tpl["map_mean"].set_visible(has_map and mean_full is not None)
 
-    if map_array is not None:
+    if has_map:
         # Normalizzazione robusta: usa percentile 2-98 sui pixel validi
         # per evitare che outlier schiaccino tutti i colori su un valore uniforme
-        valid_px = map_array[~np.isnan(map_array)]
-        if len(valid_px) > 0:
-            p2  = float(np.percentile(valid_px, 2))
-            p98 = float(np.percentile(valid_px, 98))
+        # (stimati su un campione: il costo non dipende dalla dimensione dell'AOI)
+        with span("percentili"):
+            p_range = robust_range(map_array)
+        if p_range is not None:
+            p2, p98 = p_range
             # Se la varianza è troppo bassa forza un range minimo
             if (p98 - p2) < 0.01:
                 mid = (p98 + p2) / 2
@@ -1391,104 +3214,59 @@ def show_index_unified(token, polygon, width, height,
         else:
             disp_vmin, disp_vmax = vmin, vmax
 
-        im = ax_map.imshow(map_array, cmap=cmap, vmin=disp_vmin, vmax=disp_vmax, aspect="auto")
-        cbar = fig.colorbar(im, ax=ax_map, fraction=0.025, pad=0.01)
-        cbar.ax.yaxis.set_tick_params(color="#aaa")
-        plt.setp(cbar.ax.yaxis.get_ticklabels(), color="#ccc", fontsize=7)
-        # Aggiungi label range reale sotto la colorbar
-        cbar.ax.text(
-            0.5, -0.02, f"[{disp_vmin:.3f} – {disp_vmax:.3f}]",
-            transform=cbar.ax.transAxes, ha="center", va="top",
-            fontsize=6, color="#888899",
-        )
-        _attach_hover(fig, ax_map, map_array, label_prefix=mode.upper())
+        # Viene disegnato il livello della piramide adatto alla dimensione del
+        # pannello; l'extent mantiene le coordinate a piena risoluzione per l'hover
+        im = tpl["im"]
+        _show_raster(ax_map, im, display_level(map_array, *_axes_pixels(fig, ax_map)),
+                     map_array)
+        im.set_cmap(cmap)
+        im.set_clim(disp_vmin, disp_vmax)
+        tpl["cbar"].update_normal(im)
+        tpl["cbar_range"].set_text(f"[{disp_vmin:.3f} – {disp_vmax:.3f}]")
+        if show:
+            _attach_hover(fig, ax_map, map_array, label_prefix=mode.upper())
 
         if mean_full is not None:
-            score   = normalize_to_score(mode, mean_full)
-            sc_col  = ("#66dd66" if (score or 0) >= 70
-                       else "#eecc44" if (score or 0) >= 45
-                       else "#ee4444")
+            score     = normalize_to_score(mode, mean_full)
             score_str = f"  |  score {score:.0f}/100" if score is not None else ""
-            ax_map.text(
-                0.5, -0.025,
+            tpl["map_mean"].set_text(
                 f"Media {mean_label}: {mean_full:.4f}{score_str}"
-                f"   —   {evaluate_index(mode, mean_full)}",
-                transform=ax_map.transAxes, ha="center", va="top",
-                fontsize=8.5, color="#1a1a1a",
-                bbox=dict(boxstyle="round,pad=0.3",
-                          facecolor=sc_col, alpha=0.88, edgecolor="none"),
+                f"   —   {evaluate_index(mode, mean_full)}"
             )
+            tpl["map_mean"].get_bbox_patch().set_facecolor(_score_color(score))
 
         formula = info.get("formula", "")
-        if formula:
-            ax_map.text(
-                0.01, 0.98, formula,
-                transform=ax_map.transAxes, ha="left", va="top",
-                fontsize=7, color="#ffe08a", fontfamily="monospace",
-                bbox=dict(boxstyle="round,pad=0.25", facecolor="#1a1a3a",
-                          edgecolor="#4455aa", lw=0.8, alpha=0.85),
-            )
-    else:
-        ax_map.text(0.5, 0.5, "Nessuna immagine disponibile",
-                    transform=ax_map.transAxes, ha="center", va="center",
-                    fontsize=10, color="#888899")
+        tpl["formula"].set_text(formula)
+        tpl["formula"].set_visible(bool(formula))
 
     # Pannello B: mappa copertura chiome
-    if ax_mask is not None and mask_array is not None:
-        ax_mask.set_facecolor("#0a0a14")
-        ax_mask.axis("off")
+    if ax_mask is not None:
         total_px  = mask_array.size
-        tree_px   = int(np.sum(mask_array))
+        tree_px   = int(np.count_nonzero(mask_array))
         cover_pct = tree_px / total_px * 100.0
-        ax_mask.set_title(
-            f"Copertura chiome  ({cover_pct:.1f}% del raster)",
-            fontsize=9, color="#88ffaa", pad=5,
-        )
-        mask_display = np.where(mask_array, 1.0, np.nan)
-        bg = np.zeros_like(mask_array, dtype=float)
-        ax_mask.imshow(bg, cmap="gray", vmin=0, vmax=1, aspect="auto", alpha=0.25)
-        cmap_tree = LinearSegmentedColormap.from_list(
-            "tree_cover", [(0.0, (0.1, 0.45, 0.1)), (1.0, (0.35, 0.95, 0.35))]
-        )
-        ax_mask.imshow(mask_display, cmap=cmap_tree, vmin=0, vmax=1,
-                       aspect="auto", alpha=0.9)
-        _attach_hover_mask(fig, ax_mask, mask_array)
-        legend_elements = [
-            Patch(facecolor="#44bb44", edgecolor="none", label="Chioma arborea"),
-            Patch(facecolor="#333344", edgecolor="none", label="Non chioma"),
-        ]
-        ax_mask.legend(
-            handles=legend_elements, loc="lower right",
-            facecolor="#1a1a3a", edgecolor="#3355aa",
-            labelcolor="#d0d0f0", fontsize=7,
-        )
-        ax_mask.text(
-            0.5, -0.025,
-            f"Pixel chiome: {tree_px:,} / {total_px:,}  ({cover_pct:.1f}%)",
-            transform=ax_mask.transAxes, ha="center", va="top",
-            fontsize=8, color="#bbffbb",
-            bbox=dict(boxstyle="round,pad=0.3",
-                      facecolor="#0d2a0d", alpha=0.88, edgecolor="none"),
+        tpl["mask_title"].set_text(f"Copertura chiome  ({cover_pct:.1f}% del raster)")
+        mask_level = display_level(mask_array, *_axes_pixels(fig, ax_mask))
+        tpl["mask_bg"].set_extent(_raster_extent(mask_array))
+        _show_raster(ax_mask, tpl["mask_im"], np.where(mask_level, 1.0, np.nan), mask_array)
+        if show:
+            _attach_hover_mask(fig, ax_mask, mask_array)
+        tpl["mask_text"].set_text(
+            f"Pixel chiome: {tree_px:,} / {total_px:,}  ({cover_pct:.1f}%)"
         )
 
     # Pannello C: grafico trend INTERATTIVO
-    ax_line.set_facecolor("#0d0d20")
-    ax_line.tick_params(colors="#888899", labelsize=8)
-    ax_line.set_xlabel("Data", color="#888899", fontsize=8)
+    trend   = tpl["trend"]
+    ax_line = trend["ax"]
     trend_label = (
         f"Valore medio {mode.upper()}  (chiome arboree)"
         if tree_focused else
         f"Valore medio {mode.upper()}  (campo intero)"
     )
     ax_line.set_ylabel(trend_label, color="#888899", fontsize=8)
-    for spine in ax_line.spines.values():
-        spine.set_edgecolor("#2a2a4a")
-    ax_line.grid(True, color="#1e1e3a", linewidth=0.6)
-    ax_line.set_title(
+    tpl["line_title"].set_text(
         f"Andamento temporale — finestre di {step_days} giorni"
         + ("  [calcolato su chiome]" if tree_focused else "")
-        + "   [🔍 zoom: scroll · pan: tasto centrale]",
-        fontsize=9, color="#a8d8ff", pad=4,
+        + "   [🔍 zoom: scroll · pan: tasto centrale]"
     )
 
     vals_arr = np.array(values_pts, dtype=float)
@@ -1496,181 +3274,167 @@ def show_index_unified(token, polygon, width, height,
     dates_ok = [d for d, ok in zip(dates_pts, mask_ok) if ok]
     vals_ok  = vals_arr[mask_ok]
 
-    if len(vals_ok) > 0:
-        line_obj, = ax_line.plot(
-            dates_ok, vals_ok,
-            color="#5588ff", lw=2, marker="o", ms=6,
-            zorder=3, label=f"{mode.upper()} {'chiome' if tree_focused else 'campo'}",
-            picker=5,
+    _fill_trend_panel(trend, dates_ok, vals_ok, mean_full,
+                      f"{mode.upper()} {'chiome' if tree_focused else 'campo'}", vmin, vmax)
+    if show and len(vals_ok) > 0:
+        _attach_trend_interaction(fig, ax_line, trend["line"], dates_ok, vals_ok,
+                                  mode, step_days, end_dt)
+
+    fname = f"analisi_{mode}{'_tree' if tree_focused else ''}.png"
+    with span("matplotlib.savefig"):
+        fig.savefig(fname, dpi=150, bbox_inches="tight", facecolor="#0a0a14",
+                    pil_kwargs={"compress_level": PNG_COMPRESS_LEVEL})
+    if show:
+        import matplotlib.pyplot as plt
+
+        plt.show()
+        plt.close(fig)
+    print(f"  → Salvata: {fname}")
+    return fname
+
+
+@traced("indice")
+def show_index_unified(token, polygon, width, height,
+                       mode, start, end,
+                       step_days=10,
+                       tree_focused=False,
+                       tree_params=None,
+                       data_file=None,
+                       dedup_stats=None,
+                       field_key=None):
+    spec = fetch_index_data(
+        token, polygon, width, height, mode, start, end,
+        step_days=step_days, tree_focused=tree_focused, tree_params=tree_params,
+        data_file=data_file, dedup_stats=dedup_stats, field_key=field_key,
+    )
+    render_index_figure(spec)
+    return spec["mean_full"]
+
+
+def _attach_trend_interaction(fig, ax_line, line_obj, dates_ok, vals_ok,
+                              mode, step_days, end_dt):
+    """Tooltip, zoom con scroll e pan con click sul grafico del trend."""
+    # ---- Tooltip interattivo con mplcursors ----
+    try:
+        import mplcursors
+        cursor = mplcursors.cursor(line_obj, hover=True)
+
+        @cursor.connect("add")
+        def on_add(sel):
+            idx = sel.index
+            d   = dates_ok[idx]
+            v   = vals_ok[idx]
+            # Finestra temporale corrispondente
+            win_end_dt = min(d + relativedelta(days=step_days), end_dt)
+            sel.annotation.set_text(
+                f"📅 {d.strftime('%d/%m/%Y')} → {win_end_dt.strftime('%d/%m/%Y')}\n"
+                f"{mode.upper()}: {v:.5f}\n"
+                f"Score: {normalize_to_score(mode, v):.1f}/100"
+            )
+            sel.annotation.get_bbox_patch().set(
+                fc="#0d1020", ec="#4488ff", alpha=0.95,
+            )
+            sel.annotation.set_color("#e0e8ff")
+            sel.annotation.set_fontsize(8.5)
+    except ImportError:
+        # mplcursors non installato: tooltip via motion_notify_event
+        annot_line = ax_line.annotate(
+            "", xy=(0, 0), xytext=(15, 15),
+            textcoords="offset points",
+            bbox=dict(boxstyle="round,pad=0.4", fc="#0d1020", ec="#4488ff", lw=0.9, alpha=0.94),
+            fontsize=8, color="#e0e8ff",
+            arrowprops=dict(arrowstyle="->", color="#4488ff", lw=0.7),
         )
-        ax_line.fill_between(dates_ok, vals_ok, alpha=0.10, color="#5588ff")
 
-        if mean_full is not None:
-            ax_line.axhline(
-                mean_full, color="#eecc44", lw=1.2,
-                linestyle="--", alpha=0.75,
-                label=f"Media periodo ({mean_full:.4f})",
-            )
+        # Converti date in numeri matplotlib per il nearest-point
+        import matplotlib.dates as mdates
+        dates_num = mdates.date2num(dates_ok)
 
-        # Annotazioni statiche sui punti
-        for d, v in zip(dates_ok, vals_ok):
-            ax_line.annotate(
-                f"{v:.3f}", xy=(d, v), xytext=(0, 9),
-                textcoords="offset points",
-                ha="center", fontsize=6.5, color="#ccccee",
+        def lookup_line(event):
+            if event.xdata is None:
+                return None
+            # Trova il punto più vicino sull'asse X
+            diffs = np.abs(dates_num - event.xdata)
+            idx   = int(np.argmin(diffs))
+            # Mostra solo se abbastanza vicino (entro step_days/2 giorni)
+            threshold = step_days / 2.0
+            if diffs[idx] > threshold:
+                return None
+            d = dates_ok[idx]
+            v = vals_ok[idx]
+            win_end_dt = min(d + relativedelta(days=step_days), end_dt)
+            txt = (
+                f"📅 {d.strftime('%d/%m/%Y')} → {win_end_dt.strftime('%d/%m/%Y')}\n"
+                f"{mode.upper()}: {v:.5f}\n"
+                f"Score: {normalize_to_score(mode, v):.1f}/100"
             )
+            return idx, (dates_ok[idx], vals_ok[idx]), txt
 
-        ax_line.set_ylim(
-            min(vals_ok) - abs(vmax - vmin) * 0.15,
-            max(vals_ok) + abs(vmax - vmin) * 0.22,
-        )
-        ax_line.legend(
-            facecolor="#1a1a3a", edgecolor="#3355aa",
-            labelcolor="#d0d0f0", fontsize=8,
-        )
+        _attach_overlay(fig, ax_line, annot_line, lookup_line)
 
-        # ---- Tooltip interattivo con mplcursors ----
-        try:
-            import mplcursors
-            cursor = mplcursors.cursor(line_obj, hover=True)
-
-            @cursor.connect("add")
-            def on_add(sel):
-                idx = sel.index
-                d   = dates_ok[idx]
-                v   = vals_ok[idx]
-                # Finestra temporale corrispondente
-                win_end_dt = min(d + relativedelta(days=step_days), end_dt)
-                sel.annotation.set_text(
-                    f"📅 {d.strftime('%d/%m/%Y')} → {win_end_dt.strftime('%d/%m/%Y')}\n"
-                    f"{mode.upper()}: {v:.5f}\n"
-                    f"Score: {normalize_to_score(mode, v):.1f}/100"
-                )
-                sel.annotation.get_bbox_patch().set(
-                    fc="#0d1020", ec="#4488ff", alpha=0.95,
-                )
-                sel.annotation.set_color("#e0e8ff")
-                sel.annotation.set_fontsize(8.5)
-        except ImportError:
-            # mplcursors non installato: tooltip via motion_notify_event
-            annot_line = ax_line.annotate(
-                "", xy=(0, 0), xytext=(15, 15),
-                textcoords="offset points",
-                bbox=dict(boxstyle="round,pad=0.4", fc="#0d1020", ec="#4488ff", lw=0.9, alpha=0.94),
-                fontsize=8, color="#e0e8ff",
-                arrowprops=dict(arrowstyle="->", color="#4488ff", lw=0.7),
-            )
-            annot_line.set_visible(False)
+    # ---- Zoom con scroll ----
+    def on_scroll(event):
+        if event.inaxes != ax_line:
+            return
+        factor = 0.85 if event.button == "up" else 1.15
+        cur_xlim = ax_line.get_xlim()
+        cur_ylim = ax_line.get_ylim()
+        xdata, ydata = event.xdata, event.ydata
+        new_xlim = [xdata + (x - xdata) * factor for x in cur_xlim]
+        new_ylim = [ydata + (y - ydata) * factor for y in cur_ylim]
+        ax_line.set_xlim(new_xlim)
+        ax_line.set_ylim(new_ylim)
+        fig.canvas.draw_idle()
 
-            # Converti date in numeri matplotlib per il nearest-point
-            import matplotlib.dates as mdates
-            dates_num = mdates.date2num(dates_ok)
+    fig.canvas.mpl_connect("scroll_event", on_scroll)
 
-            def on_move_line(event):
-                if event.inaxes != ax_line:
-                    annot_line.set_visible(False)
-                    fig.canvas.draw_idle()
-                    return
-                if event.xdata is None:
-                    return
-                # Trova il punto più vicino sull'asse X
-                diffs = np.abs(dates_num - event.xdata)
-                idx   = int(np.argmin(diffs))
-                # Mostra solo se abbastanza vicino (entro step_days/2 giorni)
-                threshold = step_days / 2.0
-                if diffs[idx] > threshold:
-                    annot_line.set_visible(False)
-                    fig.canvas.draw_idle()
-                    return
-                d = dates_ok[idx]
-                v = vals_ok[idx]
-                win_end_dt = min(d + relativedelta(days=step_days), end_dt)
-                annot_line.set_text(
-                    f"📅 {d.strftime('%d/%m/%Y')} → {win_end_dt.strftime('%d/%m/%Y')}\n"
-                    f"{mode.upper()}: {v:.5f}\n"
-                    f"Score: {normalize_to_score(mode, v):.1f}/100"
-                )
-                annot_line.xy = (dates_ok[idx], vals_ok[idx])
-                annot_line.set_visible(True)
-                fig.canvas.draw_idle()
-
-            fig.canvas.mpl_connect("motion_notify_event", on_move_line)
-
-        # ---- Zoom con scroll ----
-        def on_scroll(event):
-            if event.inaxes != ax_line:
-                return
-            factor = 0.85 if event.button == "up" else 1.15
-            cur_xlim = ax_line.get_xlim()
-            cur_ylim = ax_line.get_ylim()
-            xdata, ydata = event.xdata, event.ydata
-            new_xlim = [xdata + (x - xdata) * factor for x in cur_xlim]
-            new_ylim = [ydata + (y - ydata) * factor for y in cur_ylim]
-            ax_line.set_xlim(new_xlim)
-            ax_line.set_ylim(new_ylim)
-            fig.canvas.draw_idle()
-
-        fig.canvas.mpl_connect("scroll_event", on_scroll)
-
-        # ---- Pan con click sinistro ----
-        _pan_state = {"active": False, "x0": None, "xlim0": None}
-
-        def on_press_pan(event):
-            if event.inaxes != ax_line or event.button != 1:
-                return
-            _pan_state["active"] = True
-            _pan_state["x0"]    = event.xdata
-            _pan_state["xlim0"] = ax_line.get_xlim()
-
-        def on_release_pan(event):
-            _pan_state["active"] = False
-
-        def on_motion_pan(event):
-            if not _pan_state["active"] or event.inaxes != ax_line:
-                return
-            if event.xdata is None:
-                return
-            dx = event.xdata - _pan_state["x0"]
-            ax_line.set_xlim([x - dx for x in _pan_state["xlim0"]])
-            fig.canvas.draw_idle()
+    # ---- Pan con click sinistro ----
+    _pan_state = {"active": False, "x0": None, "xlim0": None}
 
-        fig.canvas.mpl_connect("button_press_event",   on_press_pan)
-        fig.canvas.mpl_connect("button_release_event", on_release_pan)
-        fig.canvas.mpl_connect("motion_notify_event",  on_motion_pan)
+    def on_press_pan(event):
+        if event.inaxes != ax_line or event.button != 1:
+            return
+        _pan_state["active"] = True
+        _pan_state["x0"]    = event.xdata
+        _pan_state["xlim0"] = ax_line.get_xlim()
 
-    else:
-        ax_line.text(
-            0.5, 0.5, "Nessun dato temporale disponibile",
-            transform=ax_line.transAxes, ha="center", va="center",
-            fontsize=9, color="#888899",
-        )
+    def on_release_pan(event):
+        _pan_state["active"] = False
 
-    fname = f"analisi_{mode}{'_tree' if tree_focused else ''}.png"
-    plt.savefig(fname, dpi=150, bbox_inches="tight", facecolor="#0a0a14")
-    plt.show()
-    print(f"  → Salvata: {fname}")
+    def on_motion_pan(event):
+        if not _pan_state["active"] or event.inaxes != ax_line:
+            return
+        if event.xdata is None:
+            return
+        dx = event.xdata - _pan_state["x0"]
+        ax_line.set_xlim([x - dx for x in _pan_state["xlim0"]])
+        fig.canvas.draw_idle()
+
+    fig.canvas.mpl_connect("button_press_event",   on_press_pan)
+    fig.canvas.mpl_connect("button_release_event", on_release_pan)
+    fig.canvas.mpl_connect("motion_notify_event",  on_motion_pan)
 
-    return mean_full
 
 # ================= VALUTAZIONE FINALE =================
 
-def show_final_report(collected_means, period_label):
+@traced("matplotlib")
+def show_final_report(collected_means, period_label, show=True):
+    import matplotlib.pyplot as plt
+
     available = {k: v for k, v in collected_means.items() if v is not None}
     if not available:
         print("Nessun dato disponibile per la valutazione finale.")
         return
 
-    scores = {}
-    for name, val in available.items():
-        s = normalize_to_score(name, val)
-        if s is not None:
-            scores[name] = s
-
-    total_weight = sum(INDEX_WEIGHTS.get(n, 0) for n in scores)
-    global_score = (
-        sum(scores[n] * INDEX_WEIGHTS.get(n, 0) for n in scores) / total_weight
-        if total_weight > 0 else 0
-    )
+    scored = score_values({
+        "period": period_label,
+        "index":  list(available),
+        "value":  list(available.values()),
+    })
+    scores       = dict(zip(scored["index"], scored["score"].astype(float)))
+    evaluations  = dict(zip(scored["index"], scored["evaluation"]))
+    global_score = (float(rank_scores(scored, ["period"])["global_score"].iloc[0])
+                    if len(scored) else 0)
 
     fig = plt.figure(figsize=(14, 9))
     fig.patch.set_facecolor("#f5f5f0")
@@ -1696,7 +3460,7 @@ def show_final_report(collected_means, period_label):
             f"{val:.4f}",
             f"{scores[name]:.1f}",
             f"{INDEX_WEIGHTS.get(name, 0):.0%}",
-            evaluate_index(name, val)
+            evaluations[name]
         ])
 
     table = ax_tab.table(cellText=rows, colLabels=col_labels,
@@ -1745,9 +3509,13 @@ def show_final_report(collected_means, period_label):
                   edgecolor="#4a7a4a", linewidth=1.5)
     )
 
-    plt.savefig("report_finale.png", dpi=150, bbox_inches="tight")
-    plt.show()
+    with span("matplotlib.savefig"):
+        fig.savefig("report_finale.png", dpi=150, bbox_inches="tight")
+    if show:
+        plt.show()
+    plt.close(fig)
     print("Report salvato in: report_finale.png")
+    return "report_finale.png"
 
 # ================= CONCLUSIONE =================
 
@@ -1823,7 +3591,11 @@ def build_conclusion(available, scores, global_score):
 
 # ================= MAIN =================
 
-def _show_rgb(img_bytes, title):
+@traced("matplotlib")
+def _show_rgb(img_bytes, title, show=True):
+    import rasterio
+    import matplotlib.pyplot as plt
+
     with rasterio.open(img_bytes) as src:
         data = src.read().astype(np.float32)
 
@@ -1835,7 +3607,7 @@ def _show_rgb(img_bytes, title):
     ax.set_facecolor("#0f0f1a")
     ax.axis("off")
     ax.set_title(title, fontsize=10, color="#ffffff", pad=6)
-    ax.imshow(rgb)
+    ax.imshow(display_level(rgb, *_axes_pixels(fig, ax)), extent=_raster_extent(rgb))
 
     annot = ax.annotate(
         "", xy=(0, 0),
@@ -1846,33 +3618,552 @@ def _show_rgb(img_bytes, title):
     )
     annot.set_visible(False)
 
-    def on_move_rgb(event):
-        if event.inaxes != ax:
-            annot.set_visible(False)
-            fig.canvas.draw_idle()
-            return
-        col = int(round(event.xdata)) if event.xdata is not None else -1
-        row = int(round(event.ydata)) if event.ydata is not None else -1
-        h, w, _ = rgb.shape
-        if 0 <= row < h and 0 <= col < w:
-            r, g, b = rgb[row, col]
-            annot.set_text(f"({col}, {row})\nR:{r}  G:{g}  B:{b}")
-            annot.xy = (event.xdata, event.ydata)
-            annot.set_visible(True)
-        else:
-            annot.set_visible(False)
-        fig.canvas.draw_idle()
+    def lookup_rgb(event):
+        px = _pixel_at(event, rgb.shape)
+        if px is None:
+            return None
+        row, col = px
+        r, g, b = rgb[row, col]
+        return px, (col, row), f"({col}, {row})\nR:{r}  G:{g}  B:{b}"
 
-    fig.canvas.mpl_connect("motion_notify_event", on_move_rgb)
+    if show:
+        _attach_overlay(fig, ax, annot, lookup_rgb)
     plt.tight_layout(pad=1.5)
-    plt.savefig("analisi_rgb.png", dpi=150, bbox_inches="tight", facecolor="#0f0f1a")
-    plt.show()
+    with span("matplotlib.savefig"):
+        fig.savefig("analisi_rgb.png", dpi=150, bbox_inches="tight", facecolor="#0f0f1a")
+    if show:
+        plt.show()
+    plt.close(fig)
     print("  → Salvata: analisi_rgb.png")
+    return "analisi_rgb.png"
+
+
+# ================= TILE XYZ =================
+
+TILE_SIZE     = 256
+TILE_MAX_ZOOM = 20   # 10 m/pixel sono ~zoom 14 alle nostre latitudini
+TILE_MANIFEST = "tiles.json"
+
+
+def raster_georef(img_bytes, polygon=None, shape=None):
+    """
+    Georeferenziazione del GeoTIFF scaricato: (transform, crs) con transform
+    come tupla affine (a, b, c, d, e, f). Se il file non ne ha, ricavata dal
+    bbox di polygon in EPSG:4326 (il CRS di output predefinito della Process
+    API) per un raster di forma shape.
+    """
+    if img_bytes is not None:
+        import rasterio
+
+        img_bytes.seek(0)
+        with rasterio.open(img_bytes) as src:
+            if src.crs is not None:
+                return tuple(src.transform)[:6], src.crs.to_string()
+    if polygon is None or shape is None:
+        return None
+    coords = _exterior_coords(polygon)
+    west,  east  = min(c[0] for c in coords), max(c[0] for c in coords)
+    south, north = min(c[1] for c in coords), max(c[1] for c in coords)
+    h, w = shape[:2]
+    return ((east - west) / w, 0.0, west, 0.0, -(north - south) / h, north), "EPSG:4326"
+
+
+def _is_wgs84(crs):
+    return crs.upper() in ("EPSG:4326", "OGC:CRS84")
+
+
+def _to_raster_crs(crs, lon, lat):
+    if _is_wgs84(crs):
+        return lon, lat
+    from pyproj import Transformer
+
+    return Transformer.from_crs("EPSG:4326", crs, always_xy=True).transform(lon, lat)
+
+
+def _from_raster_crs(crs, x, y):
+    if _is_wgs84(crs):
+        return x, y
+    from pyproj import Transformer
+
+    return Transformer.from_crs(crs, "EPSG:4326", always_xy=True).transform(x, y)
+
+
+def _raster_lonlat_bounds(georef, shape):
+    """(ovest, sud, est, nord) in gradi dei quattro angoli del raster."""
+    (a, b, c, d, e, f), crs = georef
+    h, w = shape[:2]
+    cols = np.array([0, w, 0, w], dtype=np.float64)
+    rows = np.array([0, 0, h, h], dtype=np.float64)
+    lon, lat = _from_raster_crs(crs, a * cols + b * rows + c, d * cols + e * rows + f)
+    return float(np.min(lon)), float(np.min(lat)), float(np.max(lon)), float(np.max(lat))
+
+
+def _lonlat_to_tile(lon, lat, z):
+    n = 2 ** z
+    lat = np.clip(lat, -85.0511, 85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - np.log(np.tan(np.radians(lat)) + 1 / np.cos(np.radians(lat))) / np.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _tile_lonlat(z, x, y):
+    """Longitudine e latitudine dei centri dei pixel della tile z/x/y."""
+    n = 2 ** z
+    t = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lon = (x + t) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + t) / n))))
+    return np.meshgrid(lon, lat)
+
+
+def tile_zoom_range(georef, shape):
+    """
+    Zoom minimo (campo intero in al più 2x2 tile) e massimo (tile con
+    risoluzione almeno pari a quella del raster).
+    """
+    west, south, east, north = _raster_lonlat_bounds(georef, shape)
+    lat_c = np.radians((south + north) / 2)
+    res_m = (east - west) * np.pi / 180 * WEB_MERCATOR_RADIUS * np.cos(lat_c) / shape[1]
+    tile_res0 = 2 * np.pi * WEB_MERCATOR_RADIUS * np.cos(lat_c) / TILE_SIZE
+    zmax = int(min(TILE_MAX_ZOOM, max(0, np.ceil(np.log2(tile_res0 / res_m)))))
+
+    zmin = zmax
+    while zmin > 0:
+        x0, y0 = _lonlat_to_tile(west, north, zmin)
+        x1, y1 = _lonlat_to_tile(east, south, zmin)
+        if x1 - x0 < 2 and y1 - y0 < 2:
+            break
+        zmin -= 1
+    return zmin, zmax
+
+
+def _sample_tile(arr, georef, z, x, y):
+    """Valori del raster (nearest) sui pixel della tile, NaN fuori raster."""
+    (a, b, c, d, e, f), crs = georef
+    lon, lat = _tile_lonlat(z, x, y)
+    px, py = _to_raster_crs(crs, lon, lat)
+    det = a * e - b * d
+    col = np.floor((e * (px - c) - b * (py - f)) / det).astype(np.int64)
+    row = np.floor((a * (py - f) - d * (px - c)) / det).astype(np.int64)
+    h, w = arr.shape[:2]
+    inside = (row >= 0) & (row < h) & (col >= 0) & (col < w)
+    out = np.full(lon.shape, np.nan, dtype=np.float32)
+    out[inside] = arr[row[inside], col[inside]]
+    return out
+
+
+@traced("tile")
+def export_index_tiles(spec, tiles_dir):
+    """
+    Esporta la mappa dell'indice come piramide di tile XYZ colorate con la
+    palette di get_colormap_and_range in tiles_dir/<indice>/{z}/{x}/{y}.png.
+    Le tile vengono riscritte solo se cambiano i valori campionati o la
+    palette (hash nel manifest tiles.json); quelle non più coperte dal
+    raster vengono rimosse. Ritorna il manifest del layer oppure None.
+    """
+    arr    = spec["map_array"]
+    georef = spec.get("georef")
+    if arr is None or georef is None:
+        return None
+
+    from matplotlib.image import imsave
+
+    mode  = spec["mode"]
+    layer = f"{mode}{'_tree' if spec['tree_focused'] else ''}"
+    cmap, vmin, vmax = get_colormap_and_range(mode)
+    layer_dir = os.path.join(tiles_dir, layer)
+    manifest_path = os.path.join(layer_dir, TILE_MANIFEST)
+
+    old_tiles = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            old_tiles = json.load(f).get("tiles", {})
+
+    west, south, east, north = _raster_lonlat_bounds(georef, arr.shape)
+    zmin, zmax = tile_zoom_range(georef, arr.shape)
+    palette_key = f"{mode}:{vmin}:{vmax}".encode()
+    tiles = {}
+    written = 0
+
+    for z in range(zmin, zmax + 1):
+        # livello della piramide di visualizzazione adatto a questo zoom
+        scale = 2.0 ** (z - zmax)
+        level = display_level(arr, int(np.ceil(arr.shape[0] * scale)),
+                              int(np.ceil(arr.shape[1] * scale)))
+        (a, b, c, d, e, f), crs = georef
+        sy, sx = arr.shape[0] / level.shape[0], arr.shape[1] / level.shape[1]
+        level_georef = ((a * sx, b * sy, c, d * sx, e * sy, f), crs)
+
+        x0, y0 = _lonlat_to_tile(west, north, z)
+        x1, y1 = _lonlat_to_tile(east, south, z)
+        for tx in range(x0, x1 + 1):
+            for ty in range(y0, y1 + 1):
+                vals = _sample_tile(level, level_georef, z, tx, ty)
+                nan  = np.isnan(vals)
+                if nan.all():
+                    continue
+                key    = f"{z}/{tx}/{ty}"
+                digest = hashlib.sha1(palette_key + vals.tobytes()).hexdigest()
+                tiles[key] = digest
+                path = os.path.join(layer_dir, f"{key}.png")
+                if old_tiles.get(key) == digest and os.path.exists(path):
+                    continue
+                rgba = cmap(np.clip((vals - vmin) / (vmax - vmin), 0, 1), bytes=True)
+                rgba[nan, 3] = 0
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                imsave(path, rgba)
+                written += 1
+
+    removed = 0
+    for key in set(old_tiles) - set(tiles):
+        path = os.path.join(layer_dir, f"{key}.png")
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+
+    manifest = {
+        "layer":   layer,
+        "index":   mode,
+        "period":  [spec["start"], spec["end"]],
+        "vmin":    vmin,
+        "vmax":    vmax,
+        "bounds":  [west, south, east, north],
+        "minzoom": zmin,
+        "maxzoom": zmax,
+        "tiles":   tiles,
+    }
+    os.makedirs(layer_dir, exist_ok=True)
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, manifest_path)
+
+    print(f"  → Tile {layer}: {written} scritte, {len(tiles) - written} invariate, "
+          f"{removed} rimosse (zoom {zmin}-{zmax})")
+    return manifest
+
+
+def write_tile_viewer(tiles_dir):
+    """Visualizzatore Leaflet statico (index.html) per tutti i layer in tiles_dir."""
+    layers = []
+    for name in sorted(os.listdir(tiles_dir)):
+        manifest_path = os.path.join(tiles_dir, name, TILE_MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                m = json.load(f)
+            m.pop("tiles", None)
+            layers.append(m)
+    if not layers:
+        return None
+
+    html = """<!DOCTYPE html>
+<html lang="it">
+<head>
+<meta charset="UTF-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>Sentinel-2 · Mappe indici</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>
+  html, body, #map { height: 100%; margin: 0; background: #07080f; }
+  .info { background: #0e1020ee; color: #c8d0f0; padding: .4rem .7rem;
+          border-radius: 6px; font: 12px 'DM Sans', sans-serif; }
+</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+const LAYERS = """ + json.dumps(layers, ensure_ascii=False) + """;
+
+const map = L.map('map');
+const base = L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+  maxZoom: 22, maxNativeZoom: 19, attribution: '&copy; OpenStreetMap'
+}).addTo(map);
+
+const overlays = {};
+LAYERS.forEach((l, i) => {
+  const b = [[l.bounds[1], l.bounds[0]], [l.bounds[3], l.bounds[2]]];
+  const layer = L.tileLayer(l.layer + '/{z}/{x}/{y}.png', {
+    minNativeZoom: l.minzoom, maxNativeZoom: l.maxzoom, maxZoom: 22,
+    bounds: b, opacity: 0.9,
+  });
+  layer.meta = l;
+  overlays[`${l.layer.toUpperCase()} (${l.period[0]} → ${l.period[1]})`] = layer;
+  if (i === 0) { layer.addTo(map); map.fitBounds(b); }
+});
+L.control.layers({ 'OpenStreetMap': base }, overlays, { collapsed: false }).addTo(map);
+
+const info = L.control({ position: 'bottomleft' });
+info.onAdd = () => L.DomUtil.create('div', 'info');
+info.addTo(map);
+function showInfo(l) {
+  info.getContainer().innerHTML = `${l.index.toUpperCase()} · range ${l.vmin} → ${l.vmax}`;
+}
+showInfo(LAYERS[0]);
+map.on('overlayadd', e => showInfo(e.layer.meta));
+</script>
+</body>
+</html>
+"""
+    path = os.path.join(tiles_dir, "index.html")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(html)
+    print(f"  → Visualizzatore tile: {path}")
+    return path
+
+
+# ================= RENDERING HEADLESS =================
+
+def worker_settings():
+    """
+    Stato di processo impostato dalla riga di comando (endpoint, ledger,
+    profilazione) da passare ai worker tramite initargs: con spawn o
+    forkserver i worker non ereditano i globali del processo principale.
+    """
+    return {
+        "endpoints": dict(SH_ENDPOINTS),
+        "ledger":    _ledger["path"],
+        "profile":   {k: _profile[k] for k in ("dir", "path", "t0")},
+    }
+
+
+def _apply_worker_settings(settings):
+    SH_ENDPOINTS.update(settings["endpoints"])
+    if settings["endpoints"]["token"].startswith("http://"):
+        os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+    open_ledger(settings["ledger"])
+    # t0 dal processo principale: perf_counter è monotono per tutto il sistema
+    _profile.update(settings["profile"], file=None, pid=None)
+
+
+def _init_headless_worker(settings=None):
+    import matplotlib
+    matplotlib.use("Agg")
+    if settings is not None:
+        _apply_worker_settings(settings)
+
+
+def start_headless_renderer(workers=None):
+    """
+    Pool di processi per il rendering delle figure con backend Agg.
+    Anche il processo principale passa ad Agg: nessuna finestra viene aperta.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    _init_headless_worker()
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_headless_worker,
+                               initargs=(worker_settings(),))
+
+
+def write_render_manifest(jobs, path="render_manifest.json"):
+    """Attende i rendering in corso e scrive il manifest delle figure prodotte (ritornate)."""
+    figures = []
+    for info, future in jobs:
+        entry = dict(info)
+        try:
+            entry["file"]   = future.result()
+            entry["status"] = "ok"
+        except Exception as e:
+            entry["file"]   = None
+            entry["status"] = f"errore: {e}"
+        figures.append(entry)
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "generated": datetime.now().isoformat(timespec="seconds"),
+            "figures":   figures,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"  → Manifest figure salvato in: {path}")
+    return figures
+
+# ================= WORKER DEGLI INDICI =================
+
+def _init_index_worker(write_lock, settings):
+    _init_headless_worker(settings)
+    _shared["write_lock"] = write_lock
+
+
+def start_index_workers(workers, minute_rate, history=()):
+    """
+    Pool di processi per la pipeline completa degli indici. Il limitatore di
+    richieste (con lo storico recente history, vedi make_rate_limiter) resta
+    nel processo principale: un thread lo consuma e deposita un permesso
+    alla volta in una coda condivisa, da cui i worker lo prelevano prima di
+    ogni richiesta. CSV e journal sono scritti sotto un lock condiviso.
+    Ritorna {"pool", "permits", "shutdown"}; shutdown(cancel=True) annulla
+    i task ancora in coda invece di attenderli.
+    """
+    import queue
+    import threading
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import Manager
+
+    manager = Manager()
+    permits = manager.Queue(maxsize=1)   # al più un permesso in anticipo
+    lock    = manager.Lock()
+    limiter = make_rate_limiter(minute_rate, history=history)
+    stop    = threading.Event()
+
+    def feed():
+        while not stop.is_set():
+            limiter["acquire"]()
+            while not stop.is_set():
+                try:
+                    permits.put(True, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+                except (EOFError, OSError):
+                    return
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    _shared["write_lock"] = lock
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_index_worker,
+                               initargs=(lock, worker_settings()))
+
+    def shutdown(cancel=False):
+        pool.shutdown(cancel_futures=cancel)
+        stop.set()
+        feeder.join()
+        _shared["write_lock"] = None
+        manager.shutdown()
+
+    return {"pool": pool, "permits": permits, "shutdown": shutdown}
+
+
+def _completed_future(value):
+    from concurrent.futures import Future
+
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+@traced("indice.worker")
+def _index_pipeline(job):
+    """
+    Download, decodifica, statistiche, tile e (headless) figura di un indice
+    in un processo worker. Ritorna la media del periodo, la figura salvata
+    oppure la specifica da disegnare nel processo principale, e i CSV da
+    deduplicare (compattati dal processo principale a fine esecuzione).
+    """
+    dedup_stats = {"rows": 0, "bytes": 0} if job["dedup_write"] else None
+    spec = fetch_index_data(
+        token_provider(job["client_id"], job["client_secret"]),
+        job["polygon"], job["width"], job["height"],
+        job["mode"], job["start"], job["end"],
+        step_days=job["step_days"],
+        tree_focused=job["tree_focused"],
+        tree_params=job["tree_params"],
+        data_file=job["data_file"],
+        dedup_stats=dedup_stats,
+        field_key=job["field_key"],
+        journal=job["journal"],
+        acquire=job["permits"].get,
+        skip=job["skip"],
+    )
+    if job["tiles_dir"]:
+        export_index_tiles(spec, job["tiles_dir"])
+    mean_val = spec["mean_full"]
+    if mean_val is not None and job["data_file"]:
+        _save_and_count(dedup_stats, job["data_file"], job["start"], job["end"],
+                        job["tree_focused"], job["mode"], mean_val, field_key=job["field_key"])
+
+    result = {"mode": job["mode"], "mean": mean_val, "dedup": dedup_stats,
+              "file": None, "spec": None}
+    if job["headless"]:
+        result["file"] = render_index_figure(spec, show=False)
+    else:
+        result["spec"] = spec
+    return result
+
+# ================= GRAFICO TREND DA CSV =================
+
+def _build_trend_csv_template(reuse):
+    fig = _new_figure((14, 6), reuse)
+    fig.patch.set_facecolor("#0a0a14")
+    ax = fig.add_subplot(1, 1, 1)
+    tpl = {
+        "fig":      fig,
+        "suptitle": fig.suptitle("", fontsize=11, color="#ffffff", y=0.99),
+        "trend":    _build_trend_panel(ax),
+        "title":    ax.set_title("", fontsize=9, color="#a8d8ff", pad=4),
+        "mean":     fig.text(
+            0.5, 0.01, "",
+            ha="center", fontsize=9, color="#1a1a1a",
+            bbox=dict(boxstyle="round,pad=0.3",
+                      facecolor="#66dd66", alpha=0.88, edgecolor="none"),
+        ),
+    }
+    return tpl
+
+
+@traced("matplotlib")
+def plot_trend_from_csv(m, mean_val, trend_points, start, end, step_days,
+                        tree_focused=False, show=True):
+    """Grafico del trend di un indice dai dati del CSV (senza mappa raster)."""
+    info             = INDEX_DESCRIPTIONS.get(m, {})
+    vmin, vmax       = get_value_range(m)
+    tree_tag         = "  [chiome arboree]" if tree_focused else ""
+
+    dates_pts = [datetime.fromisoformat(p["start"]) for p in trend_points]
+    vals_arr  = np.array([p["value"] for p in trend_points], dtype=float)
+    mask_ok   = ~np.isnan(vals_arr)
+    dates_ok  = [d for d, ok in zip(dates_pts, mask_ok) if ok]
+    vals_ok   = vals_arr[mask_ok]
+
+    reuse = not show
+    if reuse and "trend_csv" in _figure_templates:
+        tpl = _figure_templates["trend_csv"]
+    else:
+        tpl = _build_trend_csv_template(reuse)
+        if reuse:
+            _figure_templates["trend_csv"] = tpl
+    fig, trend = tpl["fig"], tpl["trend"]
+
+    tpl["suptitle"].set_text(
+        f"{info.get('title', m.upper())}   —   {start} → {end}{tree_tag}"
+        f"\n[dati da CSV]"
+    )
+    trend["ax"].set_ylabel(
+        f"Valore medio {m.upper()}  ({'chiome arboree' if tree_focused else 'campo intero'})",
+        color="#888899", fontsize=8,
+    )
+    tpl["title"].set_text(f"Andamento temporale — finestre di {step_days} giorni  [da CSV]")
+    _fill_trend_panel(trend, dates_ok, vals_ok, mean_val,
+                      f"{m.upper()} {'chiome' if tree_focused else 'campo'}", vmin, vmax)
+    # qui nessun testo "nessun dato": il grafico resta vuoto come in origine
+    trend["nodata"].set_visible(False)
+
+    tpl["mean"].set_visible(mean_val is not None)
+    if mean_val is not None:
+        score     = normalize_to_score(m, mean_val)
+        score_str = f"  |  score {score:.0f}/100" if score is not None else ""
+        tpl["mean"].set_text(
+            f"Media: {mean_val:.4f}{score_str}   —   {evaluate_index(m, mean_val)}"
+        )
+        tpl["mean"].get_bbox_patch().set_facecolor(_score_color(score))
+
+    fname = f"analisi_{m}{'_tree' if tree_focused else ''}_csv.png"
+    with span("matplotlib.savefig"):
+        fig.savefig(fname, dpi=150, bbox_inches="tight", facecolor="#0a0a14",
+                    pil_kwargs={"compress_level": PNG_COMPRESS_LEVEL})
+    if show:
+        import matplotlib.pyplot as plt
+
+        plt.show()
+        plt.close(fig)
+    print(f"  → Salvata: {fname}")
+    return fname
 
 
 def run(client_id, client_secret, kml, start, end, mode, step_days,
         report_only=False, tree_focused=False, tree_params=None,
-        data_file=None, chart_only=False, chart_output="chart.html"):
+        data_file=None, chart_only=False, chart_output="chart.html",
+        compact=False, dedup_write=False, headless=False, render_workers=None,
+        chart_max_points=CHART_MAX_POINTS, tiles_dir=None, rank_output=None,
+        journal_file=None, index_workers=1, minute_rate=95, dry_run=False,
+        catalog=True, catalog_url=None, monthly_pu=0):
 
     if tree_params is None:
         tree_params = dict(TREE_MASK_DEFAULTS)
@@ -1881,44 +4172,86 @@ def run(client_id, client_secret, kml, start, end, mode, step_days,
     if tree_focused:
         period_label += "  [chiome arboree]"
 
+    # ---- Compattazione dello storico ----
+    if compact:
+        if not data_file or not os.path.exists(data_file):
+            print("⚠ --compact richiede --data-file con un CSV esistente.")
+            return
+        removed, reclaimed = compact_datapoints(data_file)
+        print(f"→ Compattazione {data_file}: {removed} righe rimosse, {reclaimed} byte recuperati.")
+        return
+
+    # ---- Classifica di tutte le rilevazioni del CSV ----
+    if rank_output:
+        if not data_file or not os.path.exists(data_file):
+            print("⚠ --rank richiede --data-file con un CSV esistente.")
+            return
+        rows = _latest_rows(_read_rows(data_file))
+        if not rows:
+            print("⚠ Nessuna rilevazione nel CSV da classificare.")
+            return
+        ranked = score_table(rows)
+        ranked.to_csv(rank_output, index=False, float_format="%.2f")
+        print(f"→ Classifica di {len(ranked)} combinazioni campo/periodo salvata in {rank_output}")
+        for row in ranked.head(10).itertuples(index=False):
+            print(f"  {row.rank:>3}. {row.start} → {row.end}  campo {row.field or '—'}"
+                  f"  score {row.global_score:.1f}")
+        return
+
+    dedup_stats = {"rows": 0, "bytes": 0} if dedup_write else None
+
     # ---- Modalità chart-only ----
     if chart_only:
         if not data_file or not os.path.exists(data_file):
             print("⚠ --chart-only richiede --data-file con un CSV esistente.")
             return
-        generate_html_chart(None, data_file, tree_focused, output_html=chart_output)
+        field_key = None
+        if kml:
+            polygon   = get_geometry(kml)
+            field_key = make_field_key(polygon, *get_bbox_size(polygon), step_days)
+        generate_html_chart(None, data_file, tree_focused, output_html=chart_output,
+                            field_key=field_key, max_points=chart_max_points)
         return
 
-    # ---- Lazy init API: autenticazione solo se serve ----
-    _api = {"token": None, "polygon": None, "width": None, "height": None}
+    # ---- Lazy init campo e API: KML letto e autenticazione solo se servono ----
+    _api = {"polygon": None, "width": None, "height": None, "key": None}
 
-    def get_api():
-        if _api["token"] is None:
-            print("→ Autenticazione Copernicus...")
-            _api["token"]                 = authenticate(client_id, client_secret)
-            _api["polygon"]               = get_polygon(kml)
+    def get_field():
+        if _api["polygon"] is None:
+            _api["polygon"]               = get_geometry(kml)
             _api["width"], _api["height"] = get_bbox_size(_api["polygon"])
-        return _api["token"], _api["polygon"], _api["width"], _api["height"]
+            _api["key"]                   = make_field_key(
+                _api["polygon"], _api["width"], _api["height"], step_days
+            )
+        return _api["polygon"], _api["width"], _api["height"], _api["key"]
+
+    get_token = token_provider(client_id, client_secret)
+
+    def get_api():
+        get_field()
+        return get_token(), _api["polygon"], _api["width"], _api["height"]
 
     # ---- Punti del trend attesi dati start/end/step ----
     def expected_trend_keys():
-        start_dt = datetime.fromisoformat(start)
-        end_dt   = datetime.fromisoformat(end)
-        keys = []
-        cur  = start_dt
-        while cur <= end_dt:
-            win_end = min(cur + relativedelta(days=step_days), end_dt)
-            keys.append((cur.strftime("%Y-%m-%d"), win_end.strftime("%Y-%m-%d")))
-            cur += relativedelta(days=step_days)
-        return keys
-
-    # ---- Legge il CSV per un indice: ritorna trend completo o None ----
-    def read_from_csv(m):
-        if not data_file or not os.path.exists(data_file):
-            return None, None
+        return [(s.strftime("%Y-%m-%d"), e.strftime("%Y-%m-%d"))
+                for s, e in trend_windows(start, end, step_days)]
+
+    # ---- Rilevazioni del campo già nel CSV, lette una volta ----
+    _stored = {}
+
+    def stored_points():
+        if "points" not in _stored:
+            _stored["points"] = {}
+            if data_file and os.path.exists(data_file):
+                _stored["points"] = load_datapoints(data_file, tree_focused=tree_focused,
+                                                    field_key=get_field()[3])
+        return _stored["points"]
 
-        all_trend   = load_datapoints(data_file, tree_focused=tree_focused)
-        trend_for_m = all_trend.get(m, [])
+    # ---- Legge il CSV per un indice: solo le finestre del trend richiesto ----
+    def read_from_csv(m):
+        expected    = set(expected_trend_keys())
+        trend_for_m = [p for p in stored_points().get(m, [])
+                       if (p["start"], p["end"]) in expected]
 
         if not trend_for_m:
             return None, None
@@ -1928,162 +4261,749 @@ def run(client_id, client_secret, kml, start, end, mode, step_days,
         mean_val     = float(np.mean(vals)) if vals else None
         return mean_val, trend_sorted
 
-    # ---- Grafico trend da CSV (senza mappa raster) ----
-    def plot_trend_from_csv(m, mean_val, trend_points):
-        info             = INDEX_DESCRIPTIONS.get(m, {})
-        _, vmin, vmax    = get_colormap_and_range(m)
-        tree_tag         = "  [chiome arboree]" if tree_focused else ""
-
-        dates_pts = [datetime.fromisoformat(p["start"]) for p in trend_points]
-        vals_arr  = np.array([p["value"] for p in trend_points], dtype=float)
-        mask_ok   = ~np.isnan(vals_arr)
-        dates_ok  = [d for d, ok in zip(dates_pts, mask_ok) if ok]
-        vals_ok   = vals_arr[mask_ok]
-
-        fig = plt.figure(figsize=(14, 6))
-        fig.patch.set_facecolor("#0a0a14")
-        fig.suptitle(
-            f"{info.get('title', m.upper())}   —   {start} → {end}{tree_tag}"
-            f"\n[dati da CSV]",
-            fontsize=11, color="#ffffff", y=0.99,
-        )
-
-        ax = fig.add_subplot(1, 1, 1)
-        ax.set_facecolor("#0d0d20")
-        ax.tick_params(colors="#888899", labelsize=8)
-        ax.set_xlabel("Data", color="#888899", fontsize=8)
-        ax.set_ylabel(
-            f"Valore medio {m.upper()}  ({'chiome arboree' if tree_focused else 'campo intero'})",
-            color="#888899", fontsize=8,
-        )
-        for spine in ax.spines.values():
-            spine.set_edgecolor("#2a2a4a")
-        ax.grid(True, color="#1e1e3a", linewidth=0.6)
-        ax.set_title(
-            f"Andamento temporale — finestre di {step_days} giorni  [da CSV]",
-            fontsize=9, color="#a8d8ff", pad=4,
-        )
-
-        if len(vals_ok) > 0:
-            ax.plot(dates_ok, vals_ok,
-                    color="#5588ff", lw=2, marker="o", ms=6, zorder=3,
-                    label=f"{m.upper()} {'chiome' if tree_focused else 'campo'}")
-            ax.fill_between(dates_ok, vals_ok, alpha=0.10, color="#5588ff")
-
-            if mean_val is not None:
-                ax.axhline(mean_val, color="#eecc44", lw=1.2,
-                           linestyle="--", alpha=0.75,
-                           label=f"Media periodo ({mean_val:.4f})")
-
-            for d, v in zip(dates_ok, vals_ok):
-                ax.annotate(f"{v:.3f}", xy=(d, v), xytext=(0, 9),
-                            textcoords="offset points",
-                            ha="center", fontsize=6.5, color="#ccccee")
-
-            ax.set_ylim(
-                min(vals_ok) - abs(vmax - vmin) * 0.15,
-                max(vals_ok) + abs(vmax - vmin) * 0.22,
-            )
-            ax.legend(facecolor="#1a1a3a", edgecolor="#3355aa",
-                      labelcolor="#d0d0f0", fontsize=8)
-
-        if mean_val is not None:
-            score     = normalize_to_score(m, mean_val)
-            sc_col    = ("#66dd66" if (score or 0) >= 70
-                         else "#eecc44" if (score or 0) >= 45
-                         else "#ee4444")
-            score_str = f"  |  score {score:.0f}/100" if score is not None else ""
-            fig.text(
-                0.5, 0.01,
-                f"Media: {mean_val:.4f}{score_str}   —   {evaluate_index(m, mean_val)}",
-                ha="center", fontsize=9, color="#1a1a1a",
-                bbox=dict(boxstyle="round,pad=0.3",
-                          facecolor=sc_col, alpha=0.88, edgecolor="none"),
-            )
-
-        fname = f"analisi_{m}{'_tree' if tree_focused else ''}_csv.png"
-        plt.savefig(fname, dpi=150, bbox_inches="tight", facecolor="#0a0a14")
-        plt.show()
-        print(f"  → Salvata: {fname}")
-
-    # ================================================================== #
-    #  LOOP PRINCIPALE
-    # ================================================================== #
-    all_means = {}
 
-    for m in mode:
+    # ---- Piano: lacune reali rispetto a CSV e journal ----
+    polygon, width, height, field_key = get_field()
+    job = backfill_job_id(field_key, start, end, step_days, tree_focused)
+    journal_file = journal_file or (journal_path(data_file) if data_file else None)
+    journal_tasks = load_journal(journal_file, job) if journal_file else {}
+    plan_args = dict(tree_focused=tree_focused, stored=stored_points(),
+                     journal_tasks=journal_tasks, report_only=report_only)
+    plan = plan_backfill(mode, start, end, step_days, output_size(width, height), **plan_args)
+
+    # Catalogo solo se ci sono finestre da scaricare: quelle senza
+    # acquisizioni utili non costano una richiesta Process
+    skip = set()
+    if catalog and any(entry["windows"] or (entry["map"] and m != "rgb")
+                       for m, entry in plan["indices"].items()):
+        try:
+            scenes = load_scenes(get_token, polygon, field_key["field"], start, end,
+                                 cache_file=catalog_cache_path(data_file) if data_file else None,
+                                 url=catalog_url)
+        except Exception as e:
+            print(f"⚠ Catalogo non disponibile ({e}): tutte le finestre verranno richieste.")
+        else:
+            windows = expected_trend_keys()
+            usable  = windows_with_scenes(windows, scenes)
+            skip    = set(windows) - usable
+            print(f"→ Catalogo: {len(scenes)} acquisizioni, "
+                  f"{len(usable)}/{len(windows)} finestre con scene entro {CATALOG_MAX_CLOUD}% di nuvole")
+            plan = plan_backfill(mode, start, end, step_days, output_size(width, height),
+                                 usable=usable, **plan_args)
+    print_backfill_plan(plan, minute_rate, used=ledger_totals(), monthly_pu=monthly_pu)
+    if dry_run:
+        return
 
-        # RGB: sempre via API, niente da cacheare
-        if m == "rgb":
-            token, polygon, width, height = get_api()
-            s_full = start + "Z" if not start.endswith("Z") else start
-            e_full = end   + "Z" if not end.endswith("Z")   else end
-            print(f"\n[RGB] Scarico immagine colori naturali {start} → {end} ...")
-            url, headers, payload = make_request(
-                token, polygon, width, height,
-                s_full, e_full, "rgb", tree_focused=False,
-            )
-            img = download_image(url, headers, payload)
-            if img:
-                _show_rgb(img, f"RGB — {period_label}")
-            continue
+    # ---- Rendering: diretto oppure in un pool di processi (headless) ----
+    renderer    = start_headless_renderer(render_workers) if headless else None
+    render_jobs = []
 
-        print(f"\n[{m.upper()}] Controllo CSV...")
-        mean_val, trend_points = read_from_csv(m)
+    def render(info, fn, *fn_args):
+        if renderer is None:
+            fn(*fn_args)
+        else:
+            render_jobs.append((info, renderer.submit(fn, *fn_args, show=False)))
+
+    # Pool e Manager vengono chiusi anche su errore o Ctrl-C: in quel caso i
+    # task ancora in coda vengono annullati invece di essere attesi
+    workers   = None
+    completed = False
+    try:
+        # ---- Journal del backfill: solo i task del piano, ripresa dai conclusi ----
+        journal = None
+        if journal_file and not report_only:
+            tasks = []
+            for m, entry in plan["indices"].items():
+                if m != "rgb":
+                    tasks += [(m, "window", s, e) for s, e in entry["windows"]]
+                    if entry["map"]:
+                        tasks.append((m, "map", start, end))
+            journal = open_backfill(journal_file, job, tasks)
+            concluded = sum(1 for rec in journal["tasks"].values() if rec["state"] in JOURNAL_DONE)
+            pending   = journal_pending(journal)
+            if concluded and pending:
+                first = pending[0]
+                print(f"→ Ripresa job {job}: {concluded} task già conclusi, {len(pending)} da eseguire, "
+                      f"riparto da {first['index'].upper()} "
+                      + ("mappa " if first["kind"] == "map" else "")
+                      + f"{first['start']} → {first['end']}")
+
+        # ---- Worker degli indici: download → statistiche → figura in parallelo ----
+        # Le richieste di esecuzioni precedenti (ledger) contano nel primo minuto
+        index_jobs = []
+        rendered   = True   # False se un worker o un rendering fallisce
+        if index_workers and index_workers > 1 and not report_only:
+            workers = start_index_workers(index_workers, minute_rate, history=ledger_recent())
+            acquire = workers["permits"].get
+        else:
+            acquire = make_rate_limiter(minute_rate, history=ledger_recent())["acquire"]
 
-        # ---- CASO 1: CSV completo → nessuna API ----
-        if trend_points is not None:
-            print(f"  → {len(trend_points)} punti trovati nel CSV. Nessuna chiamata API.")
-            all_means[m] = mean_val
-            if not report_only:
-                plot_trend_from_csv(m, mean_val, trend_points)
+        # ================================================================== #
+        #  LOOP PRINCIPALE
+        # ================================================================== #
+        all_means = {}
 
-        # ---- CASO 2: CSV incompleto o assente → scarica via API ----
-        else:
-            print(f"  → Dati non disponibili nel CSV. Scarico via API...")
-            token, polygon, width, height = get_api()
+        for m in mode:
 
-            if report_only:
+            # RGB: sempre via API, niente da cacheare
+            if m == "rgb":
+                token, polygon, width, height = get_api()
                 s_full = start + "Z" if not start.endswith("Z") else start
                 e_full = end   + "Z" if not end.endswith("Z")   else end
+                print(f"\n[RGB] Scarico immagine colori naturali {start} → {end} ...")
+                acquire()
                 url, headers, payload = make_request(
                     token, polygon, width, height,
-                    s_full, e_full, m,
-                    tree_focused=tree_focused,
+                    s_full, e_full, "rgb", tree_focused=False,
                 )
                 img = download_image(url, headers, payload)
-                _, _, mean_val, _ = extract_array_and_mean(img, m, tree_focused, tree_params)
-                if mean_val is not None:
+                if img:
+                    render({"kind": "rgb", "index": "rgb"}, _show_rgb, img, f"RGB — {period_label}")
+                continue
+
+            print(f"\n[{m.upper()}] Controllo CSV...")
+            mean_val, trend_points = read_from_csv(m)
+
+            entry = plan["indices"][m]
+
+            # ---- Solo report: media del periodo o trend completo già nel CSV ----
+            if report_only and not entry["map"]:
+                period = [p["value"] for p in stored_points().get(m, [])
+                          if (p["start"], p["end"]) == (start, end)]
+                mean_val = period[0] if period else mean_val
+                if mean_val is None:
+                    print("  → Nessuna acquisizione utile nel periodo. Nessuna chiamata API.")
+                else:
                     all_means[m] = mean_val
-                    print(f"  → media: {mean_val:.4f}")
-                    if data_file:
-                        save_datapoint(data_file, start, end, tree_focused, m, mean_val)
+                    print(f"  → Media del periodo dal CSV: {mean_val:.4f}. Nessuna chiamata API.")
+
+            # ---- CASO 1: nessuna lacuna nel CSV → nessuna API ----
+            elif trend_points is not None and not entry["windows"] and not entry["map"]:
+                print(f"  → {len(trend_points)} punti trovati nel CSV. Nessuna chiamata API.")
+                all_means[m] = mean_val
+                if not report_only:
+                    render({"kind": "trend_csv", "index": m}, plot_trend_from_csv,
+                           m, mean_val, trend_points, start, end, step_days, tree_focused)
+
+            # ---- CASO 2: CSV incompleto o assente → scarica via API ----
             else:
-                mean_val = show_index_unified(
-                    token=token,
-                    polygon=polygon,
-                    width=width,
-                    height=height,
-                    mode=m,
-                    start=start,
-                    end=end,
-                    step_days=step_days,
-                    tree_focused=tree_focused,
-                    tree_params=tree_params,
-                    data_file=data_file,
-                )
-                if mean_val is not None:
-                    all_means[m] = mean_val
-                    if data_file:
-                        save_datapoint(data_file, start, end, tree_focused, m, mean_val)
+                if entry["touched"]:
+                    print("  → Job interrotto su questo indice: ripresa dal journal.")
+                elif trend_points is not None:
+                    print(f"  → {len(trend_points)} punti nel CSV, "
+                          f"{len(entry['windows'])} finestre mancanti. Scarico solo le lacune...")
+                else:
+                    print(f"  → Dati non disponibili nel CSV. Scarico via API...")
+
+                # pipeline completa dell'indice in un worker
+                if workers is not None and not report_only:
+                    polygon, width, height, field_key = get_field()
+                    index_jobs.append((m, workers["pool"].submit(_index_pipeline, {
+                        "client_id": client_id, "client_secret": client_secret,
+                        "polygon": polygon, "width": width, "height": height,
+                        "mode": m, "start": start, "end": end, "step_days": step_days,
+                        "tree_focused": tree_focused, "tree_params": tree_params,
+                        "data_file": data_file, "field_key": field_key,
+                        "dedup_write": dedup_write, "tiles_dir": tiles_dir,
+                        "headless": headless, "permits": workers["permits"], "skip": skip,
+                        "journal": journal_subset(journal, m) if journal is not None else None,
+                    })))
+                    continue
 
-        time.sleep(0.2)
+                token, polygon, width, height = get_api()
+
+                if report_only:
+                    s_full = start + "Z" if not start.endswith("Z") else start
+                    e_full = end   + "Z" if not end.endswith("Z")   else end
+                    url, headers, payload = make_request(
+                        token, polygon, width, height,
+                        s_full, e_full, m,
+                        tree_focused=tree_focused,
+                    )
+                    acquire()
+                    img = download_image(url, headers, payload)
+                    _, _, mean_val, _ = extract_array_and_mean(img, m, tree_focused, tree_params)
+                    if mean_val is not None:
+                        all_means[m] = mean_val
+                        print(f"  → media: {mean_val:.4f}")
+                        if data_file:
+                            _save_and_count(dedup_stats, data_file, start, end, tree_focused, m, mean_val,
+                                            field_key=get_field()[3])
+                else:
+                    spec = fetch_index_data(
+                        token=get_token,
+                        polygon=polygon,
+                        width=width,
+                        height=height,
+                        mode=m,
+                        start=start,
+                        end=end,
+                        step_days=step_days,
+                        tree_focused=tree_focused,
+                        tree_params=tree_params,
+                        data_file=data_file,
+                        dedup_stats=dedup_stats,
+                        field_key=get_field()[3],
+                        journal=journal,
+                        acquire=acquire,
+                        skip=skip,
+                    )
+                    render({"kind": "index", "index": m, "mean": spec["mean_full"]},
+                           render_index_figure, spec)
+                    if tiles_dir:
+                        export_index_tiles(spec, tiles_dir)
+                    mean_val = spec["mean_full"]
+                    if mean_val is not None:
+                        all_means[m] = mean_val
+                        if data_file:
+                            _save_and_count(dedup_stats, data_file, start, end, tree_focused, m, mean_val,
+                                            field_key=get_field()[3])
+
+            time.sleep(0.2)
+
+        # ---- Risultati dei worker, nell'ordine degli indici ----
+        if workers is not None:
+            for m, future in index_jobs:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"⚠ [{m.upper()}] errore nel worker: {e}")
+                    rendered = False
+                    continue
+                info = {"kind": "index", "index": m, "mean": result["mean"]}
+                if result["spec"] is not None:
+                    render(info, render_index_figure, result["spec"])
+                else:
+                    render_jobs.append((info, _completed_future(result["file"])))
+                if dedup_stats is not None and result["dedup"] is not None:
+                    dedup_stats.setdefault("files", set()).update(result["dedup"].get("files", ()))
+                if result["mean"] is not None:
+                    all_means[m] = result["mean"]
+            all_means = {m: all_means[m] for m in mode if m in all_means}
+
+        if dedup_stats is not None:
+            finish_dedup(dedup_stats)
+            print(f"\n→ Deduplica: {dedup_stats['rows']} righe sostituite, "
+                  f"{dedup_stats['bytes']} byte recuperati.")
+
+        if all_means:
+            render({"kind": "report"}, show_final_report, all_means, period_label)
+
+        if data_file and os.path.exists(data_file):
+            generate_html_chart(None, data_file, tree_focused, output_html=chart_output,
+                                field_key=get_field()[3], max_points=chart_max_points)
+
+        if tiles_dir and os.path.isdir(tiles_dir):
+            write_tile_viewer(tiles_dir)
+
+        if renderer is not None:
+            figures  = write_render_manifest(render_jobs)
+            rendered = rendered and all(fig["status"] == "ok" for fig in figures)
+
+        # ---- Job concluso e figure disegnate: via raster delle mappe e righe superate ----
+        if journal is not None and rendered and close_backfill(journal):
+            print(f"→ Job {job} concluso: journal compattato.")
+        completed = True
+    finally:
+        if workers is not None:
+            workers["shutdown"](cancel=not completed)
+        if renderer is not None:
+            renderer.shutdown(cancel_futures=not completed)
+
+# ================= API HTTP DI SOLA LETTURA =================
+
+API_CACHE_SIZE = 256   # risposte JSON tenute in memoria (LRU)
+
+
+def _file_signature(path):
+    """(dimensione, mtime) del file: cambia a ogni scrittura del daemon/run."""
+    if not path or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def make_lru(maxsize=API_CACHE_SIZE):
+    """Cache LRU thread-safe: dict con get(key), put(key, value) e contatori."""
+    import threading
+    from collections import OrderedDict
+
+    data = OrderedDict()
+    lock = threading.Lock()
+    stats = {"hits": 0, "misses": 0}
+
+    def get(key):
+        with lock:
+            if key in data:
+                data.move_to_end(key)
+                stats["hits"] += 1
+                return data[key]
+            stats["misses"] += 1
+            return None
+
+    def put(key, value):
+        with lock:
+            data[key] = value
+            data.move_to_end(key)
+            while len(data) > maxsize:
+                data.popitem(last=False)
+
+    return {"get": get, "put": put, "stats": stats, "size": lambda: len(data)}
+
+
+def _query_rows(rows, q):
+    """Filtra le rilevazioni per field, index, tree_focused e intervallo start/end."""
+    out = rows
+    if q.get("field"):
+        out = [r for r in out if r.get("field") == q["field"]]
+    if q.get("index"):
+        wanted = set(q["index"].lower().split(","))
+        out = [r for r in out if r["index"] in wanted]
+    if q.get("tree_focused"):
+        out = [r for r in out if str(r["tree_focused"]).lower() == q["tree_focused"].lower()]
+    if q.get("start"):
+        out = [r for r in out if r["start"] >= q["start"]]
+    if q.get("end"):
+        out = [r for r in out if r["end"] <= q["end"]]
+    return [r for r in out if r["value"] not in ("", None)]
+
+
+def api_fields(rows, q):
+    fields = {}
+    for r in rows:
+        f = fields.setdefault(r.get("field") or "", {
+            "field": r.get("field") or "", "size": r.get("size") or "",
+            "step_days": r.get("step_days") or "", "indices": set(),
+            "readings": 0, "first": r["start"], "last": r["end"],
+        })
+        f["indices"].add(r["index"])
+        f["readings"] += 1
+        f["first"] = min(f["first"], r["start"])
+        f["last"]  = max(f["last"], r["end"])
+    for f in fields.values():
+        f["indices"] = sorted(f["indices"])
+    return {"fields": list(fields.values())}
 
-    if all_means:
-        show_final_report(all_means, period_label)
 
-    if data_file and os.path.exists(data_file):
-        generate_html_chart(None, data_file, tree_focused, output_html=chart_output)
+def _is_period_mean(row):
+    """
+    Vero per la media del periodo salvata da run: copre più giorni del passo
+    del trend, mentre ogni finestra ne copre al più step_days. Le righe
+    senza passo (CSV di versioni precedenti) restano punti del trend.
+    """
+    if not row.get("step_days"):
+        return False
+    days = (datetime.fromisoformat(row["end"][:10])
+            - datetime.fromisoformat(row["start"][:10])).days
+    return days > int(row["step_days"])
+
+
+def api_trend(rows, q):
+    """
+    Serie per campo e indice ({campo: {indice: [punti]}}); le medie del
+    periodo sono in "periods", con la stessa struttura, per non mescolarle
+    alle finestre del trend.
+    """
+    series  = {}
+    periods = {}
+    for r in sorted(_query_rows(rows, q), key=lambda r: r["start"]):
+        target = periods if _is_period_mean(r) else series
+        target.setdefault(r.get("field") or "", {}).setdefault(r["index"], []).append({
+            "start": r["start"], "end": r["end"],
+            "step_days": int(r["step_days"]) if r.get("step_days") else None,
+            "tree_focused": str(r["tree_focused"]).lower() == "true",
+            "value": float(r["value"]),
+        })
+    return {"query": q, "series": series, "periods": periods}
+
+
+def api_scores(rows, q):
+    selected = _query_rows(rows, q)
+    if not selected:
+        return {"query": q, "ranking": []}
+    ranked = score_table(selected)
+    ranked = ranked.astype(object).where(ranked.notna(), None)
+    return {"query": q, "ranking": ranked.to_dict("records")}
+
+
+def api_layers(tiles_dir, q):
+    layers = []
+    if tiles_dir and os.path.isdir(tiles_dir):
+        for name in sorted(os.listdir(tiles_dir)):
+            manifest_path = os.path.join(tiles_dir, name, TILE_MANIFEST)
+            if os.path.exists(manifest_path):
+                with open(manifest_path, encoding="utf-8") as f:
+                    m = json.load(f)
+                m["tiles"] = len(m.get("tiles", {}))
+                layers.append(m)
+    return {"layers": layers}
+
+
+API_ROUTES = {
+    "/fields": api_fields,
+    "/trend":  api_trend,
+    "/scores": api_scores,
+}
+
+
+def serve_api(data_file, host="127.0.0.1", port=8765, tiles_dir=None,
+              cache_size=API_CACHE_SIZE):
+    """
+    Server HTTP JSON di sola lettura sulle rilevazioni salvate:
+      /fields                                  campi presenti nello store
+      /trend?field=&index=&start=&end=&tree_focused=
+      /scores?field=&start=&end=&tree_focused= score e classifica
+      /layers                                  layer tile esportati con --tiles
+    Lo store viene riletto solo quando il file cambia; le risposte sono in
+    una LRU e hanno un ETag legato a file e query, quindi un client che
+    ripete la richiesta con If-None-Match riceve 304 senza alcun calcolo.
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit, parse_qsl
+
+    lru   = make_lru(cache_size)
+    store = {"sig": None, "rows": []}
+    store_lock = threading.Lock()
+
+    def current_rows():
+        sig = _file_signature(data_file)
+        with store_lock:
+            if sig != store["sig"]:
+                store["rows"] = _latest_rows(_read_rows(data_file)) if sig else []
+                store["sig"]  = sig
+            return store["sig"], store["rows"]
+
+    def tiles_signature():
+        if not tiles_dir or not os.path.isdir(tiles_dir):
+            return None
+        return tuple(_file_signature(os.path.join(tiles_dir, n, TILE_MANIFEST))
+                     for n in sorted(os.listdir(tiles_dir)))
+
+    class Handler(BaseHTTPRequestHandler):
+        server_version = "AgroSentinel/1.0"
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            q   = dict(parse_qsl(url.query))
+            if url.path == "/layers":
+                sig, rows = tiles_signature(), None
+            elif url.path in API_ROUTES:
+                sig, rows = current_rows()
+            else:
+                body = json.dumps({"error": f"percorso sconosciuto: {url.path}"}).encode()
+                return self._send(404, body)
+
+            key  = (url.path, tuple(sorted(q.items())), sig)
+            etag = '"' + hashlib.sha1(repr(key).encode()).hexdigest()[:20] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, b"", etag)
+
+            body = lru["get"](key)
+            if body is None:
+                result = (api_layers(tiles_dir, q) if rows is None
+                          else API_ROUTES[url.path](rows, q))
+                body = json.dumps(result, ensure_ascii=False).encode("utf-8")
+                lru["put"](key, body)
+            self._send(200, body, etag)
+
+        def _send(self, code, body, etag=None):
+            self.send_response(code)
+            if etag:
+                self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            if code != 304:
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if code != 304:
+                self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            st = lru["stats"]
+            print(f"[api] {self.address_string()} {fmt % args}  "
+                  f"(cache {st['hits']} hit / {st['misses']} miss)")
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"→ API in ascolto su http://{host}:{port}  (store: {data_file})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n→ API arrestata.")
+    finally:
+        server.server_close()
+
+# ================= DAEMON DI MONITORAGGIO =================
+
+PORTFOLIO_DEFAULTS = {
+    "indices":      ["ndvi"],
+    "step_days":    10,
+    "every_hours":  24,
+    "tree_focused": False,
+    "start":        None,   # None: 90 giorni prima dell'avvio
+    "data_file":    "datapoints.csv",
+}
+
+
+def make_rate_limiter(per_minute, history=()):
+    """
+    Distribuisce le richieste in modo uniforme nel budget per minuto:
+    acquire() attende almeno 60/per_minute secondi dalla richiesta
+    precedente e ritorna i secondi attesi; recent() conta le richieste
+    dell'ultimo minuto. history sono gli istanti (time.time()) delle
+    richieste recenti di altre esecuzioni, dal ledger: contano nel budget
+    del primo minuto.
+    """
+    interval = 60.0 / max(1, per_minute)
+    offset   = time.monotonic() - time.time()
+    sent     = deque(sorted(t + offset for t in history))
+    state    = {"next": sent[-1] + interval if sent else 0.0, "sent": sent}
+
+    def acquire():
+        now  = time.monotonic()
+        while state["sent"] and now - state["sent"][0] >= 60:
+            state["sent"].popleft()
+        wait = max(0.0, state["next"] - now)
+        if len(state["sent"]) >= per_minute:
+            wait = max(wait, state["sent"][0] + 60 - now)
+        if wait:
+            time.sleep(wait)
+            now += wait
+        state["next"] = now + interval
+        state["sent"].append(now)
+        return wait
+
+    def recent():
+        now = time.monotonic()
+        while state["sent"] and now - state["sent"][0] >= 60:
+            state["sent"].popleft()
+        return len(state["sent"])
+
+    return {"acquire": acquire, "recent": recent, "interval": interval}
+
+
+def load_portfolio(path):
+    """
+    Legge il portafoglio JSON dei campi:
+    {"defaults": {...}, "fields": [{"name": ..., "area": "campo.kml", ...}]}
+    Ogni campo eredita PORTFOLIO_DEFAULTS e "defaults"; i percorsi sono
+    relativi al file del portafoglio. KML e chiave del campo vengono letti
+    una sola volta.
+    """
+    with open(path, encoding="utf-8") as f:
+        cfg = json.load(f)
+    base     = os.path.dirname(os.path.abspath(path))
+    defaults = {**PORTFOLIO_DEFAULTS, **cfg.get("defaults", {})}
+    default_start = (datetime.now() - relativedelta(days=90)).strftime("%Y-%m-%d")
+
+    fields = []
+    for entry in cfg["fields"]:
+        spec = {**defaults, **entry}
+        area = os.path.join(base, spec["area"])
+        polygon       = get_geometry(area)
+        width, height = get_bbox_size(polygon)
+        fields.append({
+            "name":         spec.get("name") or os.path.splitext(os.path.basename(area))[0],
+            "polygon":      polygon,
+            "width":        width,
+            "height":       height,
+            "key":          make_field_key(polygon, width, height, spec["step_days"]),
+            "indices":      list(spec["indices"]),
+            "step_days":    int(spec["step_days"]),
+            "interval":     float(spec["every_hours"]) * 3600,
+            "tree_focused": bool(spec["tree_focused"]),
+            "start":        spec["start"] or default_start,
+            "data_file":    os.path.join(base, spec["data_file"]),
+        })
+    return fields
+
+
+def _stored_keys(data_file):
+    """Chiavi complete (campo, dimensione, passo, start, end, tree_focused, indice) nel CSV."""
+    if not os.path.exists(data_file):
+        return set()
+    return {_datapoint_key(r) for r in _read_rows(data_file) if r.get("value") not in ("", None)}
+
+
+def _field_window_key(field, s_date, e_date, index):
+    return (tuple(field["key"][k] for k in FIELD_KEY_COLUMNS)
+            + (s_date, e_date, str(field["tree_focused"]).lower(), index))
+
+
+# Una finestra senza dati più vecchia di così non viene più richiesta:
+# le acquisizioni recenti possono essere pubblicate o rielaborate in ritardo
+EMPTY_RETRY_DAYS = 15
+
+
+def open_daemon_journal(field):
+    """Journal del campo (accanto al CSV) in cui il daemon registra le finestre senza dati."""
+    job = backfill_job_id(field["key"], field["start"], "daemon", field["step_days"],
+                          field["tree_focused"])
+    return open_backfill(journal_path(field["data_file"]), job, [])
+
+
+def pending_windows(field, stored, today=None, journal=None):
+    """
+    Finestre complete (fine non oltre oggi) dall'inizio del campo non ancora
+    nel CSV: lista di (inizio, fine, indice). Le finestre registrate senza
+    dati nel journal vengono saltate, tranne le ultime EMPTY_RETRY_DAYS giorni.
+    """
+    today   = today or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    step    = relativedelta(days=field["step_days"])
+    retry   = today - relativedelta(days=EMPTY_RETRY_DAYS)
+    current = datetime.fromisoformat(field["start"])
+    todo    = []
+    while current + step <= today:
+        win_end = current + step
+        s_date, e_date = current.strftime("%Y-%m-%d"), win_end.strftime("%Y-%m-%d")
+        for m in field["indices"]:
+            if _field_window_key(field, s_date, e_date, m) in stored:
+                continue
+            if win_end < retry and journal_get(journal, m, "window", s_date, e_date):
+                continue
+            todo.append((current, win_end, m))
+        current = win_end
+    return todo
+
+
+def run_daemon(client_id, client_secret, portfolio, minute_rate, tree_params=None,
+               status_every=60, status_file="daemon_status.json", once=False,
+               dedup_write=False):
+    """
+    Monitoraggio continuo di un portafoglio di campi: token, sessione HTTP,
+    geometrie e chiavi del CSV restano in memoria; ogni campo viene
+    aggiornato con le sole finestre mancanti secondo la sua cadenza
+    (every_hours), con le richieste distribuite nel MINUTE_RATE.
+    Stato della coda (campi in attesa, finestre da scaricare, ritardo)
+    stampato ogni status_every secondi e scritto in status_file.
+    Con once=True esegue un solo giro su tutti i campi ed esce.
+    """
+    if tree_params is None:
+        tree_params = dict(TREE_MASK_DEFAULTS)
+
+    fields  = load_portfolio(portfolio)
+    limiter = make_rate_limiter(minute_rate, history=ledger_recent())
+    session = http_session()
+    stored  = {}
+    for f in fields:
+        if f["data_file"] not in stored:
+            stored[f["data_file"]] = _stored_keys(f["data_file"])
+    journals = [open_daemon_journal(f) for f in fields]
+
+    get_token = token_provider(client_id, client_secret)
+    stats = {"requests": 0, "saved": 0, "empty": 0, "failed": 0, "started": time.time()}
+    dedup_stats = {"rows": 0, "bytes": 0} if dedup_write else None
+
+    # Primo giro scaglionato: un campo ogni intervallo del limitatore
+    queue = [(time.time() + i * limiter["interval"], i, i) for i in range(len(fields))]
+    heapq.heapify(queue)
+    seq = len(fields)
+    status = {"next": 0.0, "current": None, "remaining": 0}
+
+    def report(force=False):
+        now = time.time()
+        if not force and now < status["next"]:
+            return
+        status["next"] = now + status_every
+        overdue = [(due, i) for due, _, i in queue if due <= now]
+        windows = status["remaining"] + sum(
+            len(pending_windows(fields[i], stored[fields[i]["data_file"]], journal=journals[i]))
+            for _, i in overdue
+        )
+        lag = now - min(due for due, _ in overdue) if overdue else 0.0
+        snapshot = {
+            "time":         datetime.now().isoformat(timespec="seconds"),
+            "fields":       len(fields),
+            "queued":       len(overdue),
+            "windows":      windows,
+            "lag_s":        round(lag, 1),
+            "current":      status["current"],
+            "req_last_min": limiter["recent"](),
+            "minute_rate":  minute_rate,
+            "requests":     stats["requests"],
+            "saved":        stats["saved"],
+            "empty":        stats["empty"],
+            "failed":       stats["failed"],
+            "next_due":     (datetime.fromtimestamp(queue[0][0]).isoformat(timespec="seconds")
+                             if queue else None),
+        }
+        print(f"[daemon {snapshot['time'][11:]}] coda: {snapshot['queued']} campi, "
+              f"{windows} finestre · ritardo {lag:.0f} s · "
+              f"{snapshot['req_last_min']}/{minute_rate} richieste/min · "
+              f"salvate {stats['saved']}, vuote {stats['empty']}, fallite {stats['failed']}")
+        if status_file:
+            tmp = status_file + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(snapshot, fh, indent=2)
+            os.replace(tmp, status_file)
+
+    print(f"→ Daemon: {len(fields)} campi, budget {minute_rate} richieste/min")
+    try:
+        while queue:
+            now = time.time()
+            due, _, i = queue[0]
+            if due > now:
+                report()
+                time.sleep(max(0.0, min(due, status["next"]) - time.time()))
+                continue
+
+            heapq.heappop(queue)
+            field = fields[i]
+            store = stored[field["data_file"]]
+            todo  = pending_windows(field, store, journal=journals[i])
+            status["current"] = field["name"]
+            print(f"\n[{field['name']}] {len(todo)} finestre da aggiornare "
+                  f"(ritardo {now - due:.0f} s)")
+
+            for n, (win_start, win_end, m) in enumerate(todo):
+                status["remaining"] = len(todo) - n
+                limiter["acquire"]()
+                s_date = win_start.strftime("%Y-%m-%d")
+                e_date = win_end.strftime("%Y-%m-%d")
+                try:
+                    mean = fetch_window_mean(
+                        get_token(), field["polygon"], field["width"], field["height"], m,
+                        win_start, win_end, field["tree_focused"], tree_params, session=session,
+                    )
+                    stats["requests"] += 1
+                    if mean is not None and not np.isnan(mean):
+                        _save_and_count(dedup_stats, field["data_file"], s_date, e_date,
+                                        field["tree_focused"], m, mean, field_key=field["key"])
+                except Exception as e:
+                    # token, rete o scrittura: la finestra resta mancante
+                    mean = None
+                    print(f"  ⚠ {m.upper()} {s_date} → {e_date}: {type(e).__name__}: {e}")
+                if mean is None:
+                    # ritentata al prossimo giro: la finestra resta mancante
+                    stats["failed"] += 1
+                    print(f"  {m.upper()} {s_date} → {e_date}: richiesta fallita")
+                    report()
+                    continue
+                if np.isnan(mean):
+                    stats["empty"] += 1
+                    journal_set(journals[i], m, "window", s_date, e_date, "empty")
+                else:
+                    store.add(_field_window_key(field, s_date, e_date, m))
+                    stats["saved"] += 1
+                print(f"  {m.upper()} {s_date} → {e_date}: "
+                      + (f"{mean:.4f}" if not np.isnan(mean) else "no data"))
+                report()
+
+            finish_dedup(dedup_stats)
+            status["current"], status["remaining"] = None, 0
+            if not once:
+                # cadenza fissa rispetto alla scadenza, non alla fine del giro
+                heapq.heappush(queue, (max(due + field["interval"], time.time()), seq, i))
+                seq += 1
+    except KeyboardInterrupt:
+        print("\n→ Daemon interrotto.")
+
+    finish_dedup(dedup_stats)
+    report(force=True)
+    elapsed = time.time() - stats["started"]
+    print(f"→ {stats['requests']} richieste in {elapsed:.0f} s, "
+          f"{stats['saved']} rilevazioni salvate, {stats['empty']} finestre senza dati.")
 
 # ================= CLI =================
 
@@ -2108,8 +5028,64 @@ if __name__ == "__main__":
                         help="File CSV per salvare/caricare le rilevazioni")
     parser.add_argument("--chart-only", action="store_true",
                         help="Genera solo il grafico HTML dal CSV esistente, senza chiamate API")
+    parser.add_argument("--compact", action="store_true",
+                        help="Compatta il CSV mantenendo solo l'ultima rilevazione per chiave ed esce")
+    parser.add_argument("--rank", nargs="?", const="ranking.csv", default=None, metavar="FILE",
+                        help="Calcola score e classifica di tutte le rilevazioni del CSV "
+                             "per campo/periodo, la salva in FILE (default: ranking.csv) ed esce")
+    parser.add_argument("--dedup-write", action="store_true",
+                        help="Rimuove le rilevazioni sostituite da quelle appena scritte "
+                             "(una compattazione a fine esecuzione)")
+    parser.add_argument("--ledger", default=LEDGER_FILE, metavar="FILE",
+                        help="Ledger SQLite delle richieste e delle PU stimate "
+                             f"(default: {LEDGER_FILE}); 'none' lo disattiva")
+    parser.add_argument("--usage", nargs="?", type=int, const=30, default=None, metavar="GIORNI",
+                        help="Stampa il consumo giornaliero (ultimi GIORNI, default 30) e "
+                             "mensile per campo registrato nel ledger ed esce")
+    parser.add_argument("--journal", default=None, metavar="FILE",
+                        help="Journal dei backfill per la ripresa dopo un'interruzione "
+                             "(default: <data-file>.journal.jsonl)")
     parser.add_argument("--chart-output", default="chart.html",
                         help="Nome del file HTML del grafico (default: chart.html)")
+    parser.add_argument("--chart-max-points", type=int, default=CHART_MAX_POINTS,
+                        help="Punti per indice inclusi nel grafico HTML; le serie più lunghe "
+                             f"vengono ricampionate (default: {CHART_MAX_POINTS})")
+
+    parser.add_argument("--serve", nargs="?", type=int, const=8765, default=None, metavar="PORT",
+                        help="Avvia l'API JSON di sola lettura su --data-file (default porta 8765)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Con --serve: indirizzo di ascolto (default: 127.0.0.1)")
+    parser.add_argument("--daemon", default=None, metavar="PORTFOLIO",
+                        help="Monitoraggio continuo dei campi descritti nel portafoglio JSON")
+    parser.add_argument("--once", action="store_true",
+                        help="Con --daemon: un solo aggiornamento di tutti i campi, poi esce")
+    parser.add_argument("--status-every", type=float, default=60,
+                        help="Con --daemon: secondi tra due stampe dello stato (default: 60)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Stampa il piano (finestre mancanti, richieste, pixel, PU, "
+                             "durata a MINUTE_RATE) senza scaricare nulla")
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="FILE",
+                        help="Traccia Chrome dei tempi per fase (auth, KML, rete, TIFF, maschera, "
+                             "percentili, matplotlib, CSV) in FILE (default profile_<data>.json) "
+                             "e riepilogo con totale, p50 e p95")
+    parser.add_argument("--base-url", default=None, metavar="URL",
+                        help="Server alternativo per token, Process e catalogo con gli stessi "
+                             "percorsi (es. http://127.0.0.1:8990 di mock_sentinel.py)")
+    parser.add_argument("--no-catalog", action="store_true",
+                        help="Non consulta il catalogo: richiede tutte le finestre mancanti")
+    parser.add_argument("--catalog-url", default=None,
+                        help="Endpoint STAC /search del catalogo (es. un servizio locale di prova)")
+    parser.add_argument("--index-workers", type=int, default=1, metavar="N",
+                        help="Processi per la pipeline degli indici (download, statistiche, "
+                             "figura); le richieste restano entro MINUTE_RATE (default: 1)")
+    parser.add_argument("--tiles", default=None, metavar="DIR",
+                        help="Esporta le mappe degli indici come tile XYZ in DIR "
+                             "con un visualizzatore HTML (solo tile modificate)")
+    parser.add_argument("--headless", action="store_true",
+                        help="Nessuna finestra: figure renderizzate in parallelo (backend Agg) "
+                             "e salvate in PNG con un manifest")
+    parser.add_argument("--render-workers", type=int, default=None,
+                        help="Processi per il rendering in modalità --headless (default: n. CPU)")
 
     # ---- flag chiome arboree ----
     parser.add_argument("--tree-focus", action="store_true",
@@ -2137,18 +5113,60 @@ if __name__ == "__main__":
         "shadow_threshold": args.shadow_thresh,
     }
 
-    run(
-        client_id     = config["AUTH"]["CLIENT_ID"],
-        client_secret = config["AUTH"]["CLIENT_SECRET"],
-        kml           = args.area,
-        start         = args.start,
-        end           = args.end,
-        mode          = modes,
-        step_days     = args.step,
-        report_only   = args.report_only,
-        tree_focused  = args.tree_focus,
-        tree_params   = tree_params,
-        data_file     = args.data_file,
-        chart_only    = args.chart_only,
-        chart_output  = args.chart_output,
-    )
\ No newline at end of file
+    open_ledger(None if args.ledger.lower() == "none" else args.ledger)
+    if args.base_url:
+        set_base_url(args.base_url)
+
+    if args.usage is not None:
+        print_usage(args.usage)
+    elif args.serve is not None:
+        if not args.data_file:
+            parser.error("--serve richiede --data-file")
+        serve_api(args.data_file, host=args.host, port=args.serve, tiles_dir=args.tiles)
+    elif args.daemon:
+        run_daemon(
+            client_id     = config["AUTH"]["CLIENT_ID"],
+            client_secret = config["AUTH"]["CLIENT_SECRET"],
+            portfolio     = args.daemon,
+            minute_rate   = config.getint("REQ", "MINUTE_RATE", fallback=95),
+            tree_params   = tree_params,
+            status_every  = args.status_every,
+            once          = args.once,
+            dedup_write   = args.dedup_write,
+        )
+    else:
+        if args.profile is not None:
+            enable_profile(args.profile or f"profile_{datetime.now():%Y%m%d_%H%M%S}.json")
+        try:
+            with span("run"):
+                run(
+                    client_id     = config["AUTH"]["CLIENT_ID"],
+                    client_secret = config["AUTH"]["CLIENT_SECRET"],
+                    kml           = args.area,
+                    start         = args.start,
+                    end           = args.end,
+                    mode          = modes,
+                    step_days     = args.step,
+                    report_only   = args.report_only,
+                    tree_focused  = args.tree_focus,
+                    tree_params   = tree_params,
+                    data_file     = args.data_file,
+                    chart_only    = args.chart_only,
+                    chart_output  = args.chart_output,
+                    compact       = args.compact,
+                    dedup_write   = args.dedup_write,
+                    headless      = args.headless,
+                    render_workers = args.render_workers,
+                    chart_max_points = args.chart_max_points,
+                    tiles_dir     = args.tiles,
+                    rank_output   = args.rank,
+                    journal_file  = args.journal,
+                    dry_run       = args.dry_run,
+                    catalog       = not args.no_catalog,
+                    catalog_url   = args.catalog_url,
+                    monthly_pu    = config.getfloat("REQ", "MONTHLY_PU", fallback=0),
+                    index_workers = args.index_workers,
+                    minute_rate   = config.getint("REQ", "MINUTE_RATE", fallback=95),
+                )
+        finally:
+            write_profile()
\ No newline at end of file
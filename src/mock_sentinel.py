@@ -0,0 +1,311 @@
+import numpy as np
+from datetime import datetime, timedelta
+from collections import deque
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+# Server locale che imita gli endpoint Copernicus usati da main.py (token
+# OAuth, Process API e ricerca nel catalogo STAC), per provare e misurare
+# il download senza credenziali né rete:
+#
+#   python ./mock_sentinel.py -port 8990 -latency 250 -jitter 80 -rate-limit 95
+#   python ./main.py --base-url http://127.0.0.1:8990 ...
+#
+# Le immagini sono GeoTIFF sintetici deterministici: stessa richiesta,
+# stessi pixel.
+
+TOKEN_PATH   = "/auth/realms/CDSE/protocol/openid-connect/token"
+PROCESS_PATH = "/api/v1/process"
+CATALOG_PATH = "/api/v1/catalog/1.0.0/search"
+
+S2_EPOCH = datetime(2015, 6, 27, 10, 30)   # lancio di Sentinel-2A
+REVISIT_DAYS = 5
+
+MOCK_DEFAULTS = {
+    "latency_ms":  0.0,     # latenza media di ogni risposta Process
+    "jitter_ms":   0.0,     # deviazione standard della latenza
+    "rate_limit":  0,       # richieste Process al minuto oltre cui risponde 429 (0: nessun limite)
+    "error_rate":  0.0,     # probabilità di un errore 500/503
+    "empty_ratio": 0.1,     # frazione di finestre senza dati (immagine tutta NaN)
+    "token_ttl":   3600,    # validità dei token in secondi
+    "seed":        0,
+    "verbose":     False,
+}
+
+# ================= DATI SINTETICI =================
+
+def _seed(*parts):
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return int(hashlib.sha1(text.encode()).hexdigest()[:16], 16)
+
+
+def _geometry_bounds(geometry):
+    """(min lon, min lat, max lon, max lat) di una geometria GeoJSON Polygon/MultiPolygon."""
+    polys = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+    pts   = np.array([c[:2] for poly in polys for c in poly[0]], dtype=float)
+    return pts[:, 0].min(), pts[:, 1].min(), pts[:, 0].max(), pts[:, 1].max()
+
+
+def _parse_time(text):
+    return datetime.fromisoformat(text.replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+def synthetic_bands(geometry, t_from, t_to, width, height, empty_ratio=0.1):
+    """
+    Bande B02, B03, B04, B08 di un campo con chiome disposte a griglia (come
+    un uliveto) su suolo nudo. La vigoria segue la stagione del centro della
+    finestra; nuvole e finestre vuote dipendono solo da campo e periodo.
+    """
+    field_rng = np.random.default_rng(_seed(geometry))
+    rng       = np.random.default_rng(_seed(geometry, t_from, t_to))
+
+    start, end = _parse_time(t_from), _parse_time(t_to)
+    if rng.random() < empty_ratio or end <= start:
+        nan = np.full((height, width), np.nan, dtype=np.float32)
+        return nan, nan, nan, nan
+
+    mid    = start + (end - start) / 2
+    season = 0.55 + 0.4 * np.sin(2 * np.pi * (mid.timetuple().tm_yday - 100) / 365.0)
+
+    rows   = np.arange(height, dtype=np.float32)[:, None]
+    cols   = np.arange(width, dtype=np.float32)[None, :]
+    step   = field_rng.uniform(5, 9)   # sesto d'impianto in pixel
+    canopy = (np.sin(2 * np.pi * rows / step + field_rng.uniform(0, 6)) *
+              np.sin(2 * np.pi * cols / step + field_rng.uniform(0, 6)))
+    canopy = np.clip((canopy - 0.3) / 0.7, 0, 1).astype(np.float32)
+
+    noise = lambda scale: rng.normal(0, scale, (height, width)).astype(np.float32)
+    b02 = 0.08 - 0.04 * canopy + noise(0.005)
+    b03 = 0.10 - 0.05 * canopy + noise(0.005)
+    b04 = 0.15 - 0.12 * canopy * season + noise(0.006)
+    b08 = 0.20 + 0.20 * canopy * season + noise(0.008)
+
+    cloud = rng.uniform(0, 0.35)
+    if cloud > 0.05:
+        mask = rng.random((height // 8 + 1, width // 8 + 1)) < cloud
+        mask = np.repeat(np.repeat(mask, 8, axis=0), 8, axis=1)[:height, :width]
+        for band in (b02, b03, b04, b08):
+            band[mask] = np.nan
+    return b02, b03, b04, b08
+
+
+def render_process(payload, empty_ratio=0.1):
+    """GeoTIFF della risposta Process: bande e tipo secondo l'output dell'evalscript."""
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_bounds
+
+    width, height = payload["output"]["width"], payload["output"]["height"]
+    geometry      = payload["input"]["bounds"]["geometry"]
+    time_range    = payload["input"]["data"][0]["dataFilter"]["timeRange"]
+    script        = payload["evalscript"]
+
+    n_out  = int(re.search(r"bands:\s*(\d+)", script).group(1))
+    sample = re.search(r'sampleType:\s*"(\w+)"', script)
+    sample = sample.group(1) if sample else "FLOAT32"
+
+    b02, b03, b04, b08 = synthetic_bands(geometry, time_range["from"], time_range["to"],
+                                         width, height, empty_ratio)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ndvi = (b08 - b04) / (b08 + b04)
+
+    if sample == "UINT8":
+        rgb  = np.stack([b04, b03, b02]) * 255 * 3.5
+        data = np.nan_to_num(np.clip(rgb, 0, 255)).astype(np.uint8)[:n_out]
+    elif n_out >= 4:
+        data = np.stack([b03, b04, b08, ndvi]).astype(np.float32)
+    else:
+        data = np.stack([ndvi] * n_out).astype(np.float32)
+
+    transform = from_bounds(*_geometry_bounds(geometry), width, height)
+    with MemoryFile() as mem:
+        with mem.open(driver="GTiff", width=width, height=height, count=data.shape[0],
+                      dtype=data.dtype, crs="EPSG:4326", transform=transform) as dst:
+            dst.write(data)
+        return mem.read()
+
+
+def catalog_features(geometry, dt_from, dt_to):
+    """Acquisizioni ogni REVISIT_DAYS giorni con copertura nuvolosa deterministica."""
+    start, end = _parse_time(dt_from), _parse_time(dt_to)
+    offset = timedelta(days=_seed(geometry) % REVISIT_DAYS)
+    n   = max(0, (start - S2_EPOCH - offset).days // REVISIT_DAYS)
+    day = S2_EPOCH + offset + timedelta(days=n * REVISIT_DAYS)
+    features = []
+    while day <= end:
+        if day >= start:
+            stamp = day.strftime("%Y-%m-%dT%H:%M:%SZ")
+            u     = (_seed(geometry, stamp) % 10000) / 10000.0
+            cloud = round(100 * u * u, 2)   # per lo più scene poco nuvolose
+            features.append({
+                "type":       "Feature",
+                "id":         f"S2_MOCK_{day:%Y%m%d}",
+                "properties": {"datetime": stamp, "eo:cloud_cover": cloud},
+            })
+        day += timedelta(days=REVISIT_DAYS)
+    return features
+
+# ================= SERVER =================
+
+def make_server(host="127.0.0.1", port=0, **options):
+    """
+    Server HTTP con gli endpoint token, Process e catalogo; GET /stats ritorna
+    i contatori. Ritorna (server, stats): il server non è ancora avviato.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qsl
+
+    opts  = dict(MOCK_DEFAULTS, **options)
+    rng   = random.Random(opts["seed"])
+    lock  = threading.Lock()
+    sent  = deque()
+    stats = {"tokens": 0, "process": 0, "catalog": 0, "ok": 0,
+             "rate_limited": 0, "errors": 0, "unauthorized": 0}
+
+    def admit():
+        """Esito della richiesta Process: 200, 429 oltre il limite, 500/503 casuali."""
+        with lock:
+            stats["process"] += 1
+            now = time.monotonic()
+            while sent and now - sent[0] >= 60:
+                sent.popleft()
+            if opts["rate_limit"] and len(sent) >= opts["rate_limit"]:
+                stats["rate_limited"] += 1
+                return 429, sent[0] + 60 - now
+            sent.append(now)
+            if rng.random() < opts["error_rate"]:
+                stats["errors"] += 1
+                return rng.choice((500, 503)), 0
+            delay = max(0.0, rng.gauss(opts["latency_ms"], opts["jitter_ms"])) / 1000.0
+        return 200, delay
+
+    class Handler(BaseHTTPRequestHandler):
+        server_version = "MockSentinel/1.0"
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/stats":
+                with lock:
+                    return self._send(200, json.dumps(stats).encode())
+            self._send(404, b'{"error": "not found"}')
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == TOKEN_PATH:
+                form = dict(parse_qsl(body.decode()))
+                if form.get("grant_type") != "client_credentials":
+                    return self._send(400, b'{"error": "unsupported_grant_type"}')
+                with lock:
+                    stats["tokens"] += 1
+                    n = stats["tokens"]
+                token = {"access_token": f"mock-{n}", "token_type": "Bearer",
+                         "expires_in": opts["token_ttl"]}
+                return self._send(200, json.dumps(token).encode())
+
+            if not self.headers.get("Authorization", "").startswith("Bearer "):
+                with lock:
+                    stats["unauthorized"] += 1
+                return self._send(401, b'{"error": "missing bearer token"}')
+
+            if self.path == PROCESS_PATH:
+                status, delay = admit()
+                if status == 429:
+                    return self._send(429, b'{"error": "rate limit exceeded"}',
+                                      headers={"Retry-After": f"{delay:.1f}"})
+                if status != 200:
+                    return self._send(status, b'{"error": "injected failure"}')
+                time.sleep(delay)
+                tiff = render_process(json.loads(body), opts["empty_ratio"])
+                with lock:
+                    stats["ok"] += 1
+                return self._send(200, tiff, content_type="image/tiff")
+
+            if self.path == CATALOG_PATH:
+                query = json.loads(body)
+                dt_from, dt_to = query["datetime"].split("/")
+                features = catalog_features(query["intersects"], dt_from, dt_to)
+                limit  = min(int(query.get("limit", 10)), 100)
+                offset = int(query.get("next", 0))
+                page   = {"type": "FeatureCollection", "features": features[offset:offset + limit],
+                          "context": {"limit": limit, "returned": len(features[offset:offset + limit])}}
+                if offset + limit < len(features):
+                    page["context"]["next"] = offset + limit
+                with lock:
+                    stats["catalog"] += 1
+                return self._send(200, json.dumps(page).encode())
+
+            self._send(404, b'{"error": "not found"}')
+
+        def _send(self, code, body, content_type="application/json", headers=None):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            if opts["verbose"]:
+                print(f"[mock] {fmt % args}")
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server, stats
+
+
+def start_mock(host="127.0.0.1", port=0, **options):
+    """
+    Avvia il server in un thread (porta libera con port=0).
+    Ritorna {"url", "stats", "stop"}.
+    """
+    server, stats = make_server(host, port, **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+
+    return {"url": f"http://{host}:{server.server_address[1]}", "stats": stats, "stop": stop}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Server locale che imita token, Process API e catalogo Sentinel Hub."
+    )
+    parser.add_argument("-host", default="127.0.0.1")
+    parser.add_argument("-port", type=int, default=8990)
+    parser.add_argument("-latency", type=float, default=0.0,
+                        help="Latenza media delle risposte Process in millisecondi")
+    parser.add_argument("-jitter", type=float, default=0.0,
+                        help="Deviazione standard della latenza in millisecondi")
+    parser.add_argument("-rate-limit", type=int, default=0,
+                        help="Richieste Process al minuto oltre cui risponde 429 (0: nessun limite)")
+    parser.add_argument("-error-rate", type=float, default=0.0,
+                        help="Probabilità di una risposta 500/503 (0-1)")
+    parser.add_argument("-empty-ratio", type=float, default=MOCK_DEFAULTS["empty_ratio"],
+                        help="Frazione di finestre senza dati")
+    parser.add_argument("-token-ttl", type=int, default=MOCK_DEFAULTS["token_ttl"],
+                        help="Validità dei token in secondi")
+    parser.add_argument("-seed", type=int, default=0)
+    parser.add_argument("-verbose", action="store_true", help="Stampa ogni richiesta")
+    args = parser.parse_args()
+
+    server, stats = make_server(
+        args.host, args.port,
+        latency_ms=args.latency, jitter_ms=args.jitter, rate_limit=args.rate_limit,
+        error_rate=args.error_rate, empty_ratio=args.empty_ratio,
+        token_ttl=args.token_ttl, seed=args.seed, verbose=args.verbose,
+    )
+    print(f"→ Mock Sentinel Hub su http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n→ Mock arrestato: {json.dumps(stats)}")
+    finally:
+        server.server_close()
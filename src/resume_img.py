@@ -2,130 +2,442 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import pandas as pd
 import numpy as np
+import glob
+import json
 import os
+import re
 import argparse
 
 
-def describe_indices(values):
-    # Dizionario di regole per ogni indice
-    rules = {
-        "NDVI": [
-            (0.0, "area non vegetata o terreno zuppo"),
-            (0.3, "scarsa densità vegetativa"),
-            (0.6, "moderata densità vegetativa"),
-            (1.0, "zona densamente vegetata")
-        ],
-        "NDRE": [
-            (0.2, "vegetazione altamente stressata ed improduttiva"),
-            (0.4, "vegetazione moderatamente stressata produttivamente"),
-            (0.6, "vegetazione produttiva"),
-            (1.0, "vegetazione sana e vigorosa")
-        ],
-        "GCI": [
-            (1, "Scarsa qta clorofilla - vegetazione inattiva"),
-            (2, "Poca qta clorofilla - vegetazione poco attiva"),
-            (3, "Sufficiente clorofilla - vegetazione attiva"),
-            (4, "Molta clorofilla - vegetazione molto attiva"),
-            (10, "Abbondante clorofilla - vegetazione abbondantemente attiva")
-        ],
-        "NDMI": [
-            (0.0, "area non vegetata"),
-            (0.1, "vegetazione con elevato stress idrico (o in spigamento)"),
-            (0.4, "scarsa idratazione"),
-            (0.6, "vegetazione regolare con esigenze idriche"),
-            (1.0, "vegetazione con riserve idriche abbondanti")
-        ]
+INDEX_COLUMNS = ["NDVI", "NDRE", "NDMI", "GCI"]
+
+# ================= FORMATO BINARIO COLONNARE =================
+
+MANIFEST_NAME = "manifest.json"
+
+def binary_dir(csv_path):
+    """Cartella che contiene la versione binaria di un file *_pixels.csv"""
+    return os.path.splitext(csv_path)[0]
+
+
+def load_manifest(csv_path):
+    """
+    Ritorna il manifest della versione binaria se esiste ed è aggiornata
+    rispetto al CSV (stessa dimensione e data di modifica), altrimenti None.
+    Se il CSV è stato rimosso dopo la conversione il manifest è sempre valido.
+    """
+    manifest_path = os.path.join(binary_dir(csv_path), MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    if os.path.exists(csv_path):
+        st = os.stat(csv_path)
+        if st.st_size != manifest["source_size"] or st.st_mtime != manifest["source_mtime"]:
+            return None
+    return manifest
+
+
+def convert_pixels_csv(csv_path, remove_csv=False):
+    """
+    Converte un *_pixels.csv in un file .npy float32 per ogni colonna numerica
+    più un manifest.json. Il manifest viene scritto per ultimo: la sua presenza
+    indica una conversione completa.
+    Ritorna (byte del CSV, byte della versione binaria).
+    """
+    out_dir = binary_dir(csv_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    df = pd.read_csv(csv_path)
+    columns = {}
+    binary_size = 0
+    for col in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            continue
+        fname = re.sub(r"[^\w.-]", "_", str(col)) + ".npy"
+        path  = os.path.join(out_dir, fname)
+        np.save(path, df[col].to_numpy(dtype=np.float32))
+        columns[col] = fname
+        binary_size += os.path.getsize(path)
+
+    st = os.stat(csv_path)
+    manifest = {
+        "source":       os.path.basename(csv_path),
+        "source_size":  st.st_size,
+        "source_mtime": st.st_mtime,
+        "rows":         len(df),
+        "dtype":        "float32",
+        "columns":      columns,
     }
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    binary_size += os.path.getsize(manifest_path)
 
-    description_parts = []
+    if remove_csv:
+        os.remove(csv_path)
+
+    return st.st_size, binary_size
+
+
+def pixel_file_exists(csv_path):
+    """Vero se il giorno è disponibile in CSV oppure in formato binario."""
+    return os.path.exists(csv_path) or load_manifest(csv_path) is not None
+
+
+def load_pixel_columns(csv_path, columns=INDEX_COLUMNS):
+    """
+    Ritorna dict: { colonna: array 1D } per le colonne richieste.
+    Se esiste la versione binaria aggiornata gli array sono memory-mapped,
+    altrimenti si ripiega sulla lettura del CSV.
+    """
+    manifest = load_manifest(csv_path)
+    if manifest is not None:
+        base = binary_dir(csv_path)
+        return {
+            c: np.load(os.path.join(base, manifest["columns"][c]), mmap_mode="r")
+            for c in columns
+        }
+
+    df = pd.read_csv(csv_path, usecols=columns)
+    return {c: df[c].to_numpy() for c in columns}
+
+# ================= AGGREGAZIONE GIORNALIERA =================
+
+def iter_pixel_chunks(csv_path, chunksize=None, columns=INDEX_COLUMNS):
+    """
+    Itera sul file di un giorno a blocchi di al più chunksize righe.
+    Con chunksize None ritorna un unico blocco con tutte le righe.
+    """
+    if chunksize is None:
+        yield load_pixel_columns(csv_path, columns)
+        return
+
+    manifest = load_manifest(csv_path)
+    if manifest is not None:
+        cols = load_pixel_columns(csv_path, columns)
+        for i in range(0, manifest["rows"], chunksize):
+            yield {c: cols[c][i:i + chunksize] for c in columns}
+        return
+
+    for df in pd.read_csv(csv_path, usecols=columns, chunksize=chunksize):
+        yield {c: df[c].to_numpy() for c in columns}
+
+
+def accumulate_stats(stats, cols):
+    """
+    Aggiorna somme, somme dei quadrati e conteggi per indice con un blocco
+    di pixel. Un pixel è
+    escluso se almeno uno degli indici vale 0; i NaN sono ignorati colonna
+    per colonna.
+    """
+    valid = np.ones(len(cols[INDEX_COLUMNS[0]]), dtype=bool)
+    for c in INDEX_COLUMNS:
+        valid &= (cols[c] != 0)
+
+    for c in INDEX_COLUMNS:
+        values = np.asarray(cols[c][valid], dtype=np.float64)
+        values = values[~np.isnan(values)]
+        stats[c]["sum"]   += float(values.sum())
+        stats[c]["sumsq"] += float(np.dot(values, values))
+        stats[c]["count"] += len(values)
+
+
+def daily_stats(csv_path, chunksize=None):
+    """
+    Somme, somme dei quadrati e conteggi dei pixel validi di un giorno.
+    Ritorna dict: { indice: {"sum": float, "sumsq": float, "count": int} }
+    """
+    stats = {c: {"sum": 0.0, "sumsq": 0.0, "count": 0} for c in INDEX_COLUMNS}
+    for chunk in iter_pixel_chunks(csv_path, chunksize):
+        accumulate_stats(stats, chunk)
+    return stats
+
+
+def stats_means(stats):
+    return {
+        c: s["sum"] / s["count"] if s["count"] > 0 else np.nan
+        for c, s in stats.items()
+    }
+
+# ================= RIEPILOGHI GIORNALIERI (SIDECAR) =================
 
-    for index_name, value in values.items():
-        if index_name in ["NDRE"]: continue
-        thresholds = rules.get(index_name)
-        if not thresholds:
+def summary_path(csv_path):
+    return binary_dir(csv_path) + ".summary.json"
+
+
+def _source_signature(csv_path):
+    """Dimensione e data di modifica del CSV, o del CSV convertito se rimosso."""
+    if os.path.exists(csv_path):
+        st = os.stat(csv_path)
+        return st.st_size, st.st_mtime
+    manifest = load_manifest(csv_path)
+    return manifest["source_size"], manifest["source_mtime"]
+
+
+def load_daily_summary(csv_path, chunksize=None):
+    """
+    Ritorna le statistiche del giorno dal sidecar *.summary.json.
+    Il sidecar viene calcolato e scritto solo se assente o non aggiornato
+    rispetto al file dei pixel.
+    """
+    size, mtime = _source_signature(csv_path)
+    path = summary_path(csv_path)
+
+    if os.path.exists(path):
+        with open(path) as f:
+            summary = json.load(f)
+        if summary["source_size"] == size and summary["source_mtime"] == mtime:
+            return summary["stats"]
+
+    stats = daily_stats(csv_path, chunksize=chunksize)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"source_size": size, "source_mtime": mtime, "stats": stats}, f)
+    os.replace(path + ".tmp", path)
+    return stats
+
+
+def combine_stats(daily):
+    """Somma le statistiche di più giorni (lista di dict da daily_stats)."""
+    total = {c: {"sum": 0.0, "sumsq": 0.0, "count": 0} for c in INDEX_COLUMNS}
+    for stats in daily:
+        for c in INDEX_COLUMNS:
+            for k in ("sum", "sumsq", "count"):
+                total[c][k] += stats[c][k]
+    return total
+
+
+def stats_variances(stats):
+    """Varianza (di popolazione) per indice, pesata sul numero di pixel."""
+    result = {}
+    for c, s in stats.items():
+        if s["count"] == 0:
+            result[c] = np.nan
+            continue
+        mean = s["sum"] / s["count"]
+        result[c] = max(s["sumsq"] / s["count"] - mean * mean, 0.0)
+    return result
+
+
+def convert_all(data_dir, area=None, remove_csv=False):
+    pattern = f"{area}_*_pixels.csv" if area else "*_pixels.csv"
+    total_csv, total_bin, converted = 0, 0, 0
+
+    for csv_path in sorted(glob.glob(os.path.join(data_dir, pattern))):
+        if load_manifest(csv_path) is not None:
+            if remove_csv:
+                os.remove(csv_path)
+            continue
+        csv_size, bin_size = convert_pixels_csv(csv_path, remove_csv=remove_csv)
+        total_csv += csv_size
+        total_bin += bin_size
+        converted += 1
+        print(f"{os.path.basename(csv_path)}: {csv_size/1e6:.2f} MB → {bin_size/1e6:.2f} MB")
+
+    if converted:
+        print(f"\nConvertiti {converted} file: {total_csv/1e6:.2f} MB → {total_bin/1e6:.2f} MB "
+              f"(x{total_csv / max(total_bin, 1):.1f})")
+    else:
+        print("Nessun file da convertire.")
+
+
+# ================= DESCRIZIONE INDICI =================
+
+# Regole per ogni indice: la classe è la prima soglia >= valore.
+# Valori oltre l'ultima soglia (o NaN) non hanno descrizione.
+INDEX_RULES = {
+    "NDVI": [
+        (0.0, "area non vegetata o terreno zuppo"),
+        (0.3, "scarsa densità vegetativa"),
+        (0.6, "moderata densità vegetativa"),
+        (1.0, "zona densamente vegetata")
+    ],
+    "NDRE": [
+        (0.2, "vegetazione altamente stressata ed improduttiva"),
+        (0.4, "vegetazione moderatamente stressata produttivamente"),
+        (0.6, "vegetazione produttiva"),
+        (1.0, "vegetazione sana e vigorosa")
+    ],
+    "GCI": [
+        (1, "Scarsa qta clorofilla - vegetazione inattiva"),
+        (2, "Poca qta clorofilla - vegetazione poco attiva"),
+        (3, "Sufficiente clorofilla - vegetazione attiva"),
+        (4, "Molta clorofilla - vegetazione molto attiva"),
+        (10, "Abbondante clorofilla - vegetazione abbondantemente attiva")
+    ],
+    "NDMI": [
+        (0.0, "area non vegetata"),
+        (0.1, "vegetazione con elevato stress idrico (o in spigamento)"),
+        (0.4, "scarsa idratazione"),
+        (0.6, "vegetazione regolare con esigenze idriche"),
+        (1.0, "vegetazione con riserve idriche abbondanti")
+    ]
+}
+
+# Fasce di efficienza GCI/NDRE: <6, [6, 10], (10, 12), [12, 15), >=15.
+# Con searchsorted(side="right") la soglia 10 è inclusa nella fascia
+# "in salute" spostandola al float successivo. NaN ricade nell'ultima fascia.
+EFFICIENCY_EDGES = np.array([6.0, np.nextafter(10.0, np.inf), 12.0, 15.0])
+EFFICIENCY_LABELS = [
+    "Vegetazione giovane o potata (0-6)",
+    "Vegetazione in salute (6 - 10)",
+    "Vegetazione leggermente stressata, attenzionare eventuali patogeni (10-12)",
+    "Vegetazione inefficiente, clorofilla inattiva, monitorare per patologie(12 - 15)",
+    "Vegetazione molto malata (>15) - patologie",
+]
+
+_RULE_EDGES  = {k: np.array([t for t, _ in r], dtype=np.float64) for k, r in INDEX_RULES.items()}
+_RULE_LABELS = {k: np.array([txt for _, txt in r] + [""], dtype=object) for k, r in INDEX_RULES.items()}
+
+
+def classify_indices(values):
+    """
+    Classifica in blocco array di valori per indice con ricerca sulle soglie
+    ordinate.
+    values: { indice: array-like }
+    Ritorna dict: { indice: array di codici classe }. Il codice len(soglie)
+    indica un valore oltre l'ultima soglia. Se sono presenti GCI e NDRE
+    aggiunge "EFFICIENCY" (rapporto GCI/NDRE) e "EFFICIENCY_CLASS".
+    """
+    codes = {}
+    for name, arr in values.items():
+        edges = _RULE_EDGES.get(name)
+        if edges is None:
             continue  # salta indici non riconosciuti
+        codes[name] = np.searchsorted(edges, np.asarray(arr, dtype=np.float64), side="left")
+
+    if "GCI" in values and "NDRE" in values:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            efficiency = (np.asarray(values["GCI"], dtype=np.float64)
+                          / np.asarray(values["NDRE"], dtype=np.float64))
+        codes["EFFICIENCY"]       = efficiency
+        codes["EFFICIENCY_CLASS"] = np.searchsorted(EFFICIENCY_EDGES, efficiency, side="right")
 
-        for threshold, text in thresholds:
-            if value <= threshold:
-                description_parts.append(text)
-                break
+    return codes
 
 
-    efficiency = float(values["GCI"] / values["NDRE"])
+def class_labels(name, codes):
+    """Descrizioni testuali per i codici ritornati da classify_indices."""
+    if name == "EFFICIENCY_CLASS":
+        return np.asarray(EFFICIENCY_LABELS, dtype=object)[codes]
+    return _RULE_LABELS[name][codes]
 
-    if efficiency < 6:
-        message = f"{efficiency:.2f} - Vegetazione giovane o potata (0-6)"
-    elif 6 <= efficiency <= 10:
-        message = f"{efficiency:.2f} - Vegetazione in salute (6 - 10)"
-    elif 10 < efficiency < 12:
-        message = f"{efficiency:.2f} - Vegetazione leggermente stressata, attenzionare eventuali patogeni (10-12)"
-    elif 12 <= efficiency < 15:
-        message = f"{efficiency:.2f} - Vegetazione inefficiente, clorofilla inattiva, monitorare per patologie(12 - 15)"
-    else:  # efficiency >= 15
-        message = f"{efficiency:.2f} - Vegetazione molto malata (>15) - patologie"
 
+def describe_codes(codes, i=0):
+    """Compone la descrizione del valore i-esimo a partire dai codici classe."""
+    description_parts = []
+
+    for index_name, cls in codes.items():
+        if index_name in ["NDRE", "EFFICIENCY", "EFFICIENCY_CLASS"]: continue
+        text = _RULE_LABELS[index_name][cls[i]]
+        if text:
+            description_parts.append(text)
+
+    efficiency = float(codes["EFFICIENCY"][i])
+    message = f"{efficiency:.2f} - {EFFICIENCY_LABELS[codes['EFFICIENCY_CLASS'][i]]}"
 
     description_parts.append("\n\nClorofilla disponibile su clorofilla biochimicamente attiva GCI/NDRE: "+message) # quanto della clorofilla presente è biochimicamente attiva
     # Composizione automatica della frase
     return ", ".join(description_parts)
 
-# AGGREGAZIONE
-parser = argparse.ArgumentParser()
-parser.add_argument("-start")
-parser.add_argument("-end")
-parser.add_argument("-area")
 
+def describe_indices(values):
+    codes = classify_indices({k: np.atleast_1d(v) for k, v in values.items()})
+    return describe_codes(codes)
+
+
+if __name__ == "__main__":
+    # AGGREGAZIONE
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-start")
+    parser.add_argument("-end")
+    parser.add_argument("-area")
+    parser.add_argument("-data", default="../data",
+                        help="Cartella dei file *_pixels.csv (default: ../data)")
+    parser.add_argument("-chunksize", type=int, default=None,
+                        help="Legge i file a blocchi di N righe (memoria costante)")
+    parser.add_argument("-daily-average", action="store_true",
+                        help="Media semplice delle medie giornaliere invece della media pesata sui pixel")
+    parser.add_argument("-per-day", action="store_true",
+                        help="Stampa anche la descrizione di ogni singolo giorno")
+    parser.add_argument("-convert", action="store_true",
+                        help="Converte i *_pixels.csv in colonne float32 .npy con manifest")
+    parser.add_argument("-remove-csv", action="store_true",
+                        help="Con -convert: rimuove i CSV dopo la conversione")
+
+    args=parser.parse_args()
+
+    if args.convert:
+        area = os.path.basename(args.area).split(".")[0] if args.area else None
+        convert_all(args.data, area=area, remove_csv=args.remove_csv)
+        raise SystemExit(0)
+
+    start=args.start
+    end=args.end
 
-args=parser.parse_args()
-start=args.start
-end=args.end
+    filename_area=os.path.basename(args.area).split(".")[0]
 
-filename_area=os.path.basename(args.area).split(".")[0]
+    start_date = datetime.fromisoformat(start.replace("Z", ""))
+    end_date   = datetime.fromisoformat(end.replace("Z", ""))
 
-start_date = datetime.fromisoformat(start.replace("Z", ""))
-end_date   = datetime.fromisoformat(end.replace("Z", ""))
+    current = start_date
 
-current = start_date
+    bands={"NDVI":[], "NDRE":[], "NDMI":[], "GCI":[]}
+    days=[]
+    daily=[]
 
-bands={"NDVI":[], "NDRE":[], "NDMI":[], "GCI":[]}
+    # valutazione su immagine aggregata
+    while current <= end_date:
+        day_start = current.isoformat() + "Z"
+        day_end   = (current + relativedelta(days=1)-relativedelta(seconds=1)).isoformat() + "Z"
+        year = current.year
+        month = current.month
 
-# valutazione su immagine aggregata
-while current <= end_date:
-    day_start = current.isoformat() + "Z"
-    day_end   = (current + relativedelta(days=1)-relativedelta(seconds=1)).isoformat() + "Z"
-    year = current.year
-    month = current.month
-    
-    filename=f"../data/{filename_area}_{day_start.replace(':','-')}_{day_end.replace(':','-')}_pixels.csv"
+        filename=os.path.join(args.data, f"{filename_area}_{day_start.replace(':','-')}_{day_end.replace(':','-')}_pixels.csv")
 
-    if os.path.exists(filename):
-        df=pd.read_csv(filename)
+        if pixel_file_exists(filename):
+            stats = load_daily_summary(filename, chunksize=args.chunksize)
+            means = stats_means(stats)
+            daily.append(stats)
 
-        df=df[(df["NDVI"]!=0) & (df["NDRE"]!=0) & (df["NDMI"]!=0) & (df["GCI"]!=0)]
+            bands["NDVI"].append(means["NDVI"])
+            bands["NDRE"].append(means["NDRE"])
+            bands["NDMI"].append(means["NDMI"])
+            bands["GCI"].append(means["GCI"])
+            days.append(current.strftime("%Y-%m-%d"))
 
-        ndvi=df["NDVI"].mean()
-        ndre=df["NDRE"].mean()
-        ndmi=df["NDMI"].mean()
-        gci=df["GCI"].mean()
 
-        bands["NDVI"].append(float(ndvi))
-        bands["NDRE"].append(float(ndre))
-        bands["NDMI"].append(float(ndmi))
-        bands["GCI"].append(float(gci))
+        current+=relativedelta(days=1)
 
+    if args.daily_average:
+        ndvi=np.average(bands["NDVI"])
+        ndre=np.average(bands["NDRE"])
+        ndmi=np.average(bands["NDMI"])
+        gci=np.average(bands["GCI"])
 
-    current+=relativedelta(days=1)
+        print(f"NDVI: {ndvi}")
+        print(f"NDRE: {ndre}")
+        print(f"NDMI: {ndmi}")
+        print(f"GCI: {gci}")
+    else:
+        # media e varianza esatte sui pixel di tutti i giorni
+        total=combine_stats(daily)
+        means=stats_means(total)
+        variances=stats_variances(total)
+        ndvi, ndre, ndmi, gci = means["NDVI"], means["NDRE"], means["NDMI"], means["GCI"]
 
-ndvi=np.average(bands["NDVI"])
-ndre=np.average(bands["NDRE"])
-ndmi=np.average(bands["NDMI"])
-gci=np.average(bands["GCI"])
+        for c in ["NDVI", "NDRE", "NDMI", "GCI"]:
+            print(f"{c}: {means[c]}  (dev. std {np.sqrt(variances[c]):.4f}, {total[c]['count']} pixel)")
 
-print(f"NDVI: {ndvi}")
-print(f"NDRE: {ndre}")
-print(f"NDMI: {ndmi}")
-print(f"GCI: {gci}")
+    values={"NDVI": ndvi, "NDRE": ndre, "NDMI": ndmi, "GCI": gci}
 
-values={"NDVI": ndvi, "NDRE": ndre, "NDMI": ndmi, "GCI": gci}
+    print("\n\n"+describe_indices(values))
 
-print("\n\n"+describe_indices(values))
\ No newline at end of file
+    if args.per_day and days:
+        codes = classify_indices(bands)
+        print("\n")
+        for i, day in enumerate(days):
+            print(f"{day}: " + describe_codes(codes, i).replace("\n\n", ""))